@@ -0,0 +1,352 @@
+"""Offline benchmark for adaptive sampling policies.
+
+Instead of running real simulations, we take a reference MSM (either a saved
+MarkovStateModel or a synthetic one) as the "true" dynamics, and emulate the
+simulators by sampling discrete trajectories from its transition matrix. The
+real sampler and Modeler classes are then driven round by round, exactly
+as they would be by the server, and we record how quickly the states are
+discovered and how quickly the slowest implied timescales converge, per
+nanosecond of (emulated) simulation.
+"""
+##############################################################################
+# Imports
+##############################################################################
+# stdlib
+import multiprocessing
+
+# 3rd party
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+from IPython.utils.traitlets import Unicode, Int, Float, Enum
+
+# local
+from ..core.app import App
+from ..core.markovstatemodel import MarkovStateModel
+from ..model.modeler import Modeler
+from ..server.sampling import CountsSampler, SpectralSampler
+
+##############################################################################
+# Globals
+##############################################################################
+
+# the transition matrix that the worker processes sample from. this is set
+# once per process by _init_worker, so that we don't need to pickle the
+# whole matrix with each task
+_worker_t_matrix = None
+_worker_cumulative = None
+
+##############################################################################
+# Classes
+##############################################################################
+
+
+class SamplingBenchmark(App):
+    name = 'benchmark'
+    path = 'msmaccelerator.benchmark.efficiency.SamplingBenchmark'
+    short_description = 'Measure the efficiency of an adaptive sampling policy offline'
+    long_description = '''Emulate the simulators by sampling trajectories from
+        a reference MSM, and drive the real sampler and modeler round by round.
+        For each round, we report the number of states discovered and the
+        convergence of the slowest implied timescales, as a function of the
+        aggregate simulation time. This lets you compare samplers, or tune the
+        CountsSampler's beta, without using any GPU time.'''
+
+    reference_model = Unicode(u'', config=True, help='''Path to a saved
+        MarkovStateModel (HDF5) whose transition matrix is used as the ground
+        truth. If not set, a synthetic metastable model is generated.''')
+    n_states = Int(500, config=True, help='''Number of microstates in the
+        synthetic reference model. Ignored if reference_model is set.''')
+    n_macrostates = Int(5, config=True, help='''Number of metastable basins
+        in the synthetic reference model. Ignored if reference_model is
+        set.''')
+    n_rounds = Int(20, config=True, help='''Number of rounds of adaptive
+        sampling to emulate''')
+    n_simulators = Int(10, config=True, help='''Number of simulations to
+        run per round''')
+    n_steps = Int(100, config=True, help='''Length of each simulation, in
+        steps of the reference model''')
+    step_ns = Float(0.1, config=True, help='''Simulation time corresponding
+        to one step of the reference model, in nanoseconds''')
+    n_timescales = Int(3, config=True, help='''Number of slow implied timescales
+        to monitor for convergence''')
+    n_procs = Int(1, config=True, help='''Number of processes used to sample the
+        emulated trajectories in parallel''')
+    seed = Int(0, config=True, help='''Seed for the random number generators''')
+    output = Unicode(u'', config=True, help='''If set, save the per-round
+        results to this file, as whitespace delimited text.''')
+    sampling_strategy = Enum(['counts', 'spectral'], config=True,
+        default_value='counts', help='''Adaptive sampling strategy to
+        benchmark. See AdaptiveServer.sampling_strategy''')
+
+    # expose the sampler and modeler options on the command line of this
+    # app. the modeler's build_msm() settings (lag_time, symmetrize,
+    # ergodic_trimming) are what get used to build the models each round
+    classes = [CountsSampler, SpectralSampler, Modeler]
+
+    aliases = dict(reference_model='SamplingBenchmark.reference_model',
+                   n_states='SamplingBenchmark.n_states',
+                   n_rounds='SamplingBenchmark.n_rounds',
+                   n_simulators='SamplingBenchmark.n_simulators',
+                   n_steps='SamplingBenchmark.n_steps',
+                   n_procs='SamplingBenchmark.n_procs',
+                   seed='SamplingBenchmark.seed',
+                   output='SamplingBenchmark.output',
+                   beta='CountsSampler.beta',
+                   sampling_strategy='SamplingBenchmark.sampling_strategy',
+                   lag_time='Modeler.lag_time',
+                   symmetrize='Modeler.symmetrize')
+
+    def start(self):
+        random = np.random.RandomState(self.seed)
+        # the sampler draws from the global numpy RNG
+        np.random.seed(self.seed)
+
+        t_matrix = self.load_reference(random)
+        n_states = t_matrix.shape[0]
+        ref_timescales = implied_timescales(t_matrix, self.n_timescales,
+                                            lag_time=self.step_ns)
+        self.log.info('Reference model: %d states. Slowest timescales (ns): %s',
+                      n_states, ref_timescales)
+
+        if self.sampling_strategy == 'counts':
+            sampler = CountsSampler(config=self.config)
+        else:
+            sampler = SpectralSampler(config=self.config)
+        sampler.log = self.log
+        modeler = Modeler(config=self.config)
+        modeler.log = self.log
+
+        # before there's a model, every simulation starts from the seed
+        # state, just like with the seed_structures on the server
+        seed_state = 0
+        visited = np.zeros(0, dtype=int)
+        dtrajs = []
+        results = []
+
+        if self.n_procs > 1:
+            pool = multiprocessing.Pool(self.n_procs, initializer=_init_worker,
+                                        initargs=(t_matrix,))
+            mapper = pool.map
+        else:
+            _init_worker(t_matrix)
+            pool, mapper = None, map
+
+        try:
+            for i_round in range(self.n_rounds):
+                if sampler.model is None:
+                    starts = [seed_state] * self.n_simulators
+                else:
+                    starts = [visited[sampler.choose_state()]
+                              for i in range(self.n_simulators)]
+
+                tasks = [(s, self.n_steps, random.randint(np.iinfo(np.int32).max))
+                         for s in starts]
+                dtrajs.extend(mapper(_sample_trajectory, tasks))
+
+                # build a model on the states that we've discovered so far,
+                # using the real modeler code.
+                visited, assignments = relabel_trajectories(dtrajs, n_states)
+                counts, rev_counts, model_t_matrix, populations, mapping = \
+                    modeler.build_msm(assignments)
+                sampler.model = MarkovStateModel(counts=scipy.sparse.csr_matrix(counts),
+                    reversible_counts=scipy.sparse.csr_matrix(rev_counts),
+                    transition_matrix=scipy.sparse.csr_matrix(model_t_matrix),
+                    populations=populations, mapping=mapping,
+                    assignments=assignments, assignments_stride=1,
+                    lag_time=modeler.lag_time)
+
+                timescales = np.zeros(self.n_timescales)
+                ts = implied_timescales(model_t_matrix, self.n_timescales,
+                                        lag_time=modeler.lag_time * self.step_ns)
+                timescales[:len(ts)] = ts
+                error = np.mean(np.abs(timescales - ref_timescales) / ref_timescales)
+
+                aggregate_ns = len(dtrajs) * self.n_steps * self.step_ns
+                results.append([i_round, aggregate_ns, len(visited),
+                                len(visited) / float(n_states), error] + list(timescales))
+                self.log.info('Round %d: %.1f ns, %d/%d states discovered, '
+                              'timescale error %.3f', i_round, aggregate_ns,
+                              len(visited), n_states, error)
+        finally:
+            if pool is not None:
+                pool.close()
+
+        results = np.array(results)
+        self.log.info('Discovered %.3f states/ns, final timescale error %.3f',
+                      results[-1, 2] / results[-1, 1], results[-1, 4])
+
+        if self.output != '':
+            header = ' '.join(['round', 'aggregate_ns', 'n_discovered',
+                               'fraction_discovered', 'timescale_error'] +
+                              ['timescale_%d' % (i+1) for i in range(self.n_timescales)])
+            np.savetxt(self.output, results, header=header)
+            self.log.info('Results saved to %s', self.output)
+
+        return results
+
+    def load_reference(self, random):
+        """Load the reference transition matrix, either from disk or by
+        generating a synthetic one.
+
+        Returns
+        -------
+        t_matrix : scipy.sparse.csr_matrix
+            The row-stochastic transition matrix of the reference model.
+        """
+        if self.reference_model != '':
+            self.log.info('Loading reference model from %s', self.reference_model)
+            msm = MarkovStateModel.load(self.reference_model)
+            t_matrix = scipy.sparse.csr_matrix(msm.transition_matrix)
+            msm.close()
+            return t_matrix
+
+        self.log.info('Generating synthetic reference model')
+        return synthetic_transition_matrix(self.n_states, self.n_macrostates, random)
+
+
+##############################################################################
+# Functions
+##############################################################################
+
+
+def synthetic_transition_matrix(n_states, n_macrostates, random):
+    """Build a reversible, metastable transition matrix.
+
+    The microstates are split into `n_macrostates` basins arranged in a
+    line. Within a basin, each state is connected to a handful of random
+    neighbors, and the basins are joined to their neighbors by a few weak
+    links. Since the counts matrix is symmetric, the resulting transition
+    matrix satisfies detailed balance.
+
+    Parameters
+    ----------
+    n_states : int
+        Number of microstates
+    n_macrostates : int
+        Number of metastable basins
+    random : np.random.RandomState
+        Source of randomness
+
+    Returns
+    -------
+    t_matrix : scipy.sparse.csr_matrix
+    """
+    n_macrostates = max(1, min(n_macrostates, n_states))
+    basins = np.array_split(np.arange(n_states), n_macrostates)
+    rows, cols, vals = [], [], []
+
+    for basin in basins:
+        # a ring through the basin, so that each one is connected, plus some
+        # random shortcuts
+        n = len(basin)
+        rows.extend(basin)
+        cols.extend(np.roll(basin, 1))
+        vals.extend(random.exponential(size=n))
+        n_extra = 2 * n
+        rows.extend(random.choice(basin, n_extra))
+        cols.extend(random.choice(basin, n_extra))
+        vals.extend(random.exponential(size=n_extra))
+
+    for left, right in zip(basins[:-1], basins[1:]):
+        rows.extend(random.choice(left, 3))
+        cols.extend(random.choice(right, 3))
+        vals.extend(1e-2 * random.exponential(size=3))
+
+    counts = scipy.sparse.coo_matrix((vals, (rows, cols)), shape=(n_states, n_states)).tocsr()
+    # symmetrize, and add a little bit of self-transition probability
+    counts = counts + counts.T + scipy.sparse.identity(n_states, format='csr')
+    rowsums = np.array(counts.sum(axis=1)).flatten()
+    return scipy.sparse.csr_matrix(scipy.sparse.diags(1.0 / rowsums, 0) * counts)
+
+
+def implied_timescales(t_matrix, n_timescales, lag_time=1.0):
+    """Compute the slowest implied timescales of a transition matrix
+
+    Parameters
+    ----------
+    t_matrix : scipy.sparse matrix or np.ndarray
+        The transition matrix
+    n_timescales : int
+        The number of timescales to compute
+    lag_time : float
+        The lag time of the model, which sets the units of the timescales
+
+    Returns
+    -------
+    timescales : np.ndarray, shape=[n]
+        The slowest timescales, sorted in descending order. Note that `n`
+        can be less than `n_timescales`, if the model is very small.
+    """
+    n = t_matrix.shape[0]
+    k = min(n_timescales + 1, n)
+
+    if k + 1 >= n:
+        # arpack needs k < n - 1, so we need to use the dense solver.
+        if scipy.sparse.issparse(t_matrix):
+            t_matrix = t_matrix.toarray()
+        eigenvalues = np.linalg.eigvals(t_matrix)
+    else:
+        eigenvalues = scipy.sparse.linalg.eigs(t_matrix, k=k, which='LR',
+                                               return_eigenvectors=False)
+
+    eigenvalues = np.sort(np.real(eigenvalues))[::-1][1:k]
+    eigenvalues = np.clip(eigenvalues, 1e-12, 1 - 1e-12)
+    return -lag_time / np.log(eigenvalues)
+
+
+def relabel_trajectories(dtrajs, n_states):
+    """Relabel trajectories in the space of the reference model onto the
+    space of the states that have actually been visited, which is what
+    a modeler would see.
+
+    Returns
+    -------
+    visited : np.ndarray, dtype=int
+        visited[i] is the reference state corresponding to new state i
+    assignments : np.ndarray, dtype=int, shape=[n_trajs, max_n_frames]
+        The relabeled trajectories, padded with -1 in the msmbuilder
+        assignments format.
+    """
+    visited = np.unique(np.concatenate(dtrajs))
+    relabel = -np.ones(n_states, dtype=int)
+    relabel[visited] = np.arange(len(visited))
+
+    assignments = -np.ones((len(dtrajs), max(len(d) for d in dtrajs)), dtype=int)
+    for i, d in enumerate(dtrajs):
+        assignments[i, :len(d)] = relabel[d]
+    return visited, assignments
+
+
+def _init_worker(t_matrix):
+    """Set the transition matrix that this process samples from"""
+    global _worker_t_matrix, _worker_cumulative
+    _worker_t_matrix = scipy.sparse.csr_matrix(t_matrix)
+
+    # cumulative sum of the transition probabilities within each row, so
+    # that each step is a single binary search.
+    data = np.cumsum(_worker_t_matrix.data)
+    offsets = np.concatenate([[0], data])[_worker_t_matrix.indptr[:-1]]
+    _worker_cumulative = data - np.repeat(offsets, np.diff(_worker_t_matrix.indptr))
+
+
+def _sample_trajectory(args):
+    """Sample a discrete trajectory from the reference transition matrix.
+
+    Parameters
+    ----------
+    args : tuple of (start, n_steps, seed)
+        Packed into a tuple so this can be used with Pool.map
+    """
+    start, n_steps, seed = args
+    random = np.random.RandomState(seed)
+    indptr, indices = _worker_t_matrix.indptr, _worker_t_matrix.indices
+
+    traj = np.zeros(n_steps, dtype=int)
+    state = start
+    for i, r in enumerate(random.rand(n_steps)):
+        traj[i] = state
+        lo, hi = indptr[state], indptr[state+1]
+        j = np.searchsorted(_worker_cumulative[lo:hi], r * _worker_cumulative[hi-1])
+        state = indices[lo + min(j, hi - lo - 1)]
+    return traj
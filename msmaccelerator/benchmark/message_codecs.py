@@ -0,0 +1,102 @@
+"""Microbenchmark of the message codecs.
+
+Measures how many messages per second each codec can encode and decode,
+using messages that look like the ones that go over the wire in practice.
+The YAML loader that the server used to decode messages with is included
+for comparison, if PyYAML is installed.
+
+Usage
+-----
+$ python -m msmaccelerator.benchmark.message_codecs [n_messages]
+"""
+##############################################################################
+# Imports
+##############################################################################
+# stdlib
+import sys
+import time
+
+# local
+from ..core.message import pack_message, CODECS
+
+##############################################################################
+# Functions
+##############################################################################
+
+
+def sample_messages(n_trajs=1000):
+    """A few representative messages: a small one of the sort that the
+    simulators send, and a construct_model message, whose size grows with
+    the number of trajectories"""
+    small = pack_message('simulation_done', 'b0b3e5ba-4d11-4b86-9a2a-0c5ebd5c1d32', {
+        'status': 'success',
+        'output': {
+            'protocol': 'localfs',
+            'path': '/scratch/msmaccelerator/trajs/b0b3e5ba-4d11-4b86-9a2a-0c5ebd5c1d32.h5'
+        }
+    })
+    large = pack_message('construct_model', 'b0b3e5ba-4d11-4b86-9a2a-0c5ebd5c1d32', {
+        'traj_fns': ['/scratch/msmaccelerator/trajs/%08d.h5' % i for i in range(n_trajs)],
+        'output': {
+            'protocol': 'localfs',
+            'path': '/scratch/msmaccelerator/models/b0b3e5ba.h5'
+        }
+    })
+    return [('small', small), ('construct_model[%d]' % n_trajs, large)]
+
+
+def benchmark(encode, decode, msg, n_messages):
+    """Time the encoding and decoding of a message
+
+    Returns
+    -------
+    encode_rate, decode_rate : float
+        Messages per second
+    size : int
+        Size of the encoded message, in bytes
+    """
+    start = time.time()
+    for i in xrange(n_messages):
+        raw = encode(msg)
+    encode_time = time.time() - start
+
+    start = time.time()
+    for i in xrange(n_messages):
+        decode(raw)
+    decode_time = time.time() - start
+
+    return n_messages / encode_time, n_messages / decode_time, len(raw)
+
+
+def main(n_messages=10000):
+    codecs = []
+    for name, codec in sorted(CODECS.items()):
+        try:
+            codec.check()
+        except ImportError as e:
+            print 'Skipping %s: %s' % (name, e)
+            continue
+        codecs.append((name, codec.encode, codec.decode))
+
+    try:
+        import yaml
+        codecs.append(('yaml (old)', CODECS['json'].encode, yaml.load))
+    except ImportError:
+        pass
+
+    print '%-22s %-12s %14s %14s %10s' % ('message', 'codec', 'encode (msg/s)',
+                                          'decode (msg/s)', 'bytes')
+    for msg_name, msg in sample_messages():
+        # the big messages are slow for the yaml loader
+        n = n_messages if msg_name == 'small' else max(1, n_messages // 100)
+        for codec_name, encode, decode in codecs:
+            encode_rate, decode_rate, size = benchmark(encode, decode, msg, n)
+            print '%-22s %-12s %14.0f %14.0f %10d' % (msg_name, codec_name,
+                encode_rate, decode_rate, size)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
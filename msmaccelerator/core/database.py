@@ -1,14 +1,20 @@
 ##############################################################################
 # Imports
 ##############################################################################
+import os
+import time
+import Queue
+import bisect
+import logging
 import functools
+import threading
 from threading import Lock
 
 import sqlalchemy.exc
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import Column, Integer, String, DateTime, Float, or_
 
 ##############################################################################
 # Globals
@@ -28,9 +34,13 @@ class Model(_Base):
     __tablename__ = 'models'
 
     id = Column(Integer, primary_key=True)
-    time = Column(DateTime)
+    time = Column(DateTime, index=True)
     protocol = Column(String(500))
     path = Column(String(500))
+    # the id of the last trajectory that went into the model. the models
+    # built afterwards can start from this one and add only the
+    # trajectories with higher ids.
+    last_trajectory_id = Column(Integer)
     
     def __str__(self):
         return "<Model path=%s>" % self.path
@@ -39,9 +49,47 @@ class Trajectory(_Base):
     __tablename__ = 'trajectories'
     
     id = Column(Integer, primary_key=True)
-    time = Column(DateTime)
+    time = Column(DateTime, index=True)
     protocol = Column(String(500))
     path = Column(String(500))
+    # metadata recorded when the trajectory is registered. see
+    # core/ingest.py
+    n_frames = Column(Integer)
+    n_atoms = Column(Integer)
+    file_size = Column(Integer)
+    timestep = Column(Float)
+    checksum = Column(String(32))
+    status = Column(String(16))
+    # for a trajectory that was streamed to the server in segments, the
+    # job that it came from, and the index of the segment within the job.
+    # the segments of a job are joined into one trajectory. see
+    # TrajectoryView.since()
+    job_id = Column(String(36), index=True)
+    segment = Column(Integer)
+
+    def __str__(self):
+        return "<Trajectory path=%s>" % self.path
+
+class Lease(_Base):
+    """A simulation that's been handed out to a simulator. See
+    server/leases.py"""
+    __tablename__ = 'leases'
+
+    job_id = Column(String(36), primary_key=True)
+    sender_id = Column(String(36))
+    starting_state = Column(String(500))
+    issued = Column(DateTime)
+    # 'active', 'done' or 'expired'
+    status = Column(String(16), index=True)
+    # the last checkpoint that the simulator saved, and the number of steps
+    # that had been done when it was saved, if it sent us one
+    checkpoint = Column(String(500))
+    step = Column(Integer)
+    # the output trajectory of the job, and the id of the trajectory that
+    # it's (a part of), which is the job_id of the job that started it.
+    # they're needed to resume the job from its checkpoint.
+    output = Column(String(500))
+    trajectory_id = Column(String(36))
 
 
 ##############################################################################
@@ -51,8 +99,33 @@ class Trajectory(_Base):
 
 def connect_to_sqlite_db(db_path):
     engine = create_engine('sqlite:///{}'.format(db_path), echo=False)
+    event.listen(engine, 'connect', _set_sqlite_pragmas)
     session.configure(bind=engine)
     _Base.metadata.create_all(engine)
+    # create_all() doesn't add new columns or indices to tables that
+    # already exist, e.g. in a database from an older version
+    for table in _Base.metadata.sorted_tables:
+        existing = set(row[1] for row in
+                       engine.execute('PRAGMA table_info(%s)' % table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                    table.name, column.name, column.type.compile(engine.dialect)))
+        for index in table.indexes:
+            engine.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (
+                index.name, table.name, ', '.join(c.name for c in index.columns)))
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # In WAL mode, readers don't block the writer (and vice versa), and
+    # a commit is an append to the log instead of a rewrite of the pages
+    # in the database. With synchronous=NORMAL, the log is only fsynced at
+    # checkpoints, so a commit can only be lost on power failure, not if
+    # the process crashes.
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
 
 
 def with_db_lock(f):
@@ -63,4 +136,270 @@ def with_db_lock(f):
             return f(*args, **kwargs)
         finally:
             _session_lock.release()
-    return wrap
\ No newline at end of file
+    return wrap
+
+
+def latest_model(db=session):
+    """Get the most recently built model, or None if there aren't any"""
+    return db.query(Model).order_by(Model.time.desc(),
+                                         Model.id.desc()).first()
+
+
+def trajectories_since(last_id=0, db=session):
+    """Get the (id, path, n_frames, job_id, segment) of every usable
+    trajectory whose id is
+    greater than `last_id`, in order of id. The ids increase as trajectories
+    are added, so this is the set of trajectories added since `last_id`.
+
+    Trajectories whose files were found to be missing, empty or corrupt
+    when they were registered are skipped.
+    """
+    return db.query(Trajectory.id, Trajectory.path, Trajectory.n_frames,
+                    Trajectory.job_id, Trajectory.segment).filter(
+        Trajectory.id > last_id).filter(
+        or_(Trajectory.status == None, Trajectory.status == 'ok')).order_by(
+        Trajectory.id).all()
+
+def active_leases(db=session):
+    """Get the leases on simulations that haven't finished or expired"""
+    return db.query(Lease).filter(Lease.status == 'active').all()
+
+##############################################################################
+# Classes
+##############################################################################
+
+
+class TrajectoryView(object):
+    """In-memory copy of the paths in the trajectories table.
+
+    Instead of reading every row each time that we need the list of
+    trajectories, the view keeps the rows that it's already seen, and
+    refresh() only asks the database for the rows added since then.
+
+    Examples
+    --------
+    >>> view = TrajectoryView()
+    >>> view.refresh()
+    >>> view.paths          # every trajectory
+    >>> view.since(last_id) # (ids, paths) added after last_id
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.ids = []
+        self.paths = []
+        # None for the trajectories registered before this was recorded
+        self.n_frames = []
+        # None for the trajectories that weren't streamed in segments
+        self.job_ids = []
+        self.segments = []
+        self._last_id = 0
+
+    @property
+    def last_id(self):
+        return self._last_id
+
+    def refresh(self):
+        """Read the rows that have been inserted since the last refresh"""
+        with self._lock:
+            rows = self._query(self._last_id)
+            for id, path, n_frames, job_id, segment in rows:
+                self.ids.append(id)
+                self.paths.append(str(path))
+                self.n_frames.append(n_frames)
+                self.job_ids.append(job_id)
+                self.segments.append(segment)
+            if len(rows) > 0:
+                self._last_id = rows[-1][0]
+
+    @with_db_lock
+    def _query(self, last_id):
+        # use a new session, so that we don't keep a transaction open, and
+        # don't touch anything pending in the calling thread's session
+        db = session.session_factory()
+        try:
+            return trajectories_since(last_id, db)
+        finally:
+            db.close()
+
+    def since(self, last_id):
+        """The ids and paths of the trajectories with id > last_id
+
+        The segments of a job are joined into a single trajectory, whose
+        path is the paths of the segments, in order, separated by
+        os.pathsep. If any of the segments of a job has id > last_id, the
+        whole trajectory is returned, including the segments that were
+        registered before last_id, since they're one continuous
+        trajectory. (A model that contained the earlier segments has to
+        replace that trajectory with this one. See Modeler.extend_model.)
+        The segments after one that's missing (e.g. because it hasn't been
+        registered yet) are left out, and the id of the trajectory is that
+        of the last of its segments that's included. The trajectories are in
+        order of id.
+        """
+        with self._lock:
+            i = bisect.bisect_right(self.ids, last_id)
+            new_jobs = set(job_id for job_id in self.job_ids[i:] if job_id is not None)
+            if len(new_jobs) == 0:
+                return self.ids[i:], self.paths[i:]
+
+            # the new rows, and the earlier segments of the jobs among them
+            rows = [k for k in range(i) if self.job_ids[k] in new_jobs]
+            rows.extend(range(i, len(self.ids)))
+
+            # job_id -> {segment: (id, path)}. if a job was started over
+            # (see server/leases.py), its segments are registered again,
+            # and the newer ones replace the older ones.
+            jobs = {}
+            trajectories = []
+            for k in rows:
+                id, path, job_id = self.ids[k], self.paths[k], self.job_ids[k]
+                if job_id is None:
+                    trajectories.append((id, path))
+                else:
+                    jobs.setdefault(job_id, {})[self.segments[k]] = (id, path)
+
+            for segments in jobs.values():
+                # the segments up to the first one that's missing
+                contiguous = []
+                for segment in sorted(segments):
+                    if segment != len(contiguous):
+                        break
+                    contiguous.append(segments[segment])
+                if len(contiguous) > 0:
+                    trajectories.append((max(id for id, path in contiguous),
+                        os.pathsep.join(path for id, path in contiguous)))
+
+            trajectories.sort(key=lambda t: t[0])
+            return ([id for id, path in trajectories],
+                    [path for id, path in trajectories])
+
+    def n_frames_since(self, last_id):
+        """The total number of frames in the trajectories with id > last_id.
+        Trajectories whose length wasn't recorded count as zero."""
+        with self._lock:
+            i = bisect.bisect_right(self.ids, last_id)
+            return sum(n for n in self.n_frames[i:] if n is not None)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class WriteBehindQueue(object):
+    """Queue of rows to be inserted into the database, which are committed
+    in batches by a background thread.
+
+    Committing each row as it comes in costs a full transaction (and an
+    fsync) per row. Rows with the same primary key as an existing row
+    update it. Instead, rows are added to the queue, and committed
+    together once `batch_size` of them have accumulated, `max_delay`
+    seconds after the first one was queued, or when the queue is flushed
+    or closed.
+
+    Parameters
+    ----------
+    batch_size : int
+        Maximum number of rows to insert in a single transaction
+    max_delay : float
+        Maximum time, in seconds, that a row waits in the queue before
+        it's committed.
+    log : logging.Logger, optional
+        Where to report errors from the background thread
+    on_commit : callable, optional
+        Called as on_commit(n_rows, seconds) from the background thread
+        after each batch is committed. It's called without holding the
+        database lock, so it can read from the database.
+
+    Notes
+    -----
+    Anything that reads from the database should call flush() first, so
+    that it sees all of the rows that have been added.
+    """
+    _CLOSE = object()
+
+    def __init__(self, batch_size=100, max_delay=1.0, log=None, on_commit=None):
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.on_commit = on_commit
+        self.log = log if log is not None else logging.getLogger(__name__)
+        self._queue = Queue.Queue()
+        self._closed = False
+        # so that nothing is put on the queue after _CLOSE, where the
+        # background thread would never take it off
+        self._put_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run,
+                                        name='WriteBehindQueue')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, row):
+        """Queue a row to be inserted into the database"""
+        with self._put_lock:
+            if self._closed:
+                raise ValueError('WriteBehindQueue is closed')
+            self._queue.put(row)
+
+    def flush(self):
+        """Block until all of the rows that have been added so far are
+        committed. After close(), this just waits for the rows that close()
+        is committing."""
+        with self._put_lock:
+            closed = self._closed
+            if not closed:
+                self._queue.put(None)
+        if closed:
+            self._thread.join()
+        else:
+            self._queue.join()
+
+    def close(self):
+        """Commit the remaining rows, and stop the background thread. This
+        is safe to call more than once."""
+        with self._put_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(self._CLOSE)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            # wait (indefinitely) for the first row of the next batch
+            batch = [self._queue.get()]
+            deadline = time.time() + self.max_delay
+            while batch[-1] is not None and batch[-1] is not self._CLOSE \
+                    and len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(
+                        timeout=max(0, deadline - time.time())))
+                except Queue.Empty:
+                    break
+
+            rows = [row for row in batch
+                    if row is not None and row is not self._CLOSE]
+            if len(rows) > 0:
+                start = time.time()
+                self._commit(rows)
+                # outside of the lock, so that the callback can read from
+                # the database
+                if self.on_commit is not None:
+                    self.on_commit(len(rows), time.time() - start)
+            for i in range(len(batch)):
+                self._queue.task_done()
+            if batch[-1] is self._CLOSE:
+                return
+
+    @with_db_lock
+    def _commit(self, rows):
+        try:
+            for row in rows:
+                session.merge(row)
+            session.commit()
+        except sqlalchemy.exc.SQLAlchemyError:
+            session.rollback()
+            self.log.exception('Failed to commit %d rows to the database',
+                               len(rows))
+        finally:
+            # the background thread has its own session (it's a
+            # scoped_session). close it so that it doesn't hold on to
+            # its connection between batches.
+            session.remove()
@@ -8,14 +8,16 @@ to get registered with the server and start their work.
 # Imports
 ##############################################################################
 
+import os
 import zmq
+import time
 import uuid
-import yaml
 
-from IPython.utils.traitlets import Int, Unicode, Bytes
+from IPython.utils.traitlets import Int, Unicode, Bytes, Enum, Float
 
 from .app import App
-from ..core.message import Message, pack_message
+from ..core.message import (Message, pack_message, get_codec, array_frames,
+                            attach_arrays)
 
 ##############################################################################
 # Classes
@@ -46,12 +48,26 @@ class Device(App):
     zmq_port = Int(12345, config=True, help='ZeroMQ port to connect to the server on')
     zmq_url = Unicode('127.0.0.1', config=True, help='URL to connect to server with')
     uuid = Bytes(help='Unique identifier for this device')
+    codec = Enum(['json', 'msgpack'], default_value='json', config=True,
+        help='''Serialization format for the messages sent to the server. The
+        server replies with the same format. msgpack is faster, but requires
+        the msgpack package.''')
+    heartbeat_interval = Float(60, config=True, help='''Minimum interval, in
+        seconds, between the heartbeats that a device sends to the server
+        while it's working on a job. The server expires the lease on a job
+        if it doesn't hear a heartbeat for AdaptiveServer.lease_timeout
+        seconds, so this should be a good deal shorter than that.''')
+    status_batch_interval = Float(10, config=True, help='''Interval, in
+        seconds, between the batches of status reports that a device
+        publishes to the server, if the server has a status port (see
+        BaseServer.status_port). The reports are queued up in between.''')
 
     def _uuid_default(self):
         return str(uuid.uuid4())
 
     aliases = dict(zmq_port='Device.zmq_port',
-                   zmq_url='Device.zmq_url')
+                   zmq_url='Device.zmq_url',
+                   codec='Device.codec')
 
     @property
     def zmq_connection_string(self):
@@ -59,6 +75,29 @@ class Device(App):
 
     def start(self):
         self.ctx = zmq.Context()
+        self.connect()
+
+        # send the "here i am message" to the server, and receive a response
+        # we're using a "robust" send/recv pattern, basically retrying the
+        # request a fixed number of times if no response is heard from the
+        # server
+        msg = self.register()
+        self.on_startup_message(msg)
+
+    def register(self):
+        """Send the 'register_{ClassName}' message to the server, and return
+        its response. The content of the message is registration_content().
+        """
+        return self.send_recv(msg_type='register_%s' % self.__class__.__name__,
+                              content=self.registration_content())
+
+    def registration_content(self):
+        """The content of the register message. Override this in a subclass
+        to tell the server what sort of work the device wants."""
+        return None
+
+    def connect(self):
+        """Open the REQ socket (self.socket), and connect it to the server"""
         self.socket = self.ctx.socket(zmq.REQ)
         # we're using the uuid to set the identity of the socket
         # AND we're going to put it explicitly inside of the header of
@@ -68,15 +107,124 @@ class Device(App):
         # code to have the sender of each message, and for the message json
         # itself to be "complete", insted of having the sender in a separate
         # data structure.
-        self.socket.setsockopt(zmq.IDENTITY, self.uuid)
+        #
+        # when we reconnect after a timeout, the server might not have
+        # noticed that the old connection is gone yet, and it ignores a new
+        # connection with the same identity, so each reconnection gets a
+        # new one. the server routes its replies to the identity of our
+        # latest message.
+        self._n_connects = getattr(self, '_n_connects', 0) + 1
+        identity = self.uuid
+        if self._n_connects > 1:
+            identity = '%s.%d' % (self.uuid, self._n_connects - 1)
+        self.socket.setsockopt(zmq.IDENTITY, identity)
         self.socket.connect(self.zmq_connection_string)
 
-        # send the "here i am message" to the server, and receive a response
-        # we're using a "robust" send/recv pattern, basically retrying the
-        # request a fixed number of times if no response is heard from the
-        # server
-        msg = self.send_recv(msg_type='register_%s' % self.__class__.__name__)
-        self.on_startup_message(msg)
+    def heartbeat(self, job_id, **status):
+        """Tell the server that we're still working on a job, renewing our
+        lease on it. This is rate-limited to one message per job
+        every heartbeat_interval seconds, so it's fine to call it often.
+
+        Parameters
+        ----------
+        job_id : str
+            The job_id from the server's message. If None (e.g. an old
+            server that doesn't hand out leases), nothing is sent.
+        **status
+            Extra information to send to the server with the heartbeat.
+        """
+        now = time.time()
+        if not hasattr(self, '_last_heartbeat'):
+            # job_id -> time of the last heartbeat for that job
+            self._last_heartbeat = {}
+        if job_id is None or now - self._last_heartbeat.get(job_id, 0) < self.heartbeat_interval:
+            return
+        self._last_heartbeat[job_id] = now
+        self._send_status(job_id, status)
+
+    def checkpoint(self, job_id, path, step):
+        """Tell the server that we've saved a checkpoint of a job, so that if
+        we die, the job can be resumed from there instead of starting over.
+        This also renews our lease on the job, and isn't rate-limited.
+
+        Parameters
+        ----------
+        job_id : str
+            The job_id from the server's message. If None, nothing is sent.
+        path : str
+            Path to the checkpoint
+        step : int
+            The number of steps of the job that had been done when the
+            checkpoint was saved
+        """
+        if job_id is None:
+            return
+        if not hasattr(self, '_last_heartbeat'):
+            self._last_heartbeat = {}
+        self._last_heartbeat[job_id] = time.time()
+        self._send_status(job_id, {'step': step, 'checkpoint': {
+            'protocol': 'localfs', 'path': os.path.abspath(path)}})
+
+    def connect_status(self, port):
+        """Open the PUB socket (self.status_socket) that the status reports
+        are published on, and connect it to the server's status port. Does
+        nothing if it's already open."""
+        if getattr(self, 'status_socket', None) is not None:
+            return
+        self.status_socket = self.ctx.socket(zmq.PUB)
+        # if the server can't keep up, drop the reports instead of piling
+        # them up in memory. they're only informational.
+        self.status_socket.setsockopt(zmq.SNDHWM, 10)
+        self.status_socket.setsockopt(zmq.LINGER, 0)
+        self.status_socket.connect('tcp://%s:%s' % (self.zmq_url, port))
+        # reports waiting to be sent
+        self._status_reports = []
+        self._last_status_batch = time.time()
+
+    def publish_status(self, job_id, **status):
+        """Queue up a status report on a job, to be published to the server
+        in the next batch. Unlike heartbeat(), this doesn't wait for a reply
+        from the server, so it's cheap enough to call at every report of the
+        simulation. Does nothing if connect_status() hasn't been called.
+
+        Parameters
+        ----------
+        job_id : str
+            The job_id from the server's message
+        **status
+            The report, e.g. step, ns_per_day and potential_energy
+        """
+        if getattr(self, 'status_socket', None) is None:
+            return
+        status['job_id'] = job_id
+        status['time'] = time.time()
+        self._status_reports.append(status)
+        if status['time'] - self._last_status_batch >= self.status_batch_interval:
+            self.send_status_reports()
+
+    def send_status_reports(self):
+        """Publish the queued status reports to the server now, as a single
+        status_batch message. If the message can't be sent without blocking,
+        the reports are dropped."""
+        if getattr(self, 'status_socket', None) is None:
+            return
+        self._last_status_batch = time.time()
+        if len(self._status_reports) == 0:
+            return
+        msg = pack_message(msg_type='status_batch', sender_id=self.uuid,
+                           content={'reports': self._status_reports})
+        self._status_reports = []
+        try:
+            self.status_socket.send(get_codec(self.codec).encode(msg), zmq.NOBLOCK)
+        except zmq.Again:
+            self.log.debug('Dropped a batch of status reports')
+
+    def _send_status(self, job_id, status):
+        status['job_id'] = job_id
+        msg = self.send_recv('simulation_status', status)
+        if 'status' in msg.content and msg.content.status == 'unknown_job':
+            self.log.warning('The server says that our lease on job %s has '
+                             'expired', job_id)
 
     def on_startup_message(self, msg_type, msg):
         """This method is called when the device receives its startup message
@@ -84,34 +232,52 @@ class Device(App):
         """
         raise NotImplementedError('This method should be overriden in a device subclass')
 
-    def send_message(self, msg_type, content=None):
+    def send_message(self, msg_type, content=None, arrays=None, request_id=None):
         """Send a message to the server asynchronously.
 
         Since we're using the request/reply pattern, after calling send
         you need to call recv to get the server's response. Consider instead
         using the send_recv method instead
 
+        Parameters
+        ----------
+        msg_type : str
+            The type of the message
+        content : dict
+            The contents of the message
+        arrays : dict of str -> np.ndarray, optional
+            Numpy arrays to send along with the message, as extra frames.
+            These are sent without making a copy.
+        request_id : str, optional
+            Put in the header, so that the server can tell when a request
+            is retried. See send_recv().
+
         See Also
         --------
         send_recv
         """
         if content is None:
             content = {}
-        self.socket.send_json(pack_message(msg_type=msg_type, content=content,
-                                           sender_id=self.uuid))
+        msg = pack_message(msg_type=msg_type, content=content,
+                           sender_id=self.uuid, arrays=arrays)
+        if request_id is not None:
+            msg['header']['request_id'] = request_id
+        frames = [get_codec(self.codec).encode(msg)] + array_frames(arrays)
+        self.socket.send_multipart(frames, copy=False)
 
     def recv_message(self):
         """Receive a message from the server.
 
         Note, this methos is not async -- it blocks the device until
-        the server delivers a message
+        the server delivers a message. Any arrays attached to the message
+        are put in its content, as views over the received frames.
         """
-        raw_msg = self.socket.recv()
-        msg = yaml.load(raw_msg)
-        return Message(msg)
+        frames = self.socket.recv_multipart(copy=False)
+        msg = get_codec(self.codec).decode(frames[0].bytes)
+        return Message(attach_arrays(msg, frames[1:]))
 
 
-    def send_recv(self, msg_type, content=None, timeout=10, retries=3):
+    def send_recv(self, msg_type, content=None, timeout=10, retries=3, arrays=None):
         """Send a message to the server and receive a response
 
         This method inplementes the "Lazy-Pirate pattern" for
@@ -132,13 +298,19 @@ class Device(App):
             If a response from the server is not received within `timeout`
             seconds, we'll retry sending our payload at most `retries`
             number of times. After that point, if no return message has
-            been received, we'll throw an IOError.
+            been received, we'll throw an IOError. Each attempt carries the
+            same request_id, so that the server only handles the request
+            once (e.g. if it was just slow to reply), and sends its reply
+            to the latest attempt.
+        arrays : dict of str -> np.ndarray, optional
+            Numpy arrays to send along with the message. See send_message.
         """
         timeout_ms = timeout * 1000
+        request_id = str(uuid.uuid4())
 
         poller = zmq.Poller()
         for i in range(retries):
-            self.send_message(msg_type, content)
+            self.send_message(msg_type, content, arrays, request_id)
             poller.register(self.socket, zmq.POLLIN)
             if poller.poll(timeout_ms):
                 return self.recv_message()
@@ -146,8 +318,8 @@ class Device(App):
                 self.log.error('No response received from server on'
                                'msg_type=%s. Retrying...', msg_type)
                 poller.unregister(self.socket)
+                self.socket.setsockopt(zmq.LINGER, 0)
                 self.socket.close()
-                self.socket = self.ctx.socket(zmq.REQ)
-                self.socket.connect(self.zmq_connection_string)
+                self.connect()
 
         raise IOError('Network timeout. Server is unresponsive.')
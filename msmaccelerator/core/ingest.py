@@ -0,0 +1,226 @@
+"""Ingestion of new trajectories by the server.
+
+When a trajectory is registered with the server, we record some metadata
+about the file, so that the consumers of the trajectories (e.g. the modeler)
+can plan their work, and skip bad files, without opening each of them.
+
+Optionally, the coordinates of the atoms used for clustering are also
+extracted, centered, and saved to a cache of features, so that the modeler
+doesn't need to read (and slice) the full trajectory files.
+"""
+##############################################################################
+# Imports
+##############################################################################
+
+import os
+import hashlib
+import traceback
+
+import numpy as np
+
+from .trajectory_cache import TrajectoryCache
+
+##############################################################################
+# Globals
+##############################################################################
+
+# values of the status field
+STATUS_OK = 'ok'
+# the file doesn't exist
+STATUS_MISSING = 'missing'
+# the file exists, but doesn't contain any frames
+STATUS_EMPTY = 'empty'
+# the file exists, but can't be read all the way to the end
+STATUS_CORRUPT = 'corrupt'
+
+##############################################################################
+# Functions
+##############################################################################
+
+
+def trajectory_metadata(path, trajectories=None):
+    """Inspect a trajectory file.
+
+    Parameters
+    ----------
+    path : str
+        Path to the trajectory file
+    trajectories : TrajectoryCache, optional
+        Cache to open the file through. This is needed for formats that
+        don't contain their own topology, e.g. AMBER NetCDF.
+
+    Returns
+    -------
+    metadata : dict
+        A dict with the keys 'n_frames', 'n_atoms', 'file_size',
+        'timestep' (in picoseconds), 'checksum' (md5), and 'status', which is
+        one of 'ok', 'missing', 'empty' or 'corrupt'. The fields that can't
+        be determined are None.
+    """
+    metadata = _empty_metadata()
+    if not os.path.exists(path):
+        metadata['status'] = STATUS_MISSING
+        return metadata
+
+    metadata['file_size'] = os.path.getsize(path)
+    metadata['checksum'] = file_checksum(path)
+
+    if trajectories is None:
+        trajectories = TrajectoryCache(max_open=1)
+    try:
+        n_frames = trajectories.n_frames(path)
+        metadata['n_frames'] = n_frames
+        if n_frames == 0:
+            metadata['status'] = STATUS_EMPTY
+            return metadata
+
+        head = trajectories.read(path, stop=min(2, n_frames))
+        metadata['n_atoms'] = head.n_atoms
+        if head.n_frames > 1:
+            metadata['timestep'] = float(head.time[1] - head.time[0])
+        # a file from a simulation that died while writing it can have a
+        # header that says there are more frames than there actually are,
+        # so check that the last one can be read.
+        trajectories.read_frame(path, n_frames - 1)
+    except Exception:
+        metadata['status'] = STATUS_CORRUPT
+    finally:
+        # we're not going to come back to this file any time soon
+        trajectories.close(path)
+
+    return metadata
+
+
+def ingest_trajectory(path, features_fn=None, atom_indices=None, topology=None):
+    """Inspect a new trajectory, and optionally save its features.
+
+    This is meant to be run in a worker process, so everything that it
+    needs is passed in, and everything that it produces is returned or
+    written to disk.
+
+    Parameters
+    ----------
+    path : str
+        Path to the trajectory file
+    features_fn : str, optional
+        If given, save the centered coordinates of the atoms in
+        `atom_indices` to this file. See save_features().
+    atom_indices : np.ndarray, optional
+        The atoms to save. If None, all of them.
+    topology : str, optional
+        Path to a PDB file giving the topology, for the trajectory formats
+        that don't contain one.
+
+    Returns
+    -------
+    metadata : dict
+        See trajectory_metadata()
+    error : str or None
+        The traceback, if something went wrong. This never raises, because
+        the pool that it's run in can't report errors (in python 2), so
+        the trajectory would never be recorded. If the file couldn't even be
+        inspected, its status is 'missing' or 'corrupt'.
+    """
+    metadata = None
+    try:
+        trajectories = TrajectoryCache(max_open=1, topology=topology)
+        metadata = trajectory_metadata(path, trajectories)
+        if features_fn is None or metadata['status'] != STATUS_OK:
+            return metadata, None
+
+        traj = trajectories.read(path, atom_indices=atom_indices)
+        trajectories.close()
+        save_features(features_fn, path, traj.xyz, atom_indices)
+    except Exception:
+        if metadata is None:
+            metadata = _empty_metadata()
+            metadata['status'] = STATUS_CORRUPT if os.path.exists(path) else STATUS_MISSING
+        return metadata, traceback.format_exc()
+    return metadata, None
+
+
+def save_features(features_fn, path, xyz, atom_indices=None):
+    """Save the coordinates of a subset of the atoms of a trajectory,
+    centered on the origin, to the cache of features.
+
+    Parameters
+    ----------
+    features_fn : str
+        The file to save to (.npz)
+    path : str
+        Path to the trajectory that the coordinates came from. Its size
+        and modification time are recorded, so that stale features can be
+        detected.
+    xyz : np.ndarray, shape=[n_frames, n_atoms, 3]
+        The coordinates, of only the atoms in atom_indices
+    atom_indices : np.ndarray, optional
+        The indices of the atoms in `xyz`. If None, xyz contains all of
+        the atoms.
+    """
+    xyz = np.asarray(xyz, dtype=np.float32)
+    xyz = xyz - xyz.mean(axis=1)[:, np.newaxis, :]
+    st = os.stat(path)
+
+    # write to a temporary file and then rename it, so that a reader never
+    # sees a half written file. (np.savez adds the .npz extension)
+    tmp = features_fn + '.tmp.npz'
+    np.savez(tmp, xyz=xyz, all_atoms=atom_indices is None,
+             atom_indices=np.zeros(0, dtype=int) if atom_indices is None else atom_indices,
+             source_size=st.st_size, source_mtime=st.st_mtime)
+    os.rename(tmp, features_fn)
+
+
+def load_features(features_fn, path, atom_indices=None):
+    """Load the cached coordinates for a trajectory
+
+    Parameters
+    ----------
+    features_fn : str
+        The file that the features were saved to
+    path : str
+        Path to the trajectory that the coordinates came from
+    atom_indices : np.ndarray, optional
+        The atoms that you want. If None, all of them.
+
+    Returns
+    -------
+    xyz : np.ndarray or None
+        The centered coordinates, or None if there's no usable entry in the
+        cache: the file doesn't exist, it was saved with a different set of
+        atoms, or the trajectory has changed since it was saved.
+    """
+    if not os.path.exists(features_fn):
+        return None
+    f = np.load(features_fn)
+    try:
+        if bool(f['all_atoms']) != (atom_indices is None):
+            return None
+        if atom_indices is not None and not np.array_equal(f['atom_indices'], atom_indices):
+            return None
+        st = os.stat(path)
+        if (int(f['source_size']), float(f['source_mtime'])) != (st.st_size, st.st_mtime):
+            return None
+        return f['xyz']
+    finally:
+        f.close()
+
+
+def features_filename(features_dir, path):
+    """The name of the file in the cache of features for a trajectory"""
+    basename = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(features_dir, basename + '.npz')
+
+
+def _empty_metadata():
+    """Metadata of a trajectory that hasn't been inspected yet"""
+    return dict(n_frames=None, n_atoms=None, file_size=None, timestep=None,
+                checksum=None, status=STATUS_OK)
+
+
+def file_checksum(path, block_size=2**20):
+    """MD5 checksum of a file, as a hex string"""
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), ''):
+            md5.update(block)
+    return md5.hexdigest()
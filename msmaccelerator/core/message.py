@@ -21,6 +21,21 @@ The general format is
 
 The allowable 'msg_type's have not been fully decided yet. Sorry.
 
+Messages can also carry numpy arrays, without going through the shared
+filesystem. These are sent as extra ZMQ frames following the message frame,
+containing the raw array buffers. Their names, dtypes and shapes are listed
+(in the same order as the frames) in the header under 'arrays':
+
+  'arrays' : [{'name': str, 'dtype': str, 'shape': list}, ...]
+
+On the receiving side, each array is put in the content dict under its name,
+as a read-only view over the ZMQ frame, so that no copy is made.
+
+On the wire, the message dict is serialized by a codec. Both JSON and (if
+the msgpack package is installed) msgpack are supported. The devices choose
+a codec with the Device.codec configurable, and the server detects which
+codec each message was encoded with, and replies in kind.
+
 TODO: Figure out schema for all of the message types. What content do they
 supply?
 """
@@ -29,16 +44,24 @@ supply?
 # Imports
 ##############################################################################
 
+import json
 import time
 import uuid
 import pprint
 
+import numpy as np
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 #############################################################################
 # Functions
 ##############################################################################
 
 
-def pack_message(msg_type, sender_id, content):
+def pack_message(msg_type, sender_id, content, arrays=None):
     """Construct a message dict
 
     Parameters
@@ -50,6 +73,10 @@ def pack_message(msg_type, sender_id, content):
     content : dict
         Any content of the message. The semantics of the content dict
         are specific to different message types
+    arrays : dict of str -> np.ndarray, optional
+        Numpy arrays to send along with the message. Their metadata goes
+        in the header. The buffers themselves need to be sent as extra frames,
+        in the order given by array_frames(arrays).
     """
     # do some typechecking on the keys
     if not isinstance(msg_type, str):
@@ -57,7 +84,7 @@ def pack_message(msg_type, sender_id, content):
     if not isinstance(content, dict):
         raise ValueError('content must be dict')
 
-    return squash_unicode({
+    msg = {
         'header': {
             'sender_id': str(sender_id),
             'msg_id': str(uuid.uuid4()),
@@ -65,7 +92,129 @@ def pack_message(msg_type, sender_id, content):
             'time': time.time()
         },
         'content': content
-    })
+    }
+    if arrays:
+        msg['header']['arrays'] = [{
+            'name': name,
+            'dtype': arrays[name].dtype.str,
+            'shape': list(arrays[name].shape)
+        } for name in sorted(arrays.keys())]
+    return msg
+
+
+def array_frames(arrays):
+    """The buffers to send as extra frames for the arrays attached to a
+    message, in the same order as their metadata in the header.
+
+    Returns
+    -------
+    frames : list of np.ndarray
+        C-contiguous arrays, which expose the buffer interface, so that
+        they can be sent by ZMQ without a copy.
+    """
+    if not arrays:
+        return []
+    return [np.ascontiguousarray(arrays[name]) for name in sorted(arrays.keys())]
+
+
+def attach_arrays(msg_dict, frames):
+    """Reconstruct the arrays sent with a message from the extra frames,
+    and put them in the message's content dict
+
+    Parameters
+    ----------
+    msg_dict : dict
+        The decoded message
+    frames : list of zmq.Frame, buffer or str
+        The frames following the message frame. If these are zmq.Frames
+        (i.e. they were received with copy=False), the arrays are views
+        over their memory.
+
+    Returns
+    -------
+    msg_dict : dict
+        The same message dict, with the arrays added to the content
+    """
+    specs = msg_dict['header'].get('arrays', [])
+    if len(specs) != len(frames):
+        raise ValueError('message header lists %d arrays, but %d frames '
+                         'were received' % (len(specs), len(frames)))
+
+    for spec, frame in zip(specs, frames):
+        buf = getattr(frame, 'buffer', frame)
+        array = np.frombuffer(buf, dtype=np.dtype(spec['dtype']))
+        msg_dict['content'][spec['name']] = array.reshape(spec['shape'])
+    return msg_dict
+
+
+def get_codec(name):
+    """Get the codec with a given name
+
+    Parameters
+    ----------
+    name : {'json', 'msgpack'}
+        The name of the codec
+    """
+    try:
+        codec = CODECS[name]
+    except KeyError:
+        raise ValueError('Unknown codec: %s. Choose from %s' % (name, CODECS.keys()))
+    codec.check()
+    return codec
+
+
+def guess_codec(raw_msg):
+    """Determine which codec was used to encode a message.
+
+    All messages are dicts, so in JSON they start with '{'. In msgpack, a
+    map starts with one of the bytes 0x80-0x8f, 0xde or 0xdf, none of which
+    can start a JSON document.
+    """
+    if raw_msg[:1] == '{':
+        return CODECS['json']
+    return CODECS['msgpack']
+
+
+##############################################################################
+# Codecs
+##############################################################################
+
+
+class JSONCodec(object):
+    """Encode messages as JSON"""
+    name = 'json'
+
+    def check(self):
+        pass
+
+    def encode(self, msg_dict):
+        return json.dumps(msg_dict)
+
+    def decode(self, raw_msg):
+        # the json module gives us unicode strings, which we don't want,
+        # since you can't send unicode over zmq
+        return squash_unicode(json.loads(raw_msg))
+
+
+class MsgpackCodec(object):
+    """Encode messages with msgpack, which is quite a bit faster than
+    JSON and more compact. Strings are packed as raw bytes, so they come
+    back out as bytestrings without any post-processing."""
+    name = 'msgpack'
+
+    def check(self):
+        if msgpack is None:
+            raise ImportError('The msgpack codec requires the msgpack package. '
+                              'You can install it with `pip install msgpack-python`')
+
+    def encode(self, msg_dict):
+        return msgpack.packb(msg_dict, use_bin_type=False)
+
+    def decode(self, raw_msg):
+        return msgpack.unpackb(raw_msg, raw=True)
+
+
+CODECS = {'json': JSONCodec(), 'msgpack': MsgpackCodec()}
 
 
 ##############################################################################
@@ -0,0 +1,121 @@
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+from msmaccelerator.core.database import (session, connect_to_sqlite_db,
+    Model, Trajectory, TrajectoryView, WriteBehindQueue, latest_model)
+
+
+def test_write_behind_queue():
+    dirname = tempfile.mkdtemp()
+    try:
+        connect_to_sqlite_db(os.path.join(dirname, 'db.sqlite'))
+        commits = []
+        queue = WriteBehindQueue(batch_size=10, max_delay=60,
+                                 on_commit=lambda n, t: commits.append(n))
+
+        for i in range(25):
+            queue.add(Trajectory(time=datetime.now(), protocol='localfs',
+                                 path='%d.h5' % i))
+        queue.flush()
+        assert session.query(Trajectory).count() == 25
+        # two full batches, and the rest was committed by the flush
+        assert commits == [10, 10, 5]
+
+        queue.add(Trajectory(time=datetime.now(), protocol='localfs',
+                             path='25.h5'))
+        queue.close()
+        assert session.query(Trajectory).count() == 26
+        # doesn't block on a queue that nothing is reading anymore
+        queue.flush()
+        queue.close()
+        assert session.execute('PRAGMA journal_mode').scalar() == 'wal'
+    finally:
+        session.remove()
+        shutil.rmtree(dirname)
+
+
+def test_write_behind_queue_on_commit_reads():
+    # the callback runs after the lock is released, so it can query the
+    # database (as AdaptiveServer._on_commit does) without deadlocking
+    dirname = tempfile.mkdtemp()
+    try:
+        connect_to_sqlite_db(os.path.join(dirname, 'db.sqlite'))
+        view = TrajectoryView()
+        queue = WriteBehindQueue(batch_size=10, max_delay=60,
+                                 on_commit=lambda n, t: view.refresh())
+        for i in range(3):
+            queue.add(Trajectory(time=datetime.now(), protocol='localfs',
+                                 path='%d.h5' % i))
+        queue.flush()
+        assert view.paths == ['%d.h5' % i for i in range(3)]
+        queue.close()
+    finally:
+        session.remove()
+        shutil.rmtree(dirname)
+
+
+def test_registry_queries():
+    dirname = tempfile.mkdtemp()
+    try:
+        connect_to_sqlite_db(os.path.join(dirname, 'db.sqlite'))
+        assert latest_model() is None
+        for i in range(3):
+            session.add(Model(time=datetime(2013, 1, 1+i), protocol='localfs',
+                              path='model%d.h5' % i))
+        view = TrajectoryView()
+        view.refresh()
+        assert len(view) == 0
+        for i in range(5):
+            session.add(Trajectory(time=datetime.now(), protocol='localfs',
+                                   path='%d.h5' % i))
+        session.commit()
+        # not the model with primary key 1
+        assert latest_model().path == 'model2.h5'
+
+        view.refresh()
+        assert view.paths == ['%d.h5' % i for i in range(5)]
+        session.add(Trajectory(time=datetime.now(), protocol='localfs',
+                               path='5.h5', n_frames=10, status='ok'))
+        session.add(Trajectory(time=datetime.now(), protocol='localfs',
+                               path='6.h5', status='corrupt'))
+        session.commit()
+        view.refresh()
+        assert view.since(view.ids[3]) == (view.ids[4:], ['4.h5', '5.h5'])
+        assert view.n_frames[-1] == 10
+    finally:
+        session.remove()
+        shutil.rmtree(dirname)
+
+
+def test_trajectory_view_segments():
+    dirname = tempfile.mkdtemp()
+    try:
+        connect_to_sqlite_db(os.path.join(dirname, 'db.sqlite'))
+        rows = [('a.seg0000.h5', 'a', 0), ('plain.h5', None, None),
+                ('b.seg0000.h5', 'b', 0), ('a.seg0002.h5', 'a', 2),
+                ('a.seg0001.h5', 'a', 1)]
+        view = TrajectoryView()
+        for i, (path, job_id, segment) in enumerate(rows):
+            session.add(Trajectory(time=datetime.now(), protocol='localfs',
+                                   path=path, job_id=job_id, segment=segment))
+            session.commit()
+            if i == 3:
+                view.refresh()
+                # the segments after the one that's missing are left out
+                assert view.since(0)[1] == ['a.seg0000.h5', 'plain.h5',
+                                            'b.seg0000.h5']
+        view.refresh()
+        ids, paths = view.since(0)
+        # in order of the last segment of each job
+        assert ids == [view.ids[1], view.ids[2], view.ids[4]]
+        assert paths == ['plain.h5', 'b.seg0000.h5', os.pathsep.join(
+            ['a.seg0000.h5', 'a.seg0001.h5', 'a.seg0002.h5'])]
+        # the whole trajectory of a job with a new segment, not just the
+        # segments that are new
+        assert view.since(view.ids[3]) == ([view.ids[4]], [paths[2]])
+        assert view.since(view.ids[4]) == ([], [])
+    finally:
+        session.remove()
+        shutil.rmtree(dirname)
@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from msmaccelerator.core.ingest import (save_features, load_features,
+                                        features_filename, trajectory_metadata,
+                                        ingest_trajectory)
+
+
+def test_features_cache():
+    dirname = tempfile.mkdtemp()
+    try:
+        traj_fn = os.path.join(dirname, 'traj.h5')
+        with open(traj_fn, 'w') as f:
+            f.write('not really a trajectory')
+        features_fn = features_filename(dirname, traj_fn)
+        atom_indices = np.array([0, 2, 4])
+        xyz = np.random.randn(10, 3, 3)
+        save_features(features_fn, traj_fn, xyz, atom_indices)
+
+        cached = load_features(features_fn, traj_fn, atom_indices)
+        np.testing.assert_array_almost_equal(cached, xyz - xyz.mean(axis=1)[:, np.newaxis], decimal=5)
+        # different atoms
+        assert load_features(features_fn, traj_fn, None) is None
+        assert load_features(features_fn, traj_fn, np.array([0, 2])) is None
+
+        # the trajectory has changed
+        with open(traj_fn, 'a') as f:
+            f.write('more frames')
+        assert load_features(features_fn, traj_fn, atom_indices) is None
+
+        # ...and it isn't actually a trajectory
+        assert trajectory_metadata(traj_fn)['status'] == 'corrupt'
+        assert trajectory_metadata(traj_fn + '.missing')['status'] == 'missing'
+    finally:
+        shutil.rmtree(dirname)
+
+
+def test_ingest_never_raises():
+    dirname = tempfile.mkdtemp()
+    try:
+        # a directory can't even be checksummed
+        metadata, error = ingest_trajectory(dirname)
+        assert metadata['status'] == 'corrupt'
+        assert error is not None
+
+        metadata, error = ingest_trajectory(os.path.join(dirname, 'missing.h5'),
+                                            os.path.join(dirname, 'features.npz'))
+        assert metadata['status'] == 'missing'
+        assert error is None
+    finally:
+        shutil.rmtree(dirname)
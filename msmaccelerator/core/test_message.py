@@ -0,0 +1,54 @@
+import numpy as np
+from nose.plugins.skip import SkipTest
+
+from msmaccelerator.core.message import (pack_message, get_codec, guess_codec,
+                                         array_frames, attach_arrays)
+from msmaccelerator.core import message
+
+
+def check_roundtrip(name):
+    codec = get_codec(name)
+    msg = pack_message('simulation_done', 'sender', {
+        'status': u'success',
+        'output': {'protocol': 'localfs', 'path': u'/trajs/1.h5'},
+        'traj_fns': [u'a.h5', 'b.h5'],
+    })
+
+    raw = codec.encode(msg)
+    assert guess_codec(raw) is codec
+
+    decoded = codec.decode(raw)
+    assert decoded == msg
+    # everything should come back as bytestrings
+    assert type(decoded['content']['output']['path']) == str
+    assert type(decoded['content']['traj_fns'][0]) == str
+    assert type(decoded['header'].keys()[0]) == str
+
+
+def test_json():
+    check_roundtrip('json')
+
+
+def test_msgpack():
+    if message.msgpack is None:
+        raise SkipTest('msgpack is not installed')
+    check_roundtrip('msgpack')
+
+
+def test_arrays():
+    arrays = {'xyz': np.random.randn(10, 3).astype(np.float32),
+              'assignments': np.arange(20).reshape(4, 5)[:, ::2]}
+    msg = pack_message('features', 'sender', {'status': 'success'}, arrays)
+    codec = get_codec('json')
+    decoded = codec.decode(codec.encode(msg))
+
+    # the frames go over the wire as raw bytes
+    frames = [buffer(f) for f in array_frames(arrays)]
+    decoded = attach_arrays(decoded, frames)
+
+    assert decoded['content']['status'] == 'success'
+    for name, array in arrays.items():
+        np.testing.assert_array_equal(decoded['content'][name], array)
+        assert decoded['content'][name].dtype == array.dtype
+        # no copy
+        assert not decoded['content'][name].flags.owndata
@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import mdtraj as md
+from nose.tools import assert_raises
+
+from msmaccelerator.core.trajectory_cache import (TrajectoryCache,
+    full_system_filename, atom_indices_filename, save_atom_indices,
+    load_atom_indices)
+
+
+def test_full_system_filename():
+    assert full_system_filename('a/traj.h5') == 'a/traj.full.h5'
+    assert full_system_filename('a/traj.seg0003.h5') == 'a/traj.seg0003.full.h5'
+
+
+def test_atom_indices():
+    dirname = tempfile.mkdtemp()
+    try:
+        traj_fn = os.path.join(dirname, 'traj.h5')
+        segment_fn = os.path.join(dirname, 'traj.seg0001.h5')
+        assert atom_indices_filename(traj_fn) == os.path.join(dirname, 'traj.atoms.dat')
+        assert atom_indices_filename(segment_fn) == atom_indices_filename(traj_fn)
+        assert load_atom_indices(traj_fn) is None
+
+        # saved sorted, without duplicates
+        save_atom_indices(traj_fn, [7, 3, 5, 3])
+        np.testing.assert_array_equal(load_atom_indices(segment_fn), [3, 5, 7])
+
+        cache = TrajectoryCache()
+        np.testing.assert_array_equal(
+            cache._file_atom_indices(segment_fn, [3, 7]), [0, 2])
+        # all of the atoms in the file
+        assert cache._file_atom_indices(segment_fn, [3, 5, 7]) is None
+        assert cache._file_atom_indices(segment_fn, None) is None
+        # not in the file
+        assert_raises(ValueError, cache._file_atom_indices, segment_fn, [3, 4])
+        assert_raises(ValueError, cache._file_atom_indices, segment_fn, [8])
+
+        # a file with all of the atoms
+        other_fn = os.path.join(dirname, 'other.h5')
+        np.testing.assert_array_equal(
+            cache._file_atom_indices(other_fn, [3, 4]), [3, 4])
+    finally:
+        shutil.rmtree(dirname)
+
+
+def _save_trajectory(filename, frames, n_atoms=3):
+    """Save a trajectory whose frames can be told apart: the x coordinates
+    in each frame are its index in `frames`"""
+    topology = md.Topology()
+    residue = topology.add_residue('ALA', topology.add_chain())
+    for i in range(n_atoms):
+        topology.add_atom('C%d' % i, md.element.carbon, residue)
+    xyz = np.zeros((len(frames), n_atoms, 3), dtype=np.float32)
+    xyz[:, :, 0] = np.asarray(frames)[:, np.newaxis]
+    md.Trajectory(xyz, topology, time=np.asarray(frames, dtype=float)).save_hdf5(filename)
+
+
+def test_read_segments():
+    dirname = tempfile.mkdtemp()
+    try:
+        # 12 frames in segments of 5, 4 and 3
+        filenames = []
+        for i, frames in enumerate([range(0, 5), range(5, 9), range(9, 12)]):
+            filenames.append(os.path.join(dirname, 'traj.seg%04d.h5' % i))
+            _save_trajectory(filenames[-1], frames)
+        path = os.pathsep.join(filenames)
+
+        cache = TrajectoryCache()
+        assert cache.n_frames(path) == 12
+        for start, stop, stride in [(0, None, 1), (0, None, 3), (2, None, 4),
+                                    (1, 10, 2), (6, 7, 1), (4, 6, 5)]:
+            traj = cache.read(path, start, stop, stride)
+            np.testing.assert_array_equal(traj.xyz[:, 0, 0],
+                                          np.arange(12)[start:stop:stride])
+        # nothing in range
+        assert cache.read(path, 12).n_frames == 0
+        assert cache.read_frame(path, 9).xyz[0, 0, 0] == 9
+    finally:
+        shutil.rmtree(dirname)
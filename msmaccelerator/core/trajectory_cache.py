@@ -0,0 +1,369 @@
+"""Random access to frames of trajectories on disk, through a bounded LRU
+cache of open file handles.
+
+Both the sampler (which needs a single generator frame each time a simulator
+registers) and the modeler read from the same set of trajectory files. Loading
+the whole file to get at a single frame is wasteful, so instead we keep the
+most recently used files open, and seek to the frames that we need.
+
+A trajectory that was streamed to the server in segments is named by the
+paths of its segments, separated by os.pathsep, and is read as if it were a
+single file.
+
+A trajectory can also be saved with only a subset of the atoms (see
+OpenMMSimulator.output_atom_indices), optionally with a sparser trajectory
+of the full system alongside it. The (full system) indices of the atoms in
+the file are saved next to it (see atom_indices_filename()), so that the
+atoms that a reader asks for can be found in it. See read() and
+read_full_frame().
+"""
+##############################################################################
+# Imports
+##############################################################################
+
+import os
+import re
+import errno
+import resource
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import mdtraj as md
+from mdtraj.formats import HDF5TrajectoryFile
+
+##############################################################################
+# Globals
+##############################################################################
+
+# formats that md.open() can seek in. Anything else (e.g. PDB) gets loaded
+# completely the first time it's accessed, and the Trajectory object is
+# kept in the cache instead of a file handle.
+RANDOM_ACCESS_EXTENSIONS = ['.h5', '.nc', '.dcd', '.xtc', '.trr', '.binpos']
+
+##############################################################################
+# Classes
+##############################################################################
+
+
+class TrajectoryCache(object):
+    """Bounded LRU cache of open trajectory file handles.
+
+    Parameters
+    ----------
+    max_open : int
+        The maximum number of files to keep open at once. This is also
+        capped at a fraction of the process's file descriptor limit.
+    topology : str or md.Topology, optional
+        Topology to use for the file formats that don't contain one
+        (e.g. AMBER NetCDF). If a string is passed, it's the path to a
+        PDB file, which will be loaded the first time it's needed.
+
+    Notes
+    -----
+    All of the methods are protected by a lock, so a single cache can be
+    shared between threads.
+    """
+    def __init__(self, max_open=32, topology=None):
+        self.max_open = max(1, min(max_open, _fd_budget()))
+        self._topology = topology
+        self._lock = threading.RLock()
+        # filename -> (handle or Trajectory, (mtime, size))
+        self._entries = OrderedDict()
+        # atom_indices_filename() -> the indices of the atoms in the file,
+        # or None if it has all of them
+        self._subsets = {}
+
+    @property
+    def topology(self):
+        if isinstance(self._topology, basestring):
+            self._topology = md.load(self._topology).topology
+        return self._topology
+
+    def read(self, filename, start=0, stop=None, stride=1, atom_indices=None):
+        """Read a range of frames from a trajectory file.
+
+        Parameters
+        ----------
+        filename : str
+            Path to the trajectory file, or the paths to the segments of a
+            trajectory, separated by os.pathsep
+        start : int, default=0
+            Index of the first frame to read
+        stop : int, optional
+            Read up to, but not including, this frame. If None, read to
+            the end of the file.
+        stride : int, default=1
+            Only read every stride-th frame.
+        atom_indices : array_like, optional
+            Only read these atoms (indices into the full system). If the
+            file was saved with only a subset of the atoms, these are
+            looked up in the subset, and it's an error to ask for atoms
+            that it doesn't contain. If None, all of the atoms in the file
+            are read.
+
+        Returns
+        -------
+        traj : md.Trajectory
+        """
+        with self._lock:
+            try:
+                return self._read(filename, start, stop, stride, atom_indices)
+            except MemoryError:
+                # drop everything we're holding on to, and try again
+                self.close()
+                return self._read(filename, start, stop, stride, atom_indices)
+
+    def read_frame(self, filename, frame, atom_indices=None):
+        """Read a single frame from a trajectory file.
+
+        Returns
+        -------
+        traj : md.Trajectory
+            A trajectory with one frame
+        """
+        return self.read(filename, start=frame, stop=frame+1,
+                         atom_indices=atom_indices)
+
+    def read_full_frame(self, filename, frame):
+        """Read a single frame from a trajectory file, with all of the atoms.
+
+        If a full-system trajectory was saved alongside the trajectory (see
+        full_system_filename()), because the trajectory only contains a
+        subset of the atoms, the frame of the full-system trajectory that's
+        closest in time is read instead. For a trajectory that was streamed
+        in segments, each segment has its own full-system trajectory.
+
+        Returns
+        -------
+        traj : md.Trajectory
+            A trajectory with one frame
+
+        Raises
+        ------
+        ValueError
+            If the trajectory only has a subset of the atoms, and there's no
+            full-system trajectory to read the frame from.
+        """
+        with self._lock:
+            if os.pathsep in filename:
+                # find the segment that the frame is in
+                for segment_fn in filename.split(os.pathsep):
+                    n_frames = self.n_frames(segment_fn)
+                    if frame < n_frames:
+                        return self.read_full_frame(segment_fn, frame)
+                    frame -= n_frames
+                raise IndexError('frame out of range: %s' % filename)
+
+            full_fn = full_system_filename(filename)
+            if not os.path.exists(full_fn):
+                if load_atom_indices(filename) is not None:
+                    raise ValueError('%s only has a subset of the atoms, and '
+                                     'no full-system trajectory' % filename)
+                return self.read_frame(filename, frame)
+
+            time = self.read_frame(filename, frame).time[0]
+            n_frames = self.n_frames(full_fn)
+            head = self.read(full_fn, stop=min(2, n_frames))
+            index = 0
+            if head.n_frames > 1:
+                index = int(round((time - head.time[0]) / (head.time[1] - head.time[0])))
+            return self.read_frame(full_fn, max(0, min(n_frames - 1, index)))
+
+    def n_frames(self, filename):
+        """Number of frames in a trajectory file"""
+        with self._lock:
+            if os.pathsep in filename:
+                return sum(self.n_frames(fn) for fn in filename.split(os.pathsep))
+            entry = self._get(filename)
+            if isinstance(entry, md.Trajectory):
+                return entry.n_frames
+            return len(entry)
+
+    def close(self, filename=None):
+        """Close the handle to one file, or if `filename` is None, all of
+        them."""
+        with self._lock:
+            if filename is None:
+                while len(self._entries) > 0:
+                    self._evict()
+            elif filename in self._entries:
+                entry, _ = self._entries.pop(filename)
+                _close(entry)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, filename):
+        return filename in self._entries
+
+    def _read(self, filename, start, stop, stride, atom_indices):
+        if os.pathsep in filename:
+            return self._read_segments(filename.split(os.pathsep), start,
+                                       stop, stride, atom_indices)
+        entry = self._get(filename)
+        atom_indices = self._file_atom_indices(filename, atom_indices)
+        if isinstance(entry, md.Trajectory):
+            traj = entry[start:stop:stride]
+            if atom_indices is not None:
+                traj = traj.atom_slice(atom_indices)
+            return traj
+
+        if stop is None:
+            stop = len(entry)
+        n_frames = max(0, (stop - start + stride - 1) // stride)
+        entry.seek(start)
+
+        if isinstance(entry, HDF5TrajectoryFile):
+            return entry.read_as_traj(n_frames=n_frames, stride=stride,
+                                      atom_indices=atom_indices)
+        return entry.read_as_traj(self.topology, n_frames=n_frames,
+                                  stride=stride, atom_indices=atom_indices)
+
+    def _read_segments(self, filenames, start, stop, stride, atom_indices):
+        """Read a range of frames from the segments of a trajectory, as if
+        they were a single file"""
+        lengths = [self.n_frames(fn) for fn in filenames]
+        if stop is None:
+            stop = sum(lengths)
+
+        pieces = []
+        offset = 0
+        for filename, length in zip(filenames, lengths):
+            # the first frame in this segment that's on the stride
+            first = max(start, offset)
+            first += (start - first) % stride
+            last = min(stop, offset + length)
+            if first < last:
+                pieces.append(self._read(filename, first - offset,
+                                         last - offset, stride, atom_indices))
+            offset += length
+
+        if len(pieces) == 0:
+            return self._read(filenames[0], 0, 0, stride, atom_indices)
+        return pieces[0].join(pieces[1:])
+
+    def _file_atom_indices(self, filename, atom_indices):
+        """Translate the indices of atoms in the full system to indices of
+        atoms in a file that might only have a subset of them. Returns None
+        if all of the atoms in the file are wanted."""
+        if atom_indices is None:
+            return None
+        subset_fn = atom_indices_filename(filename)
+        if subset_fn not in self._subsets:
+            self._subsets[subset_fn] = load_atom_indices(filename)
+        subset = self._subsets[subset_fn]
+        if subset is None:
+            return atom_indices
+
+        atom_indices = np.asarray(atom_indices, dtype=int)
+        positions = np.searchsorted(subset, atom_indices)
+        positions = np.minimum(positions, len(subset) - 1)
+        if not np.all(subset[positions] == atom_indices):
+            missing = atom_indices[subset[positions] != atom_indices]
+            raise ValueError('%s was saved with only a subset of the atoms, '
+                             'which doesn\'t include %d of the ones requested '
+                             '(e.g. %d)' % (filename, len(missing), missing[0]))
+        if np.array_equal(positions, np.arange(len(subset))):
+            # all of them, in order
+            return None
+        return positions
+
+    def _get(self, filename):
+        """Get the handle for a file, opening it if necessary, and mark it as
+        the most recently used"""
+        stat = _stat(filename)
+        if filename in self._entries:
+            entry, old_stat = self._entries.pop(filename)
+            if old_stat == stat:
+                self._entries[filename] = (entry, stat)
+                return entry
+            # the file has changed on disk since we opened it (e.g. it's
+            # still being written), so our handle might be stale.
+            _close(entry)
+
+        while len(self._entries) >= self.max_open:
+            self._evict()
+
+        try:
+            entry = self._open(filename)
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EMFILE, errno.ENFILE) or len(self._entries) == 0:
+                raise
+            # we're out of file descriptors. shrink the cache and retry.
+            for i in range((len(self._entries) + 1) // 2):
+                self._evict()
+            self.max_open = max(1, len(self._entries))
+            entry = self._open(filename)
+
+        self._entries[filename] = (entry, stat)
+        return entry
+
+    def _open(self, filename):
+        if os.path.splitext(filename)[1] in RANDOM_ACCESS_EXTENSIONS:
+            return md.open(filename, 'r')
+        if self._topology is None:
+            return md.load(filename)
+        return md.load(filename, top=self.topology)
+
+    def _evict(self):
+        """Close the least recently used handle"""
+        filename, (entry, _) = self._entries.popitem(last=False)
+        _close(entry)
+
+
+##############################################################################
+# Functions
+##############################################################################
+
+
+def full_system_filename(path):
+    """The full-system trajectory saved alongside a trajectory of a subset of
+    the atoms, e.g. traj.full.h5 for traj.h5, or traj.seg0003.full.h5 for
+    the segment traj.seg0003.h5"""
+    root, ext = os.path.splitext(path)
+    return root + '.full' + ext
+
+
+def atom_indices_filename(path):
+    """The file listing the atoms in a trajectory that was saved with only a
+    subset of them, e.g. traj.atoms.dat for traj.h5, and for all of its
+    segments"""
+    root = os.path.splitext(path)[0]
+    return re.sub(r'\.seg\d+$', '', root) + '.atoms.dat'
+
+
+def save_atom_indices(path, atom_indices):
+    """Save the indices of the atoms in a trajectory that's saved with only a
+    subset of them. See atom_indices_filename()."""
+    fn = atom_indices_filename(path)
+    np.savetxt(fn + '.tmp', np.unique(atom_indices), fmt='%d')
+    os.rename(fn + '.tmp', fn)
+
+
+def load_atom_indices(path):
+    """The indices of the atoms in a trajectory, sorted, or None if it has
+    all of them. See save_atom_indices()."""
+    fn = atom_indices_filename(path)
+    if not os.path.exists(fn):
+        return None
+    return np.atleast_1d(np.loadtxt(fn, dtype=int))
+
+
+def _fd_budget(fraction=0.25):
+    """Number of file descriptors that we're willing to use for the cache,
+    as a fraction of the soft limit for the process"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return 1024
+    return max(1, int(soft * fraction))
+
+
+def _stat(filename):
+    st = os.stat(filename)
+    return st.st_mtime, st.st_size
+
+
+def _close(entry):
+    if hasattr(entry, 'close'):
+        entry.close()
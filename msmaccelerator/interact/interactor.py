@@ -9,6 +9,7 @@ from IPython.utils.traitlets import Unicode, Instance, Bool
 # local
 from ..core.database import session, connect_to_sqlite_db, Trajectory, Model
 from ..core.device import Device
+from ..server.stats import format_stats
 
 ##############################################################################
 # Classes
@@ -31,11 +32,19 @@ class Interactor(Device):
     shell = Bool(False, config=True, help='''Go into interactive shell mode,
         in which you can interact with the server via an IPython
         read-eval-print loop.''')
+    stats = Bool(False, config=True, help='''Print the server's statistics:
+        message counts, handler latencies, bytes in/out, and the time spent
+        in the sampler, state builder and database.''')
+    reset_stats = Bool(False, config=True, help='''With --stats, reset the
+        server's statistics after printing them, so that the next call
+        only covers the time in between.''')
     db_path = Unicode('db.sqlite', config=True, help='''
         Path to the database (sqlite3 file)''')
 
     aliases = dict(set_beta = 'Interactor.set_beta',
                    shell = 'Interactor.shell',
+                   stats = 'Interactor.stats',
+                   reset_stats = 'Interactor.reset_stats',
                    zmq_port = 'Device.zmq_port',
                    zmq_url = 'Device.zmq_url')
     
@@ -47,9 +56,12 @@ class Interactor(Device):
             return
         elif np.isscalar(self.set_beta):
             self.send_recv('set_beta', {'value': self.set_beta})
+        elif self.stats:
+            msg = self.send_recv('get_stats', {'reset': self.reset_stats})
+            print format_stats(msg.content.to_dict())
         else:
-            raise ValueError('Either you should go into shell mode or set a new '
-                             'beta')
+            raise ValueError('Either you should go into shell mode, set a new '
+                             'beta, or ask for the stats')
         
         
         
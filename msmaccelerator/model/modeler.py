@@ -7,10 +7,9 @@ ZMQ device that builds an MSM and saves it to disk.
 
 import os
 import numpy as np
+import scipy.sparse
 import pickle
 
-# mdtraj
-import mdtraj.trajectory
 import msmbuilder.io
 import msmbuilder.metrics
 import msmbuilder.Trajectory
@@ -19,10 +18,12 @@ import msmbuilder.clustering
 
 # local
 from ..core.markovstatemodel import MarkovStateModel
+from ..core.trajectory_cache import TrajectoryCache
+from ..core.ingest import load_features, features_filename
 from ..core.device import Device
 
-from ..core.traitlets import FilePath
-from IPython.utils.traitlets import Unicode, Int, Float, Enum, Bool
+from ..core.traitlets import FilePath, Undefined
+from IPython.utils.traitlets import Unicode, Int, Float, Enum, Bool, Instance
 
 #############################################################################
 # Handlers
@@ -69,6 +70,20 @@ class Modeler(Device):
          a custom distance metric for clusering instead of RMSD?''')
     custom_metric_path = Unicode('metric.pickl', config=True, help='''File
          containing a pickled metric for use in clustering.''')
+    trajectories = Instance('msmaccelerator.core.trajectory_cache.TrajectoryCache',
+        help='''Cache of open trajectory files that frames are read from''')
+    features_dir = Unicode('', config=True, help='''Directory of the
+        server's cache of features (see AdaptiveServer.features_outdir),
+        where the modeler reads the coordinates of the trajectories from
+        instead of the trajectory files. If empty, the directory that the
+        server sends is used, if it has one. Set this if the cache is
+        mounted at a different path here than on the server.''')
+
+    def _trajectories_default(self):
+        topology = None
+        if self.topology_pdb is not Undefined:
+            topology = self.topology_pdb
+        return TrajectoryCache(topology=topology)
 
     aliases = dict(stride='Modeler.stride',
                    lag_time='Modeler.lag_time',
@@ -77,6 +92,7 @@ class Modeler(Device):
                    topology_pdb='Modeler.topology_pdb',
                    symmetrize='Modeler.symmetrize',
                    trim='Modeler.ergodic_trimming',
+                   features_dir='Modeler.features_dir',
                    zmq_url='Device.zmq_url',
                    zmq_port='Device.zmq_port')
 
@@ -84,17 +100,63 @@ class Modeler(Device):
         """This method is called when the device receives its startup message
         from the server
         """
-        assert msg.header.msg_type in ['construct_model'], 'only allowed methods'
+        assert msg.header.msg_type in ['construct_model', 'nothing_to_do'], 'only allowed methods'
         return getattr(self, msg.header.msg_type)(msg.header, msg.content)
 
+    def nothing_to_do(self, header, content):
+        """Called by the server when it doesn't want a new model built yet,
+        because there isn't enough new data, or another modeler is already
+        building one."""
+        self.log.info('The server has no model for us to build: %s', content.reason)
+
     def construct_model(self, header, content):
         """All the model building code. This code is what's called by the
-        server after registration."""
+        server after registration.
+
+        If the message contains a `base_model`, then `traj_fns` are only the
+        trajectories that have been added since that model was built, and we
+        extend it instead of starting from scratch.
+        """
         # the message needs to not contain unicode
         assert content.output.protocol == 'localfs', "I'm currently only equipped for localfs output"
 
+        if 'features' in content and not self.use_custom_metric:
+            # the cached coordinates are centered, which is fine for RMSD,
+            # but not necessarily for a custom metric.
+            assert content.features.protocol == 'localfs'
+            if self.features_dir == '':
+                self.features_dir = content.features.path
+
+        if 'base_model' in content:
+            assert content.base_model.protocol == 'localfs', "I'm currently only equipped for localfs input"
+            msm = self.extend_model(content.base_model.path, content.traj_fns)
+        else:
+            msm = self.build_model(content.traj_fns)
+
+        # save the results to disk
+        msm.save(content.output.path)
+
+        # tell the server that we're done
+        reply = {
+            'status': 'success',
+            'output': {
+                'protocol': 'localfs',
+                'path': content.output.path
+            },
+        }
+        if 'last_trajectory_id' in content:
+            reply['last_trajectory_id'] = content.last_trajectory_id
+        self.send_recv(msg_type='modeler_done', content=reply)
+
+    def build_model(self, traj_fns):
+        """Build an MSM from scratch
+
+        Returns
+        -------
+        msm : MarkovStateModel
+        """
         # load up all of the trajectories
-        trajs = self.load_trajectories(content.traj_fns)
+        trajs, traj_fns = self.load_trajectories(traj_fns)
 
         # run clustering
         assignments, generator_indices = self.cluster(trajs)
@@ -102,59 +164,183 @@ class Modeler(Device):
         # build the MSM
         counts, rev_counts, t_matrix, populations, mapping = self.build_msm(assignments)
 
-        # save the results to disk
-        msm = MarkovStateModel(counts=counts, reversible_counts=rev_counts,
+        return MarkovStateModel(counts=counts, reversible_counts=rev_counts,
             transition_matrix=t_matrix, populations=populations, mapping=mapping,
-            generator_indices=generator_indices, traj_filenames=content.traj_fns,
+            generator_indices=generator_indices, traj_filenames=traj_fns,
             assignments_stride=self.stride, lag_time=self.lag_time,
             assignments=assignments)
-        msm.save(content.output.path)
 
-        # tell the server that we're done
-        self.send_recv(msg_type='modeler_done', content={
-            'status': 'success',
-            'output': {
-                'protocol': 'localfs',
-                'path': content.output.path
-            },
-        })
+    def extend_model(self, base_fn, traj_fns):
+        """Extend an existing MSM with new trajectories.
 
-    def load_trajectories(self, traj_fns):
-        """Load up the trajectories, taking into account both the stride and
-        the atom indices"""
+        The frames in the new trajectories are assigned to the existing
+        states, and new states are created (by continuing the k-centers
+        clustering) for the frames that aren't within the distance cutoff of
+        any of them. The existing states, and the assignments of the frames
+        that were used to build the base model, are left as they are. The
+        new counts are added to the base model's.
 
-        trajs = []
+        A trajectory that was streamed to the server in segments can be in
+        the base model with only some of its segments (see
+        TrajectoryView.since). If one of `traj_fns` continues it, the
+        new trajectory replaces it, and only its new transitions are counted.
+
+        Parameters
+        ----------
+        base_fn : str
+            Path to the model to extend
+        traj_fns : list of str
+            Paths to the new trajectories
+
+        Returns
+        -------
+        msm : MarkovStateModel
+        """
+        base = MarkovStateModel.load(base_fn)
+        try:
+            old_fns = [str(fn) for fn in base.traj_filenames]
+            if base.assignments_stride != self.stride or base.lag_time != self.lag_time:
+                self.log.warning('The base model was built with a different '
+                                 'stride or lag time. Rebuilding from scratch.')
+                return self.build_model(merge_trajectories(old_fns, traj_fns)[0])
+            self.log.info('Extending %s (%d states, %d trajectories)', base_fn,
+                          len(base.generator_indices), len(old_fns))
+
+            trajs, traj_fns = self.load_trajectories(traj_fns, allow_empty=True)
+            metric = self.get_metric()
+            generators = self.load_generators(old_fns, base.generator_indices)
+            new_assignments, new_generator_indices = self.cluster_incremental(
+                metric, generators, trajs)
+
+            continued = continued_trajectories(old_fns, traj_fns)
+            all_fns, index = merge_trajectories(old_fns, traj_fns)
+            new_generator_indices[:, 0] = index[new_generator_indices[:, 0]]
+
+            n_states = len(base.generator_indices) + len(new_generator_indices)
+            old_counts = base.counts.tocoo()
+            counts = scipy.sparse.coo_matrix((old_counts.data,
+                (old_counts.row, old_counts.col)), shape=(n_states, n_states)).tocsr()
+            def count(assignments):
+                return msmbuilder.MSMLib.get_count_matrix_from_assignments(
+                    assignments, n_states=n_states, lag_time=self.lag_time)
+
+            appended = [i for i, j in enumerate(continued) if j < 0]
+            assignments = concatenate_assignments(base.assignments,
+                                                  new_assignments[appended])
+            if len(appended) > 0:
+                counts = counts + count(new_assignments[appended])
+            for i, j in enumerate(continued):
+                if j < 0:
+                    continue
+                # the frames that the base model already has keep their
+                # assignments, so only the transitions after them are new
+                row = continue_assignments(base.assignments[j], new_assignments[i])
+                counts = counts + count(row[np.newaxis]) - count(
+                    base.assignments[j][np.newaxis])
+                assignments = concatenate_assignments(assignments,
+                    np.zeros((0, len(row)), dtype=int))
+                assignments[j] = -1
+                assignments[j, :len(row)] = row
+            generator_indices = np.concatenate([base.generator_indices,
+                                                new_generator_indices])
+        finally:
+            base.close()
+
+        counts, rev_counts, t_matrix, populations, mapping = self.build_msm(
+            assignments, counts=counts)
+        self.log.info('Extended model has %d states', n_states)
+
+        return MarkovStateModel(counts=counts, reversible_counts=rev_counts,
+            transition_matrix=t_matrix, populations=populations, mapping=mapping,
+            generator_indices=generator_indices, traj_filenames=all_fns,
+            assignments_stride=self.stride, lag_time=self.lag_time,
+            assignments=assignments)
+
+    def load_atom_indices(self):
         if os.path.exists(self.rmsd_atom_indices):
             self.log.info('Loading atom indices from %s', self.rmsd_atom_indices)
-            atom_indices = np.loadtxt(self.rmsd_atom_indices, dtype=np.int)
-        else:
-            self.log.info('Skipping loading atom_indices. Using all.')
-            atom_indices = None
+            return np.loadtxt(self.rmsd_atom_indices, dtype=np.int)
+        self.log.info('Skipping loading atom_indices. Using all.')
+        return None
+
+    def load_generators(self, traj_fns, generator_indices):
+        """Load the cluster centers of an existing model from disk
+
+        Returns
+        -------
+        generators : ShimTrajectory
+        """
+        atom_indices = self.load_atom_indices()
+        xyz = [self.trajectories.read_frame(traj_fns[traj], frame,
+                                            atom_indices=atom_indices).xyz
+               for traj, frame in generator_indices]
+        return ShimTrajectory(np.concatenate(xyz))
+
+    def load_trajectories(self, traj_fns, allow_empty=False):
+        """Load up the trajectories, taking into account both the stride and
+        the atom indices. If the server has saved the features of a
+        trajectory, they're loaded instead of the trajectory file.
+
+        Returns
+        -------
+        trajs : list of ShimTrajectory
+            The trajectories
+        traj_fns : list of str
+            The filenames of the trajectories that were actually loaded.
+            Missing files are skipped.
+        """
+
+        trajs = []
+        loaded_fns = []
+        atom_indices = self.load_atom_indices()
 
         for traj_fn in traj_fns:
-            # use the mdtraj dcd reader, but then monkey-patch
+            # read with mdtraj (through the cache), but then monkey-patch
             # the coordinate array into shim for the msmbuilder clustering
             # code that wants the trajectory to act like a dict with the XYZList
             # key.
             self.log.info('Loading traj %s', traj_fn)
-            if not os.path.exists(traj_fn):
+            # a trajectory that was streamed to the server in segments is
+            # the paths of the segments, separated by os.pathsep
+            segment_fns = traj_fn.split(os.pathsep)
+            if not all(os.path.exists(fn) for fn in segment_fns):
                 self.log.error('Traj file reported by server does not exist: %s' % traj_fn)
                 continue
 
-            t = mdtraj.trajectory.load(traj_fn, atom_indices=atom_indices,
-                                       top=self.topology_pdb)
-            t2 = ShimTrajectory(t.xyz[::self.stride, :])
+            xyz = None
+            if self.features_dir != '' and not self.use_custom_metric:
+                xyz = [load_features(features_filename(self.features_dir, fn),
+                                     fn, atom_indices) for fn in segment_fns]
+                # only if all of the segments are in the cache
+                xyz = None if any(x is None for x in xyz) else np.concatenate(xyz)
+            if xyz is not None:
+                t2 = ShimTrajectory(xyz[::self.stride])
+            else:
+                t = self.trajectories.read(traj_fn, stride=self.stride,
+                                           atom_indices=atom_indices)
+                t2 = ShimTrajectory(t.xyz)
 
             trajs.append(t2)
+            loaded_fns.append(traj_fn)
 
         if len(trajs) == 0:
+            if allow_empty:
+                return trajs, loaded_fns
             raise ValueError('No trajectories found!')
 
         self.log.info('loaded %s trajectories', len(trajs))
         self.log.info('loaded %s total frames...', sum(len(t) for t in trajs))
         self.log.info('loaded %s atoms', t2['XYZList'].shape[1])
 
-        return trajs
+        return trajs, loaded_fns
+
+    def get_metric(self):
+        if self.use_custom_metric:
+            metric_path = self.custom_metric_path
+            self.log.info("Loading custom metric: %s" % metric_path)
+            pickle_file = open(metric_path)
+            return pickle.load(pickle_file)
+        return msmbuilder.metrics.RMSD()
 
     def cluster(self, trajectories):
         """Cluster the trajectories into microstates.
@@ -174,13 +360,7 @@ class Modeler(Device):
             is in trajectory `k`, in its `l`th frame. Because of the striding,
             `l` will always be a multiple of `self.stride`.
         """
-        if self.use_custom_metric:
-            metric_path = self.custom_metric_path
-            self.log.info("Loading custom metric: %s" % metric_path)
-            pickle_file = open(metric_path)
-            metric = pickle.load(pickle_file)
-        else:
-            metric = msmbuilder.metrics.RMSD()
+        metric = self.get_metric()
 
         clusterer = msmbuilder.clustering.KCenters(metric, trajectories,
                                         distance_cutoff=self.kcenters_distance_cutoff)
@@ -206,10 +386,73 @@ class Modeler(Device):
 
         return assignments, generator_indices
 
-    def build_msm(self, assignments):
-        """Build the MSM from the microstate assigned trajectories"""
-        counts = msmbuilder.MSMLib.get_count_matrix_from_assignments(assignments,
-            lag_time=self.lag_time)
+    def cluster_incremental(self, metric, generators, trajectories):
+        """Continue k-centers clustering from an existing set of cluster
+        centers.
+
+        Each frame is assigned to the closest of the existing `generators`.
+        Then, as in k-centers, the frame farthest from its center becomes a
+        new center, until every frame is within the distance cutoff.
+
+        Returns
+        -------
+        assignments : np.ndarray, dtype=int, shape=[n_trajs, max_n_frames]
+            The assignments of the frames in `trajectories`, padded with -1.
+            The new states are numbered after the existing ones.
+        generator_indices : np.ndarray, dtype=int, shape=[n_new_clusters, 2]
+            The traj/frame indices of the new cluster centers, with respect
+            to `trajectories`. See cluster().
+        """
+        lengths = [len(t) for t in trajectories]
+        if sum(lengths) == 0:
+            return (-1 * np.ones((len(lengths), 0), dtype=int),
+                    np.zeros((0, 2), dtype=int))
+
+        ptraj = metric.prepare_trajectory(ShimTrajectory(
+            np.concatenate([t['XYZList'] for t in trajectories])))
+        pgens = metric.prepare_trajectory(generators)
+        n_generators = len(generators)
+
+        distances = np.empty(sum(lengths))
+        distances.fill(np.inf)
+        assignments = np.zeros(sum(lengths), dtype=int)
+        for i in range(n_generators):
+            d = metric.one_to_all(pgens, ptraj, i)
+            closer = d < distances
+            distances[closer] = d[closer]
+            assignments[closer] = i
+
+        new_centers = []
+        while distances.max() > self.kcenters_distance_cutoff:
+            center = np.argmax(distances)
+            d = metric.one_to_all(ptraj, ptraj, center)
+            closer = d < distances
+            distances[closer] = d[closer]
+            assignments[closer] = n_generators + len(new_centers)
+            new_centers.append(center)
+        self.log.info('Assigned %d new frames, creating %d new states',
+                      len(assignments), len(new_centers))
+
+        padded = -1 * np.ones((len(lengths), max(lengths)), dtype=int)
+        start = 0
+        for i, length in enumerate(lengths):
+            padded[i, :length] = assignments[start:start+length]
+            start += length
+
+        generator_indices = np.zeros((0, 2), dtype=int)
+        if len(new_centers) > 0:
+            generator_indices = reindex_list(np.array(new_centers), lengths)
+            generator_indices[:, 1] *= self.stride
+
+        return padded, generator_indices
+
+    def build_msm(self, assignments, counts=None):
+        """Build the MSM from the microstate assigned trajectories. If
+        `counts` is given, it's used instead of counting the transitions
+        in `assignments`."""
+        if counts is None:
+            counts = msmbuilder.MSMLib.get_count_matrix_from_assignments(
+                assignments, lag_time=self.lag_time)
 
         result = msmbuilder.MSMLib.build_msm(counts, symmetrize=self.symmetrize,
                                              ergodic_trimming=self.ergodic_trimming)
@@ -251,6 +494,95 @@ def reindex_list(indices, sublist_lengths):
     return output
 
 
+def continued_trajectories(old_fns, new_fns):
+    """For each of `new_fns`, the index of the trajectory in `old_fns` that
+    it continues, or -1.
+
+    A trajectory that was streamed to the server in segments is the paths of
+    its segments, separated by os.pathsep. It continues another trajectory
+    if its first segments are all of the other's.
+
+    Example
+    -------
+    >>> continued_trajectories(['a', 'b0:b1'], ['c', 'b0:b1:b2', 'b0'])
+    [-1, 1, -1]
+    """
+    first = dict((fn.split(os.pathsep)[0], j) for j, fn in enumerate(old_fns))
+    continued = []
+    for fn in new_fns:
+        segments = fn.split(os.pathsep)
+        j = first.get(segments[0], -1)
+        if j >= 0:
+            old_segments = old_fns[j].split(os.pathsep)
+            if (len(old_segments) >= len(segments) or
+                    segments[:len(old_segments)] != old_segments):
+                j = -1
+        continued.append(j)
+    return continued
+
+
+def merge_trajectories(old_fns, new_fns):
+    """Add new trajectories to a list of old ones. The new trajectories that
+    continue one of the old ones (see continued_trajectories) replace it,
+    and the rest are appended.
+
+    Returns
+    -------
+    traj_fns : list of str
+        The merged list
+    index : np.ndarray, dtype=int, shape=[len(new_fns)]
+        The index in `traj_fns` of each of `new_fns`
+
+    Example
+    -------
+    >>> merge_trajectories(['a', 'b0:b1'], ['c', 'b0:b1:b2'])
+    (['a', 'b0:b1:b2', 'c'], array([2, 1]))
+    """
+    traj_fns = list(old_fns)
+    index = np.zeros(len(new_fns), dtype=int)
+    for i, (fn, j) in enumerate(zip(new_fns, continued_trajectories(old_fns, new_fns))):
+        if j < 0:
+            j = len(traj_fns)
+            traj_fns.append(fn)
+        traj_fns[j] = fn
+        index[i] = j
+    return traj_fns, index
+
+
+def continue_assignments(old, new):
+    """The assignments of a trajectory that continues one in the base model.
+    The frames that are in the base model keep their assignments (`old`),
+    and the rest are assigned as in `new`. Both are padded with -1.
+
+    Example
+    -------
+    >>> continue_assignments(np.array([0, 1, -1]), np.array([2, 2, 3, 4]))
+    array([0, 1, 3, 4])
+    """
+    n_old = np.sum(old != -1)
+    output = -1 * np.ones(max(n_old, len(new)), dtype=int)
+    output[:len(new)] = new
+    output[:n_old] = old[:n_old]
+    return output
+
+
+def concatenate_assignments(a, b):
+    """Stack two 2d arrays of assignments, padded with -1, on top of each
+    other.
+
+    Example
+    -------
+    >>> concatenate_assignments(np.array([[0, 1, 2]]), np.array([[3, 4]]))
+    array([[ 0,  1,  2],
+           [ 3,  4, -1]])
+    """
+    n_frames = max(a.shape[1], b.shape[1])
+    output = -1 * np.ones((a.shape[0] + b.shape[0], n_frames), dtype=int)
+    output[:a.shape[0], :a.shape[1]] = a
+    output[a.shape[0]:, :b.shape[1]] = b
+    return output
+
+
 class ShimTrajectory(dict):
     """This is a dict that can be used to interface some xyz coordinates
     with MSMBuilder's clustering algorithms.
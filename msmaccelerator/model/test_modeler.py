@@ -0,0 +1,41 @@
+import os
+
+import numpy as np
+
+from msmaccelerator.model.modeler import (continued_trajectories,
+    merge_trajectories, continue_assignments, concatenate_assignments)
+
+
+def _path(*segments):
+    return os.pathsep.join(segments)
+
+
+def test_continued_trajectories():
+    old_fns = ['a.h5', _path('b.seg0000.h5', 'b.seg0001.h5')]
+    new_fns = ['c.h5', _path('b.seg0000.h5', 'b.seg0001.h5', 'b.seg0002.h5'),
+               # not a continuation: the same trajectory, a part of it, or
+               # different segments
+               old_fns[1], 'b.seg0000.h5',
+               _path('b.seg0000.h5', 'b.seg0002.h5', 'b.seg0003.h5')]
+    assert continued_trajectories(old_fns, new_fns) == [-1, 1, -1, -1, -1]
+
+    traj_fns, index = merge_trajectories(old_fns, new_fns[:2])
+    assert traj_fns == ['a.h5', new_fns[1], 'c.h5']
+    np.testing.assert_array_equal(index, [2, 1])
+    traj_fns, index = merge_trajectories(old_fns, [])
+    assert traj_fns == old_fns and len(index) == 0
+
+
+def test_continue_assignments():
+    # the first two frames were in the base model
+    np.testing.assert_array_equal(continue_assignments(
+        np.array([0, 1, -1]), np.array([2, 2, 3, 4, -1])), [0, 1, 3, 4, -1])
+    # no new frames
+    np.testing.assert_array_equal(continue_assignments(
+        np.array([0, 1, -1]), np.array([5, -1])), [0, 1])
+
+
+def test_concatenate_assignments():
+    np.testing.assert_array_equal(
+        concatenate_assignments(np.array([[0, 1, 2]]), np.array([[3, 4]])),
+        [[0, 1, 2], [3, 4, -1]])
@@ -4,18 +4,30 @@
 # Imports
 ##############################################################################
 import os
+import uuid
+import threading
+import functools
+import multiprocessing
 from datetime import datetime
+
+import numpy as np
 from zmq.eventloop import ioloop
 ioloop.install()  # this needs to come at the beginning
 
 # local
-from .sampling import CountsSampler
+from .sampling import CountsSampler, SpectralSampler
 from .statebuilder import OpenMMStateBuilder, AmberStateBuilder
-from .baseserver import BaseServer
-from ..core.database import session, Model, Trajectory
+from .baseserver import BaseServer, blocking
+from .scheduling import ModelScheduler
+from .leases import LeaseTable
+from ..core.database import (Model, Trajectory, TrajectoryView,
+                             with_db_lock, latest_model, active_leases)
+from ..core.ingest import (ingest_trajectory, features_filename,
+                           trajectory_metadata, STATUS_OK)
+from ..core.trajectory_cache import TrajectoryCache
 
 # ipython
-from IPython.utils.traitlets import Unicode, Instance, Enum
+from IPython.utils.traitlets import Unicode, Instance, Enum, Bool, Int, Float
 ##############################################################################
 # Classes
 ##############################################################################
@@ -41,6 +53,16 @@ class AdaptiveServer(BaseServer):
         XML file containing the OpenMM system to propagate. This is required
         by the server, iff md_engine=='OpenMM', to properly serialize the
         starting conformations.''')
+    state_energies = Bool(False, config=True, help='''If True, build the
+        serialized OpenMM states by evaluating them in a Reference platform
+        context, so that they contain the forces and energy. This is slow for
+        large systems, and isn't needed by the simulators, so by default the
+        states are written directly from a template.''')
+    amber_restart_format = Enum(['inpcrd', 'ncrst'], config=True,
+        default_value='inpcrd', help='''Format of the starting structures
+        emitted to the simulators, iff md_engine=='AMBER'. 'inpcrd' is
+        the ASCII format, 'ncrst' is the (binary) AMBER NetCDF restart
+        format, which is smaller and faster to read.''')
     traj_outdir = Unicode('trajs/', config=True, help='''Directory on the local
         filesystem where output trajectories will be saved''')
     models_outdir = Unicode('models/', config=True, help='''Directory on
@@ -53,20 +75,96 @@ class AdaptiveServer(BaseServer):
         Simulator. Honestly, I'm not sure exactly why we need it. TODO:
         ask Peter about this.''')
 
+    sampling_strategy = Enum(['counts', 'spectral'], config=True,
+        default_value='counts', help='''Adaptive sampling strategy. If
+        'counts', the CountsSampler chooses states based on their number of
+        counts. If 'spectral', the SpectralSampler chooses the states that
+        contribute the most to the uncertainty in the slowest implied
+        timescales.''')
+
+    delta_models = Bool(False, config=True, help='''If True, the modelers are
+        sent the most recent model, and only the trajectories that have
+        been added since it was built. The modeler extends that model
+        instead of building a new one from scratch, so the time to build a
+        model (and the size of the construct_model message) is proportional
+        to the amount of new data. Note that this means the existing states
+        are never re-clustered.''')
+
+    model_frames_threshold = Int(0, config=True, help='''Minimum number of
+        new frames (collected since the trajectories in the current model)
+        needed before a new model is built. Modelers that connect before
+        then are told that there's nothing to do.''')
+    model_build_timeout = Float(3600, config=True, help='''Time, in seconds,
+        after which a modeler that hasn't finished building its model is
+        assumed to have died. Only one model is built at a time, so until
+        then, the other modelers are told that there's nothing to do.''')
+    lease_timeout = Float(600, config=True, help='''Time, in seconds, that a
+        simulator has to send a heartbeat (or finish) after it's handed a
+        starting state, or after its last heartbeat. After that, it's
+        assumed to have died, and its starting state is handed out again.''')
+    lease_check_interval = Float(30, config=True, help='''Interval, in
+        seconds, between checks for expired leases.''')
+    max_walkers = Int(64, config=True, help='''Maximum number of starting
+        states sent to a simulator with multiple walkers at once.''')
+    ingest_processes = Int(0, config=True, help='''Number of worker processes
+        used to ingest new trajectories (inspect the files, and save their
+        features). If zero, the trajectories are inspected in the server's
+        worker threads, and their features aren't saved.''')
+    features_outdir = Unicode('features/', config=True, help='''Directory on
+        the local filesystem where the features of the trajectories (the
+        centered coordinates of the atoms in features_atom_indices) are
+        cached, iff ingest_processes > 0. The modeler reads the features
+        from here instead of from the trajectory files.''')
+    features_atom_indices = Unicode('AtomIndices.dat', config=True, help='''File
+        containing the indices of the atoms to save in the cache of features.
+        This should be the same as the modeler's rmsd_atom_indices, or the
+        modeler won't use the cache. If the file doesn't exist, all of the
+        atoms are saved.''')
+
     sampler = Instance('msmaccelerator.server.sampling.CentroidSampler')
     # this class attributes lets us configure the sampler on the command
     # line from this app. very convenient.
-    classes = [CountsSampler]
+    classes = [CountsSampler, SpectralSampler]
 
     aliases = dict(zmq_port='BaseServer.zmq_port',
                    system_xml='AdaptiveServer.system_xml',
                    seed_structures='BaseSampler.seed_structures',
                    beta='CountsSampler.beta',
-                   md_engine='AdaptiveServer.md_engine')
+                   sampling_strategy='AdaptiveServer.sampling_strategy',
+                   delta_models='AdaptiveServer.delta_models',
+                   model_frames_threshold='AdaptiveServer.model_frames_threshold',
+                   lease_timeout='AdaptiveServer.lease_timeout',
+                   ingest_processes='AdaptiveServer.ingest_processes',
+                   amber_restart_format='AdaptiveServer.amber_restart_format',
+                   md_engine='AdaptiveServer.md_engine',
+                   stats_file='BaseServer.stats_file',
+                   status_port='BaseServer.status_port')
 
     def start(self):
+        # the ingest processes need to be forked before we start any
+        # threads, or open any sockets
+        self._ingest_pool = None
+        if self.ingest_processes > 0:
+            self._ingest_pool = multiprocessing.Pool(self.ingest_processes)
+
         # run the startup in the base class
         super(AdaptiveServer, self).start()
+        # in-memory copy of the trajectory table, kept up to date as the
+        # write-behind queue commits new rows
+        self.trajectory_view = TrajectoryView()
+        self.trajectory_view.refresh()
+        # used to inspect the new trajectories. the topology is needed
+        # for AMBER NetCDF files.
+        self.ingest_trajectories = TrajectoryCache(max_open=4,
+                                                   topology=self.topology_pdb)
+        # the simulations that are out, backed by the database. the ones
+        # that were out when we were last shut down get a fresh deadline.
+        self.leases = LeaseTable(self.lease_timeout, save=self.db_writer.add)
+        self.leases.restore(with_db_lock(active_leases)())
+        if len(self.leases) > 0:
+            self.log.info('Restored %d active leases', len(self.leases))
+        ioloop.PeriodicCallback(self._expire_leases,
+            1000*self.lease_check_interval, io_loop=self._ioloop).start()
         # start our adaptive sampler
         self.initialize_sampler()
 
@@ -74,10 +172,26 @@ class AdaptiveServer(BaseServer):
         for path in [self.traj_outdir, self.models_outdir, self.starting_states_outdir]:
             if not os.path.exists(path):
                 os.makedirs(path)
+        if self._ingest_pool is not None:
+            if not os.path.exists(self.features_outdir):
+                os.makedirs(self.features_outdir)
+            self._features_atom_indices = None
+            if os.path.exists(self.features_atom_indices):
+                self._features_atom_indices = np.loadtxt(
+                    self.features_atom_indices, dtype=int)
 
         # start the ioloop so that we can respond to ZMQ stuff
         self.log.info('IOLoop starting')
-        ioloop.IOLoop.instance().start()
+        try:
+            ioloop.IOLoop.instance().start()
+        finally:
+            if self._ingest_pool is not None:
+                # let the ingestion of the trajectories we've got finish,
+                # so that they get saved to the database
+                self._ingest_pool.close()
+                self._ingest_pool.join()
+            # commit whatever is still waiting in the write-behind queue
+            self.db_writer.close()
 
     def initialize_sampler(self):
         """Initialize the adaptive sampling machinery.
@@ -88,57 +202,129 @@ class AdaptiveServer(BaseServer):
             to the sampler if one is found.
 
         """
-        self.sampler = CountsSampler(config=self.config)
+        if self.sampling_strategy == 'counts':
+            self.sampler = CountsSampler(config=self.config)
+        elif self.sampling_strategy == 'spectral':
+            self.sampler = SpectralSampler(config=self.config)
+        else:
+            raise ValueError('sampling_strategy must be one of "counts" or "spectral": %s' % self.sampling_strategy)
         self.sampler.log = self.log
+        # the sampler is shared between the handlers running in the worker
+        # threads, and swapping in a new model isn't atomic.
+        self.sampler_lock = threading.RLock()
         if self.md_engine == 'OpenMM':
-            self.sampler.statebuilder = OpenMMStateBuilder(self.system_xml)
+            self.sampler.statebuilder = OpenMMStateBuilder(self.system_xml,
+                use_context=self.state_energies)
         elif self.md_engine == 'AMBER':
-            self.sampler.statebuilder = AmberStateBuilder()
+            self.sampler.statebuilder = AmberStateBuilder(self.amber_restart_format)
         else:
             raise ValueError('md_engine must be one of "OpenMM" or "AMBER": %s' % self.md_engine)
 
         self.log.info('Sampler loaded')
 
-        last_model = session.query(Model).order_by(Model.time.desc()).get(1)
+        last_model = with_db_lock(latest_model)()
+        model_last_id = 0
         if last_model is not None:
             self.sampler.model_fn = last_model.path
             self.log.info(('Loading most recent model on disk, "%s". According '
                 'to the database'), last_model)
             self.log.info('Ignoring seed structures, since we found a model.')
+            if last_model.last_trajectory_id is not None:
+                model_last_id = last_model.last_trajectory_id
 
         else:
             self.log.info('Using seed structures. No existing model found on disk.')
 
+        self.scheduler = ModelScheduler(self.model_frames_threshold,
+            self.model_build_timeout, model_last_id)
+
 
 
     ########################################################################
     # BEGIN HANDLERS FOR INCOMMING MESSAGES
     ########################################################################
     
+    @blocking
     def register_AmberSimulator(self, header, content):
         """Called at the when an OpenMMSimulator device boots up. We give it
         starting conditions
         """
-        return self._register_Simulator(header.sender_id, '.inpcrd', '.nc')
+        return self._register_Simulator(header.sender_id, content, '.nc')
 
+    @blocking
     def register_OpenMMSimulator(self, header, content):
         """Called at the when an OpenMMSimulator device boots up. We give it
         starting conditions
         """
-        return self._register_Simulator(header.sender_id, '.xml', '.h5')
-
-    def _register_Simulator(self, sender_id, state_format, traj_format):
-        assert state_format in ['.xml', '.inpcrd'], 'invalid state format'
-        starting_state_fn = os.path.join(self.starting_states_outdir,
-                                         '%s.%s' % (sender_id, state_format))
-        with open(starting_state_fn, 'w') as f:
-            state = self.sampler.get_state()
-            f.write(state)
+        return self._register_Simulator(header.sender_id, content, '.h5')
 
-        self.send_message(sender_id, 'simulate', content={
+    def _register_Simulator(self, sender_id, content, traj_format):
+        """Send a simulator its job. A simulator with more than one walker
+        asks for n_walkers of them, and gets a simulate_batch message with
+        a list of jobs, each of which looks like the content of a simulate
+        message.
+        """
+        if 'n_walkers' not in content:
+            msg_type = 'simulate'
+            reply = self._new_job(sender_id, traj_format)
+        else:
+            n_walkers = min(int(content.n_walkers), self.max_walkers)
+            msg_type = 'simulate_batch'
+            reply = {'jobs': [self._new_job(sender_id, traj_format)
+                              for i in range(n_walkers)]}
+        if self.status_port != 0:
+            # where to publish the status reports
+            reply['status_port'] = self.status_port
+        self.send_message(sender_id, msg_type, content=reply)
+
+    def _new_job(self, sender_id, traj_format):
+        """Lease a starting state to a simulator.
+
+        Returns
+        -------
+        job : dict
+            The job_id, the trajectory_id, and the paths to the starting
+            state, the topology, and the output trajectory. If the job is
+            being resumed, it also contains its last checkpoint (resume).
+        """
+        # a simulator can ask for more than one job (in its worker loop
+        # mode, or with multiple walkers), so the files are named after
+        # the job, not the simulator
+        job_id = str(uuid.uuid4())
+        trajectory_id = job_id
+        resume = None
+
+        # the starting states of simulations whose leases have expired
+        # get handed out again before we sample any new ones
+        reissue = self.leases.next_reissue()
+        if reissue is not None:
+            starting_state_fn, old_job_id, resume = reissue
+            if resume is not None:
+                # resume the job from its checkpoint. it gets a lease and
+                # output files of its own (in case the old simulator is
+                # still around), but continues the same trajectory
+                trajectory_id = resume['trajectory_id']
+                self.log.info('Resuming job %s as %s, from step %d',
+                              old_job_id, job_id, resume['step'])
+                self.stats.count('leases_resumed')
+            else:
+                self.log.info('Reissuing starting state from an expired lease: %s',
+                              starting_state_fn)
+            self.stats.count('leases_reissued')
+        else:
+            starting_state_fn = self._new_starting_state(job_id)
+        output_fn = os.path.join(os.path.abspath(self.traj_outdir),
+                                 job_id + traj_format)
+        self.leases.issue(sender_id, starting_state_fn, job_id, resume,
+                          output_fn, trajectory_id)
+        self.stats.count('leases_issued')
+
+        job = {
+            'job_id': job_id,
+            'trajectory_id': trajectory_id,
             'starting_state': {
                 'protocol': 'localfs',
-                'path': os.path.abspath(starting_state_fn)
+                'path': starting_state_fn
             },
             'topology_pdb': {
                 'protocol': 'localfs',
@@ -146,62 +332,222 @@ class AdaptiveServer(BaseServer):
             },
             'output': {
                 'protocol': 'localfs',
-                'path': os.path.join(os.path.abspath(self.traj_outdir),
-                                     sender_id + traj_format),
+                'path': output_fn,
             },
-        })
+        }
+        if resume is not None:
+            job['resume'] = resume
+        return job
 
+    @blocking
     def register_Modeler(self, header, content):
         """Called when a Modeler device boots up, asking for a path to data.
-        """
 
-        # get the filename of all of the trajectories from the database
-        traj_fns = [str(e[0]) for e in session.query(Trajectory.path).all()]
-        assert isinstance(traj_fns, list)
-        assert len(traj_fns) == 0 or isinstance(traj_fns[0], str)
+        If self.delta_models, and there's a previous model to start from, the
+        message contains the path to that model (base_model) and only the
+        trajectories that have been added since it was built. Otherwise, it
+        contains all of the trajectories. Either way, last_trajectory_id is
+        the id of the last trajectory in the message, which the modeler sends
+        back to us in modeler_done.
 
-        self.send_message(header.sender_id, 'construct_model', content={
+        If there isn't enough new data to build a new model, or another
+        modeler is already building one, the modeler is sent a nothing_to_do
+        message instead. See ModelScheduler.
+        """
+        # make sure we see the rows still in the write-behind queue
+        self.db_writer.flush()
+        with self.stats.timer('database'):
+            self.trajectory_view.refresh()
+            base = None
+            if self.delta_models:
+                base = with_db_lock(latest_model)()
+
+        last_id = 0
+        if base is not None and base.last_trajectory_id is not None \
+                and os.path.exists(base.path):
+            last_id = base.last_trajectory_id
+        ids, traj_fns = self.trajectory_view.since(last_id)
+        last_trajectory_id = ids[-1] if len(ids) > 0 else last_id
+
+        reason = self.scheduler.request(header.sender_id, last_trajectory_id,
+                                        self.trajectory_view.n_frames_since)
+        if reason is not None:
+            self.log.info('Not building a model: %s', reason)
+            self.stats.count('model_builds_declined')
+            self.send_message(header.sender_id, 'nothing_to_do',
+                              content={'reason': reason})
+            return
+
+        content = {
             'traj_fns': traj_fns,
+            'last_trajectory_id': last_trajectory_id,
             'output': {
                 'protocol': 'localfs',
                 'path': os.path.join(os.path.abspath(self.models_outdir), header.sender_id + '.h5'),
             }
-        })
+        }
+        if last_id > 0:
+            self.log.info('Sending %d new trajectories on top of model %s',
+                          len(traj_fns), base.path)
+            content['base_model'] = {'protocol': 'localfs', 'path': base.path}
+        if self._ingest_pool is not None:
+            content['features'] = {
+                'protocol': 'localfs',
+                'path': os.path.abspath(self.features_outdir),
+            }
+
+        self.send_message(header.sender_id, 'construct_model', content=content)
 
+    @blocking
     def modeler_done(self, header, content):
         """Called when a Modeler finishes, returning the path to the model
         build.
+
+        If a model with newer data has been registered in the meantime (e.g.
+        this build was so slow that it timed out, and another modeler was
+        started), this one is ignored.
         """
         assert content.output.protocol == 'localfs'
-        # register the newest model with the sampler!
-        self.sampler.model_fn = content.output.path
         self.send_message(header.sender_id, 'acknowledge_receipt')
 
+        last_trajectory_id = None
+        if 'last_trajectory_id' in content:
+            last_trajectory_id = content.last_trajectory_id
+        if not self.scheduler.finish(header.sender_id, last_trajectory_id):
+            self.log.warning('Ignoring model %s, which has been superseded by '
+                             'a newer one', content.output.path)
+            self.stats.count('model_builds_superseded')
+            return
+
+        # register the newest model with the sampler!
+        with self.sampler_lock, self.stats.timer('load_model'):
+            self.sampler.model_fn = content.output.path
+
         # save every model in the database
-        session.add(Model(
+        self._save(Model(
             time = datetime.fromtimestamp(header.time),
             protocol = content['output']['protocol'],
-            path = content['output']['path']
+            path = content['output']['path'],
+            last_trajectory_id = last_trajectory_id
         ))
-        session.commit()
 
     def simulation_status(self, header, content):
-        """Called when the simulation reports its status.
+        """Called when the simulation reports its status. This is a heartbeat,
+        which renews the lease on its job. If the simulator has saved a
+        checkpoint, the status contains its path and step, and the job is
+        resumed from there if the lease expires.
         """
-        self.send_message(header.sender_id, 'acknowledge_receipt')
-
+        status = 'success'
+        resume = None
+        if 'checkpoint' in content:
+            resume = {'checkpoint': content.checkpoint.to_dict(),
+                      'step': content.step}
+        if 'job_id' in content and content.job_id is not None \
+                and not self.leases.renew(content.job_id, resume):
+            # the lease has already expired, and its starting state might
+            # have been handed out again
+            self.log.warning('Heartbeat from %s for unknown job %s',
+                             header.sender_id, content.job_id)
+            status = 'unknown_job'
+        self.send_message(header.sender_id, 'acknowledge_receipt',
+                          content={'status': status})
+
+    def status_batch(self, header, content):
+        """Called with a batch of status reports, published by a simulator on
+        the status socket (see BaseServer.status_port). There's no reply.
+        Each report renews the lease on its job, like a heartbeat, and its
+        speed goes into the statistics of the fleet.
+        """
+        for report in content.reports:
+            job_id = report.get('job_id')
+            if job_id is None:
+                continue
+            self.leases.renew(job_id)
+            self.stats.progress(job_id, report.get('ns_per_day'))
+        self.stats.count('status_reports', len(content.reports))
+
+    @blocking
     def simulation_done(self, header, content):
         """Called when a simulation finishes"""
         self.send_message(header.sender_id, 'acknowledge_receipt')
-        if not os.path.exists(content['output']['path']):
-            self.log.critical('Output file returned by simulation does not exist. %s' % content['output']['path'])
-
-        session.add(Trajectory(
-            time = datetime.fromtimestamp(header.time),
-            protocol = content['output']['protocol'],
-            path = content['output']['path']
+        if 'job_id' in content and content.job_id is not None:
+            if self.leases.complete(content.job_id):
+                self.stats.count('leases_completed')
+            else:
+                # we'll use the trajectory anyways
+                self.log.warning('Simulation finished after its lease had '
+                                 'expired: %s', content.job_id)
+
+        if 'segments' in content:
+            # the trajectory was streamed to us in segments, which have
+            # already been registered
+            return
+        self._ingest(content['output']['path'], datetime.fromtimestamp(header.time),
+                     content['output']['protocol'])
+
+    @blocking
+    def segment_done(self, header, content):
+        """Called when a simulation has finished a segment of its trajectory,
+        which is registered right away, so that it can be used to build
+        models before the simulation is done. The segments of a job are
+        joined back together into one trajectory (by their trajectory_id,
+        which is shared by a job and the jobs that resumed it). This also
+        renews the lease on the job.
+
+        The segments of a job whose lease has expired are dropped, since
+        the job might have been resumed by another simulator, which is
+        writing its own segments of the same trajectory.
+        """
+        self.send_message(header.sender_id, 'acknowledge_receipt')
+        if not self.leases.renew(content.job_id):
+            self.log.warning('Dropping a segment from %s for unknown job %s',
+                             header.sender_id, content.job_id)
+            self.stats.count('segments_dropped')
+            return
+        self.stats.count('segments_received')
+        trajectory_id = content.trajectory_id if 'trajectory_id' in content else content.job_id
+        self._ingest(content['output']['path'], datetime.fromtimestamp(header.time),
+                     content['output']['protocol'], job_id=trajectory_id,
+                     segment=content.segment)
+
+    def _ingest(self, path, time, protocol, **kwargs):
+        """Record the metadata of a new trajectory, so that nobody else has to
+        open the file to find out how big it is, or whether it's any good.
+        The row is saved to the database once that's done. Any extra
+        keyword arguments are fields of the Trajectory row.
+        """
+        on_ingested = functools.partial(self._on_ingested, path, time,
+                                        protocol, **kwargs)
+
+        if self._ingest_pool is not None:
+            self.stats.count('ingest_submitted')
+            self._ingest_pool.apply_async(ingest_trajectory, (path,
+                features_filename(self.features_outdir, path),
+                self._features_atom_indices, self.topology_pdb),
+                callback=on_ingested)
+        else:
+            with self.stats.timer('ingest'):
+                metadata = trajectory_metadata(path, self.ingest_trajectories)
+            on_ingested((metadata, None))
+
+    def _on_ingested(self, path, time, protocol, result, **kwargs):
+        """Called with the result of ingest_trajectory(), possibly from the
+        ingest pool's result thread"""
+        metadata, error = result
+        if metadata['status'] != STATUS_OK:
+            self.stats.count('bad_trajectories')
+            self.log.critical('Output file returned by simulation is %s. It will '
+                              'not be used to build models: %s', metadata['status'], path)
+        if error is not None:
+            self.log.error('Failed to ingest %s:\n%s', path, error)
+
+        metadata.update(kwargs)
+        self._save(Trajectory(
+            time = time,
+            protocol = protocol,
+            path = path,
+            **metadata
         ))
-        session.commit()
 
 
     # permit external interaction with the sampler, to change its
@@ -215,7 +561,8 @@ class AdaptiveServer(BaseServer):
 
         try:
             new_beta = content.value
-            self.sampler.beta = new_beta
+            with self.sampler_lock:
+                self.sampler.beta = new_beta
             self.send_message(header.sender_id, 'set_beta', content={
                 'status': 'success'
             })
@@ -245,3 +592,44 @@ class AdaptiveServer(BaseServer):
     ########################################################################
     # END HANDLERS FOR INCOMMING MESSAGES
     ########################################################################
+
+    def _new_starting_state(self, job_id):
+        """Sample a new starting state for a job, and write it to disk
+
+        Returns
+        -------
+        path : str
+            The absolute path to the starting state file
+        """
+        state_format = self.sampler.statebuilder.extension
+        assert state_format in ['.xml', '.inpcrd', '.ncrst'], 'invalid state format'
+        starting_state_fn = os.path.abspath(os.path.join(
+            self.starting_states_outdir, job_id + state_format))
+        with self.sampler_lock:
+            # this is sampler.get_state(), split in two so that we can
+            # time the parts separately
+            with self.stats.timer('sampler'):
+                frame = self.sampler.select()
+            with self.stats.timer('statebuilder'):
+                state = self.sampler.statebuilder.build(frame)
+        with open(starting_state_fn, 'wb') as f:
+            f.write(state)
+        return starting_state_fn
+
+    def _expire_leases(self):
+        """Called periodically on the IOLoop"""
+        expired = self.leases.expire()
+        if len(expired) > 0:
+            self.stats.count('leases_expired', len(expired))
+            self.log.warning('%d leases expired. Their starting states will be '
+                             'reissued. %d leases are active', len(expired),
+                             len(self.leases))
+
+    def _on_commit(self, n_rows, seconds):
+        super(AdaptiveServer, self)._on_commit(n_rows, seconds)
+        self.trajectory_view.refresh()
+
+    def _save(self, row):
+        # this doesn't block. the row is committed along with the others
+        # in the queue by a background thread.
+        self.db_writer.add(row)
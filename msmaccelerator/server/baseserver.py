@@ -6,18 +6,27 @@
 ##############################################################################
 
 import os
-import yaml
 import zmq
+import json
+import time
 import uuid
+import signal
+import atexit
+import functools
+import threading
+from multiprocessing.pool import ThreadPool
 from zmq.eventloop import ioloop
 ioloop.install()  # this needs to come at the beginning
 from zmq.eventloop.zmqstream import ZMQStream
-from IPython.utils.traitlets import Unicode, Int, Bool
+from IPython.utils.traitlets import Unicode, Int, Bool, Float
 
 # local
-from ..core.database import connect_to_sqlite_db
+from ..core.database import connect_to_sqlite_db, WriteBehindQueue
 from ..core.app import App
-from ..core.message import Message, pack_message
+from ..core.message import (Message, pack_message, guess_codec, get_codec,
+                            array_frames, attach_arrays)
+from .stats import ServerStats
+from .clients import ClientTable
 
 
 ##############################################################################
@@ -35,25 +44,104 @@ class BaseServer(App):
     with three arguments, header, parent_header and content.
 
     The method should respond on the stream by calling send_message()
+
+    Handlers that do slow work (disk access, building states, talking to
+    the database) should be decorated with @blocking. These are run in a
+    pool of worker threads instead of on the IOLoop, so that they don't
+    stall the other clients. Their replies are sent from the IOLoop once
+    they're ready.
+
+    The server keeps statistics on the messages that it handles (counts,
+    latencies, bytes on the wire) in self.stats. Subclasses can time the
+    expensive parts of their handlers with self.stats.timer(name).
     """
 
     zmq_port = Int(12345, config=True, help='ZeroMQ port to serve on')
     db_path = Unicode('db.sqlite', config=True, help='''
         Path to the database (sqlite3 file)''')
+    db_batch_size = Int(100, config=True, help='''Maximum number of rows
+        (finished trajectories, models) to insert into the database in a
+        single transaction.''')
+    db_commit_interval = Float(1.0, config=True, help='''Maximum time, in
+        seconds, that a new row waits before it's committed to the
+        database. Rows are committed in batches by a background thread,
+        so that the handlers don't wait on the disk.''')
+    n_workers = Int(4, config=True, help='''Number of worker threads used
+        to run the blocking message handlers. If zero, all of the handlers
+        are run synchronously on the event loop.''')
+    stats_file = Unicode('', config=True, help='''If set, periodically dump
+        the server's statistics (message counts, handler latencies, time
+        spent in the sampler/statebuilder/database) to this file, as JSON.
+        The statistics can also be queried from a live server with
+        `accelerator interact --stats`.''')
+    stats_interval = Float(60, config=True, help='''Interval, in seconds,
+        between dumps of the statistics to the stats_file.''')
+    max_clients = Int(10000, config=True, help='''Number of clients whose
+        routing identity, message format and last reply the server keeps
+        track of. The least recently heard from are forgotten first.''')
+    # the message types that can be sent on the status socket
+    status_msg_types = ('status_batch',)
+
+    status_port = Int(0, config=True, help='''If nonzero, listen on this port
+        (with a SUB socket) for the status reports that the devices publish
+        while they work. These are fire-and-forget, so unlike the messages on
+        zmq_port, the devices don't wait for a reply.''')
 
 
     def start(self):
         url = 'tcp://*:%s' % int(self.zmq_port)
 
         self.uuid = str(uuid.uuid4())
+        # the ioloop isn't started until the subclass is done starting up,
+        # but it's going to run in this thread.
+        self._ioloop = ioloop.IOLoop.instance()
+        self._ioloop_thread = threading.current_thread()
+        self._pool = None
+        if self.n_workers > 0:
+            self._pool = ThreadPool(self.n_workers)
+
+        self.stats = ServerStats()
+        if self.stats_file != '':
+            ioloop.PeriodicCallback(self.dump_stats, 1000*self.stats_interval,
+                                    io_loop=self._ioloop).start()
+
         self.ctx = zmq.Context()
         s = self.ctx.socket(zmq.ROUTER)
         s.bind(url)
+        # how to reach each client, the codec that it's talking to us in
+        # (so that we can reply in the same format), and our reply to its
+        # last request (so that a retried request isn't handled twice)
+        self._clients = ClientTable(self.max_clients)
+        # the (sender_id, request_id) that the handler running in the
+        # current thread is replying to
+        self._local = threading.local()
         self._stream = ZMQStream(s)
-        self._stream.on_recv(self._dispatch)
+        # receive zmq.Frames instead of bytes, so that the arrays attached
+        # to messages can be views over the frames' memory
+        self._stream.on_recv(self._dispatch, copy=False)
+        if self.status_port != 0:
+            s = self.ctx.socket(zmq.SUB)
+            s.setsockopt(zmq.SUBSCRIBE, '')
+            s.bind('tcp://*:%s' % int(self.status_port))
+            self._status_stream = ZMQStream(s)
+            self._status_stream.on_recv(self._dispatch_status)
         connect_to_sqlite_db(self.db_path)
+        self.db_writer = WriteBehindQueue(self.db_batch_size,
+            self.db_commit_interval, log=self.log, on_commit=self._on_commit)
+        # make sure that the queued rows get committed when we exit. on
+        # SIGTERM, stop the ioloop so that the exit is orderly.
+        atexit.register(self.db_writer.close)
+        signal.signal(signal.SIGTERM, self._on_sigterm)
 
-    def send_message(self, client_id, msg_type, content=None):
+    def _on_commit(self, n_rows, seconds):
+        self.stats.add_time('database_commit', seconds)
+        self.stats.count('database_rows', n_rows)
+
+    def _on_sigterm(self, signum, frame):
+        self.log.info('Received SIGTERM. Shutting down.')
+        self._ioloop.add_callback_from_signal(self._ioloop.stop)
+
+    def send_message(self, client_id, msg_type, content=None, arrays=None):
         """Send a message out to a client
 
         Parameters
@@ -71,19 +159,45 @@ class BaseServer(App):
             The type of the message
         content : dict
             Content of the message
+        arrays : dict of str -> np.ndarray, optional
+            Numpy arrays to send along with the message, as extra frames.
+
         Notes
         -----
         For details on the messaging protocol, refer to message.py
+
+        This method can be called from any thread. ZMQ sockets aren't thread
+        safe, so if we're not on the IOLoop's thread, the message is handed
+        off to the IOLoop to be sent.
+
+        The first message that a handler sends to the client whose request
+        it's handling is remembered as the reply to that request, and sent
+        again if the client retries the request.
         """
         if content is None:
             content = {}
 
-        msg = pack_message(msg_type, self.uuid, content)
+        reply_to = getattr(self._local, 'reply_to', None)
+        if reply_to is not None and reply_to[0] == client_id:
+            self._clients.set_reply(client_id, reply_to[1],
+                                    (msg_type, content, arrays))
+
+        if threading.current_thread() is not self._ioloop_thread:
+            self._ioloop.add_callback(functools.partial(self._send,
+                client_id, msg_type, content, arrays))
+        else:
+            self._send(client_id, msg_type, content, arrays)
+
+    def _send(self, client_id, msg_type, content, arrays):
+        msg = pack_message(msg_type, self.uuid, content, arrays)
         self.log.info('SENDING MESSAGE: %s', msg)
 
-        self._stream.send(client_id, zmq.SNDMORE)
-        self._stream.send('', zmq.SNDMORE)
-        self._stream.send_json(msg)
+        # the client's socket identity is its sender_id, unless it had to
+        # reconnect. see Device.connect()
+        route, codec = self._clients.route(client_id) or (client_id, get_codec('json'))
+        frames = [route, '', codec.encode(msg)] + array_frames(arrays)
+        self.stats.sent(msg_type, sum(len(buffer(f)) for f in frames[2:]))
+        self._stream.send_multipart(frames, copy=False)
 
     def _validate_msg_dict(self, msg_dict):
         if 'header' not in msg_dict:
@@ -114,34 +228,133 @@ class BaseServer(App):
         # if this is a tornado thing or what, but disabling
         # the parent log handler seems to fix it.
         self.log.parent.handlers = []
+        received_at = time.time()
 
-        if not len(frames) == 3:
-            self.log.error('invalid message received. messages are expected to contain only three frames: %s', str(frames))
+        if len(frames) < 3:
+            self.stats.count('invalid_messages')
+            self.log.error('invalid message received. messages are expected to contain at least three frames: %s', str(frames))
+            return
 
-        client, _, raw_msg = frames
-        # using the PyYaml loader is a hack force regular strings
-        # instead of unicode, since you can't send unicode over zmq
-        # since json is a subset of yaml, this works
-        msg_dict = yaml.load(raw_msg)
+        client, raw_msg = frames[0].bytes, frames[2].bytes
+        codec = guess_codec(raw_msg)
 
         try:
+            msg_dict = codec.decode(raw_msg)
             self._validate_msg_dict(msg_dict)
-        except ValueError:
+            attach_arrays(msg_dict, frames[3:])
+        except Exception:
             # if we recieve an invalid message, we log it out error stream
             # and then return from this function, so it won't take the server
             # down
-            self.log.exception('Invalid message: %s', msg_dict)
+            self.stats.count('invalid_messages')
+            self.log.exception('Invalid message: %r', raw_msg)
             return
-
         msg = Message(msg_dict)
         self.log.info('RECEIVING MESSAGE: %s', msg)
 
         try:
             responder = getattr(self, msg.header.msg_type)
         except AttributeError:
+            # not counted by type, so that a client can't grow the stats
+            # without bound by making up types
+            self.stats.count('unknown_msg_type')
             self.log.critical('RESPONDER NOT FOUND FOR MESSAGE: %s',
                               msg.header.msg_type)
             return
 
-        responder(msg.header, msg.content)
+        self.stats.received(msg.header.msg_type,
+                            sum(len(f) for f in frames[2:]))
+        retry, reply = self._clients.track(msg.header.sender_id, client, codec,
+                                           msg_dict['header'].get('request_id'))
+        if retry:
+            # handled already, or it's still in the queue
+            self.stats.count('retried_requests')
+            if reply is not None:
+                self._send(msg.header.sender_id, *reply)
+            return
+
+        if self._pool is not None and getattr(responder, 'blocking', False):
+            self.stats.enqueued()
+            self._pool.apply_async(self._run_blocking,
+                                   (responder, msg, received_at))
+        else:
+            self._run(responder, msg, received_at)
+
+    def _dispatch_status(self, frames):
+        """Callback for the messages on the status socket. These are handled
+        on the IOLoop, and there's no reply."""
+        raw_msg = frames[0]
+        try:
+            msg_dict = guess_codec(raw_msg).decode(raw_msg)
+            self._validate_msg_dict(msg_dict)
+            msg = Message(msg_dict)
+            if msg.header.msg_type not in self.status_msg_types:
+                # the other handlers would try to reply
+                raise ValueError('not a status message')
+            responder = getattr(self, msg.header.msg_type)
+        except Exception:
+            self.stats.count('invalid_messages')
+            self.log.exception('Invalid status message: %r', raw_msg)
+            return
+        self.stats.received(msg.header.msg_type, len(raw_msg))
+        self._run(responder, msg, time.time())
+
+    def _run_blocking(self, responder, msg, received_at):
+        """Run a blocking handler in a worker thread"""
+        self.stats.dequeued(time.time() - received_at)
+        try:
+            self._run(responder, msg, received_at)
+        except Exception:
+            # exceptions raised in the pool would otherwise be silently
+            # swallowed, since nobody is waiting on the result.
+            self.log.exception('Error in handler for message: %s', msg)
+
+    def _run(self, responder, msg, received_at):
+        """Call the handler for a message, recording its latency"""
+        error = True
+        if 'request_id' in msg.header:
+            self._local.reply_to = (msg.header.sender_id, msg.header.request_id)
+        try:
+            responder(msg.header, msg.content)
+            error = False
+        finally:
+            self._local.reply_to = None
+            self.stats.handled(msg.header.msg_type,
+                               time.time() - received_at, error)
+
+    def get_stats(self, header, content):
+        """Reply with the server's statistics. If content.reset is True,
+        the statistics are reset after they're sent."""
+        self.send_message(header.sender_id, 'stats', content=self.stats.to_dict())
+        if 'reset' in content and content.reset:
+            self.stats.reset()
+
+    def dump_stats(self):
+        """Write the server's statistics to self.stats_file"""
+        # write to a temporary file and then rename it, so that anyone
+        # reading the file never sees it half written
+        tmp = self.stats_file + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self.stats.to_dict(), f, indent=2, sort_keys=True)
+            os.rename(tmp, self.stats_file)
+        except (IOError, OSError):
+            self.log.exception('Could not write statistics to %s', self.stats_file)
+
+
+##############################################################################
+# Functions
+##############################################################################
+
+
+def blocking(handler):
+    """Decorator that marks a message handler as blocking, so that the server
+    runs it in its pool of worker threads instead of on the IOLoop.
+
+    Since blocking handlers run concurrently with each other (and with the
+    non-blocking ones), any state that they share needs to be protected
+    with a lock.
+    """
+    handler.blocking = True
+    return handler
 
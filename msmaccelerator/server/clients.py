@@ -0,0 +1,103 @@
+"""Bookkeeping on the clients that talk to the server.
+
+For each client, we remember the identity of the socket that its messages
+are routed from (which changes when it reconnects, see Device.connect), the
+codec that it's talking to us in, so that we can reply in the same format,
+and its last request and our reply to it.
+
+The devices retry a request that hasn't been answered within a timeout,
+with the same request_id (see Device.send_recv). A request that's waiting
+in the server's queue, or that was answered on a connection that the client
+has since given up on, would otherwise be handled twice, e.g. handing out
+two starting states to a simulator that only runs one of them.
+"""
+##############################################################################
+# Imports
+##############################################################################
+
+import threading
+from collections import OrderedDict
+
+##############################################################################
+# Classes
+##############################################################################
+
+
+class ClientTable(object):
+    """Table of the clients that the server has heard from recently.
+
+    Parameters
+    ----------
+    max_clients : int
+        Number of clients to remember. The least recently heard from are
+        forgotten first.
+    """
+    def __init__(self, max_clients=10000):
+        self.max_clients = max_clients
+        # sender_id -> [route, codec, request_id, reply]
+        self.clients = OrderedDict()
+        self._lock = threading.Lock()
+
+    def track(self, sender_id, route, codec, request_id=None):
+        """Record a message from a client.
+
+        Parameters
+        ----------
+        sender_id : str
+            The client
+        route : str
+            The identity of the socket that the message came from
+        codec : object
+            The codec that the message was encoded with
+        request_id : str, optional
+            The id of the request, which is the same for each of its
+            retries
+
+        Returns
+        -------
+        retry : bool
+            Whether the message is a retry of the client's last request,
+            in which case it shouldn't be handled again
+        reply : tuple or None
+            If it's a retry, and we've already replied to the request, the
+            reply (see set_reply()), which should be sent again. If it's a
+            retry that we haven't replied to yet, the reply will be sent
+            to the new route when the handler is done.
+        """
+        with self._lock:
+            client = self.clients.pop(sender_id, None)
+            if client is None:
+                client = [None, None, None, None]
+            client[0], client[1] = route, codec
+            # move it to the end
+            self.clients[sender_id] = client
+            while len(self.clients) > self.max_clients:
+                self.clients.popitem(last=False)
+
+            if request_id is None or request_id != client[2]:
+                client[2], client[3] = request_id, None
+                return False, None
+            return True, client[3]
+
+    def set_reply(self, sender_id, request_id, reply):
+        """Remember the reply to a request, if it's still the client's last
+        request and it hasn't been replied to yet. Returns whether it was
+        recorded."""
+        with self._lock:
+            client = self.clients.get(sender_id)
+            if client is None or client[2] != request_id or client[3] is not None:
+                return False
+            client[3] = reply
+            return True
+
+    def route(self, sender_id):
+        """The (route, codec) to reach a client, or None if we haven't heard
+        from it"""
+        with self._lock:
+            client = self.clients.get(sender_id)
+            if client is None:
+                return None
+            return client[0], client[1]
+
+    def __len__(self):
+        return len(self.clients)
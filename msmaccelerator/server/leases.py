@@ -0,0 +1,219 @@
+"""Leases on the simulations that have been handed out to simulators.
+
+Each starting state that the server hands out is leased to the simulator
+until a deadline. The simulator renews the lease by sending heartbeats
+(simulation_status messages) while it's running. If the deadline passes
+without a heartbeat -- the node died, or the job was preempted -- the lease
+expires, and its starting state is handed out again to the next simulator
+that registers.
+
+A simulator can also tell us about the checkpoints that it saves. If a
+lease with a checkpoint expires, the job is handed out again with the
+checkpoint, so that the next simulator can resume it instead of starting
+over. The resumed job gets a lease (and output files) of its own, so that if
+the first simulator wasn't dead after all, the two don't get mixed up. What
+they have in common is their trajectory_id, the job_id of the job that
+started the trajectory.
+"""
+##############################################################################
+# Imports
+##############################################################################
+
+import time
+import uuid
+import threading
+from collections import deque
+from datetime import datetime
+
+from ..core.database import Lease
+
+##############################################################################
+# Classes
+##############################################################################
+
+
+class LeaseTable(object):
+    """Table of the outstanding simulations, kept in memory, and backed by
+    the database.
+
+    Parameters
+    ----------
+    timeout : float
+        Time, in seconds, that a lease lasts without being renewed
+    save : callable, optional
+        Called with a core.database.Lease row whenever a lease is issued,
+        completed or expired, e.g. the add() method of a WriteBehindQueue.
+        The heartbeats aren't saved.
+    """
+    def __init__(self, timeout=600, save=None):
+        self.timeout = timeout
+        self.save = save
+        # job_id -> [sender_id, starting_state, issued, deadline, resume,
+        #            output, trajectory_id]
+        self.leases = {}
+        # (starting_state, job_id, resume) of the expired leases, waiting
+        # to be handed out
+        self.reissue = deque()
+        self.n_issued = 0
+        self.n_completed = 0
+        self.n_expired = 0
+        self._lock = threading.Lock()
+
+    def issue(self, sender_id, starting_state, job_id=None, resume=None,
+              output=None, trajectory_id=None):
+        """Lease a starting state to a simulator
+
+        Parameters
+        ----------
+        sender_id : str
+            The simulator
+        starting_state : str
+            Path to the starting state
+        job_id : str, optional
+            The id to use for the lease. By default, a new uuid.
+        resume : dict, optional
+            The last checkpoint of the job, if it's being resumed. See
+            renew().
+        output : str, optional
+            Path to the output trajectory of the job
+        trajectory_id : str, optional
+            The id of the trajectory that the job is (a part of). By
+            default, the job_id.
+
+        Returns
+        -------
+        job_id : str
+            The id of the lease, which the simulator sends back with its
+            heartbeats and when it's done.
+        """
+        if job_id is None:
+            job_id = str(uuid.uuid4())
+        if trajectory_id is None:
+            trajectory_id = job_id
+        now = time.time()
+        lease = [sender_id, starting_state, now, now + self.timeout, resume,
+                 output, trajectory_id]
+        with self._lock:
+            self.leases[job_id] = lease
+            self.n_issued += 1
+        self._save(job_id, list(lease), 'active')
+        return job_id
+
+    def renew(self, job_id, resume=None):
+        """Extend the deadline of a lease. Returns False if there's no such
+        lease, e.g. because it has already expired.
+
+        Parameters
+        ----------
+        job_id : str
+            The lease
+        resume : dict, optional
+            A new checkpoint of the job, as a dict with the keys
+            'checkpoint' (the path to the checkpoint, as a protocol/path
+            dict) and 'step' (the number of steps of the job that had been
+            done when it was saved). The output trajectory (as a
+            protocol/path dict) and trajectory_id of the lease are added to
+            it, since the job that resumes from the checkpoint needs them.
+            Unlike the plain heartbeats, this is saved to the database.
+        """
+        with self._lock:
+            if job_id not in self.leases:
+                return False
+            lease = self.leases[job_id]
+            lease[3] = time.time() + self.timeout
+            if resume is not None:
+                resume = dict(resume, trajectory_id=lease[6],
+                              output={'protocol': 'localfs', 'path': lease[5]})
+                lease[4] = resume
+                lease = list(lease)
+        if resume is not None:
+            self._save(job_id, lease, 'active')
+        return True
+
+    def complete(self, job_id):
+        """Release the lease on a finished simulation. Returns False if
+        there's no such lease."""
+        with self._lock:
+            if job_id not in self.leases:
+                return False
+            lease = self.leases.pop(job_id)
+            self.n_completed += 1
+        self._save(job_id, lease, 'done')
+        return True
+
+    def expire(self):
+        """Expire the leases whose deadlines have passed, and queue their
+        starting states to be handed out again.
+
+        Returns
+        -------
+        job_ids : list of str
+            The leases that expired
+        """
+        now = time.time()
+        expired = []
+        with self._lock:
+            for job_id, lease in self.leases.items():
+                if lease[3] < now:
+                    del self.leases[job_id]
+                    self.reissue.append((lease[1], job_id, lease[4]))
+                    expired.append((job_id, lease))
+            self.n_expired += len(expired)
+
+        for job_id, lease in expired:
+            self._save(job_id, lease, 'expired')
+        return [job_id for job_id, lease in expired]
+
+    def next_reissue(self):
+        """Get an expired lease to hand out again, or None if there aren't
+        any.
+
+        Returns
+        -------
+        reissue : tuple or None
+            (starting_state, job_id, resume), where resume is the last
+            checkpoint of the job (see renew()), or None if it didn't send
+            one. The job should be given a new job_id.
+        """
+        with self._lock:
+            if len(self.reissue) == 0:
+                return None
+            return self.reissue.popleft()
+
+    def restore(self, rows):
+        """Load the active leases from the database, e.g. after the server
+        restarts. Their deadlines are reset, since we can't know how long
+        it's been since their last heartbeat."""
+        now = time.time()
+        with self._lock:
+            for row in rows:
+                issued = time.mktime(row.issued.timetuple())
+                job_id = str(row.job_id)
+                output = str(row.output) if row.output is not None else None
+                trajectory_id = str(row.trajectory_id) if row.trajectory_id is not None else job_id
+                resume = None
+                # (leases saved by older versions don't have the output)
+                if row.checkpoint is not None and output is not None:
+                    resume = {'checkpoint': {'protocol': 'localfs',
+                                             'path': str(row.checkpoint)},
+                              'step': row.step,
+                              'output': {'protocol': 'localfs', 'path': output},
+                              'trajectory_id': trajectory_id}
+                self.leases[job_id] = [str(row.sender_id), str(row.starting_state),
+                    issued, now + self.timeout, resume, output, trajectory_id]
+
+    def __len__(self):
+        return len(self.leases)
+
+    def _save(self, job_id, lease, status):
+        if self.save is not None:
+            sender_id, starting_state, issued, deadline, resume, output, trajectory_id = lease
+            row = Lease(job_id=job_id, sender_id=sender_id,
+                        starting_state=starting_state,
+                        issued=datetime.fromtimestamp(issued),
+                        status=status, output=output,
+                        trajectory_id=trajectory_id)
+            if resume is not None:
+                row.checkpoint = resume['checkpoint']['path']
+                row.step = resume['step']
+            self.save(row)
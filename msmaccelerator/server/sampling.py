@@ -16,13 +16,15 @@ import os
 
 # 3rd party
 import numpy as np
-import mdtraj as md
+import scipy.sparse
+import scipy.sparse.linalg
 from IPython.config import Configurable
-from IPython.utils.traitlets import Instance, Float, Unicode
+from IPython.utils.traitlets import Instance, Float, Unicode, Int
 
 # ours
 from ..core.traitlets import CNumpyArray
 from ..core.markovstatemodel import MarkovStateModel
+from ..core.trajectory_cache import TrajectoryCache
 
 ##############################################################################
 # Abstract Classes
@@ -42,6 +44,15 @@ class BaseSampler(Configurable):
         single PDB or other type of loadable trajectory file. These structures
         will only be used in the beginning, before we have an actual MSM
         to use.''')
+    trajectories = Instance('msmaccelerator.core.trajectory_cache.TrajectoryCache',
+        help='''Cache of open trajectory files that frames are read from''')
+    max_open_trajectories = Int(32, config=True, help='''Maximum number of
+        trajectory files to keep open for random access to their frames.''')
+
+    def _trajectories_default(self):
+        # the seed structures give the topology for formats without one
+        return TrajectoryCache(self.max_open_trajectories,
+                               topology=self.seed_structures)
 
     def get_state(self):
         self.log.error(self.seed_structures)
@@ -79,14 +90,10 @@ class BaseSampler(Configurable):
                 "to know what starting conditions to send to the sampler, "
                 "since no MSMs have been build")
 
-        # if the seed structures trajectory is big and supports random
-        # access, this might not be the most efficient, since we're loading
-        # the whole trajectory just to get a single frame.
-        traj = md.load(self.seed_structures)
-        frame = np.random.randint(len(traj))
+        frame = np.random.randint(self.trajectories.n_frames(self.seed_structures))
 
         self.log.info('Sampling from the seed structures, frame %d' % frame)
-        return traj[frame]
+        return self.trajectories.read_frame(self.seed_structures, frame)
 
 
 class CentroidSampler(BaseSampler):
@@ -133,6 +140,22 @@ class CentroidSampler(BaseSampler):
         self.log.info('[CentroidSampler] New sampling weights set!')
 
 
+    def choose_state(self):
+        """Choose the index of a microstate from the multinomial distribution
+        given by `self.weights`.
+
+        This is split off from select() so that code which doesn't have any
+        structures on disk (e.g. the offline sampling benchmark) can still
+        drive the sampler.
+
+        Returns
+        -------
+        index : int
+            The index of the chosen microstate.
+        """
+        # Find the index of the first weight over a random value.
+        return np.sum(self.cumulative_weights < np.random.rand())
+
     def select(self):
         """Select a simulation frame from amongst the state centroids, choosing
         randomly from a multinomial distribution.
@@ -155,13 +178,13 @@ class CentroidSampler(BaseSampler):
                            'are registered.')
             return super(CentroidSampler, self).select()
 
-        # Find the index of the first weight over a random value.
-        index = np.sum(self.cumulative_weights < np.random.rand())
+        index = self.choose_state()
         traj, frame = self.model.generator_indices[index]
         filename = self.model.traj_filenames[traj]
 
-        # load up the generator from disk
-        traj = md.trajectory.load(filename)[frame]
+        # load up the generator from disk. if the trajectory only has some
+        # of the atoms, this reads the nearest frame of the full system.
+        traj = self.trajectories.read_full_frame(filename, frame)
         self.log.info('Sampling from a multinimial. I choose '
                       'traj="%s", frame=%s', filename, frame)
         return traj
@@ -209,3 +232,189 @@ class CountsSampler(CentroidSampler):
         self.cumulative_weights = np.cumsum(self.weights)
         self.log.info('[CountsSampler] Beta=%s. Setting multinomial weights, %s',
                       self.beta, self.weights)
+
+
+class SpectralSampler(CentroidSampler):
+    """Adaptive sampler that puts simulations in the states which contribute
+    the most to the uncertainty in the slowest implied timescales.
+
+    The uncertainty is estimated with a first-order sensitivity analysis of
+    the eigenvalues of the transition matrix, treating each row of the
+    transition matrix as Dirichlet-distributed given its observed counts.
+    See Hinrichs, N. S.; Pande, V. S. "Calculation of the distribution of
+    eigenvalues and eigenvectors in Markovian state models for molecular
+    dynamics" J. Chem. Phys. 2007, 126, 244101.
+    """
+    n_timescales = Int(1, config=True, help="""Number of slow implied
+        timescales whose variance we try to reduce. Each timescale's
+        contribution is weighted equally.""")
+    exploration = Float(0.01, config=True, help="""Fraction of the
+        probability that is spread uniformly over all of the states, so that
+        every state has some chance of being sampled. This also guards
+        against states whose variance contribution is numerically zero.""")
+
+    def _model_changed(self, old, new):
+        """When the MarkovStateModel that this class is pointing to, self.model,
+        is changed, this callback will be triggered. We use this hook to set
+        the weights, which will be used by the superclass to randomly sample
+        the generators with."""
+        self.reset_weights()
+
+    def _n_timescales_changed(self, old, new):
+        self.reset_weights()
+
+    def _exploration_changed(self, old, new):
+        self.reset_weights()
+
+    def reset_weights(self):
+        if self.model is None:
+            return
+
+        counts = self.model.counts
+        t_matrix = self.model.transition_matrix
+        n_states = counts.shape[0]
+        n_active = t_matrix.shape[0]
+
+        # the transition matrix only covers the states that survived ergodic
+        # trimming, whereas the counts (and generators) cover all of them.
+        mapping = self.model.mapping
+        if mapping is None or len(mapping) != n_states:
+            mapping = np.arange(n_states)
+        active = mapping >= 0
+
+        row_counts = np.zeros(n_active)
+        row_counts[mapping[active]] = np.array(counts.sum(axis=1)).flatten()[active]
+
+        populations = self.model.populations
+        if populations is None or len(populations) != n_active:
+            populations = None
+
+        # warm start the eigensolver from the previous model's slow
+        # eigenvectors. the state indices of successive models generally
+        # line up, since new clusters are added at the end.
+        v0 = getattr(self, '_last_eigenvector', None)
+        if v0 is not None:
+            v0 = np.resize(v0, n_active)
+
+        variance, eigenvector = timescale_variance_contributions(t_matrix,
+            row_counts, self.n_timescales, lag_time=self.model.lag_time or 1,
+            populations=populations, v0=v0)
+        self._last_eigenvector = eigenvector
+
+        w = np.zeros(n_states)
+        w[active] = variance[mapping[active]]
+        # the states that were trimmed are, by definition, poorly sampled,
+        # so we don't want to neglect them.
+        w[~active] = np.max(variance) if n_active > 0 else 1.0
+
+        if np.sum(w) > 0:
+            w = w / np.sum(w)
+        w = (1 - self.exploration) * w + self.exploration / n_states
+
+        self.weights = w / np.sum(w)
+        self.cumulative_weights = np.cumsum(self.weights)
+        self.log.info('[SpectralSampler] n_timescales=%s. Setting multinomial '
+                      'weights, %s', self.n_timescales, self.weights)
+
+
+##############################################################################
+# Functions
+##############################################################################
+
+
+def timescale_variance_contributions(t_matrix, row_counts, n_timescales,
+                                     lag_time=1, populations=None, v0=None):
+    """Contribution of each state to the variance of the slowest implied
+    timescales of a transition matrix.
+
+    If the ith row of the transition matrix is Dirichlet-distributed with
+    `row_counts[i]` observations, the covariance of its elements is
+    (diag(p) - p p^T) / (c_i + 1), and the sensitivity of the kth eigenvalue
+    to T_ij is phi_i psi_j / <phi, psi>, where phi and psi are the left and
+    right eigenvectors. Expanding the quadratic form, the contribution of
+    row i only needs two sparse matrix-vector products, so this is O(nnz)
+    after the (sparse) eigendecomposition.
+
+    Parameters
+    ----------
+    t_matrix : scipy.sparse matrix or np.ndarray, shape=[n, n]
+        The transition matrix
+    row_counts : np.ndarray, shape=[n]
+        The number of transitions observed out of each state
+    n_timescales : int
+        The number of slow timescales to consider
+    lag_time : int, float
+        Lag time of the model. This just sets the scale of the output.
+    populations : np.ndarray, shape=[n], optional
+        The equilibrium populations. If supplied and the transition matrix
+        satisfies detailed balance, the left eigenvectors are computed from
+        the right ones, skipping a second eigendecomposition.
+    v0 : np.ndarray, shape=[n], optional
+        Starting vector for the iterative eigensolver.
+
+    Returns
+    -------
+    variance : np.ndarray, shape=[n]
+        The contribution of each state to the sum of the variances of the
+        slowest `n_timescales` implied timescales.
+    eigenvector : np.ndarray, shape=[n]
+        The slowest nontrivial right eigenvector, which can be passed back
+        in as `v0` when the model is updated.
+    """
+    t_matrix = scipy.sparse.csr_matrix(t_matrix)
+    n = t_matrix.shape[0]
+    k = min(n_timescales + 1, n)
+    variance = np.zeros(n)
+    if k < 2:
+        return variance, np.ones(n)
+
+    eigenvalues, right = _eig(t_matrix, k, v0)
+    if populations is not None and _is_reversible(t_matrix, populations):
+        left = right * populations[:, np.newaxis]
+    else:
+        left_values, left = _eig(t_matrix.T.tocsr(), k, None)
+        left = _match_eigenvectors(eigenvalues, left_values, left)
+
+    for i in range(1, k):
+        lam = np.clip(eigenvalues[i], 1e-12, 1 - 1e-12)
+        phi, psi = left[:, i], right[:, i]
+        norm = np.dot(phi, psi)
+        # d(timescale) / d(lambda), with timescale = -lag_time / log(lambda)
+        dtdl = lag_time / (lam * np.log(lam)**2)
+        # sum_j T_ij psi_j^2 - (sum_j T_ij psi_j)^2, where the second
+        # sum is lam*psi_i since psi is an eigenvector
+        spread = t_matrix.dot(psi**2) - (lam * psi)**2
+        variance += dtdl**2 * phi**2 * np.maximum(spread, 0) / (norm**2 * (row_counts + 1))
+
+    return variance, right[:, 1]
+
+
+def _eig(t_matrix, k, v0):
+    """The `k` eigenvalues (and right eigenvectors) of `t_matrix` with
+    largest real part, sorted in decreasing order"""
+    n = t_matrix.shape[0]
+    if k + 1 >= n:
+        # arpack requires k < n - 1, so we need to use the dense solver
+        values, vectors = np.linalg.eig(t_matrix.toarray())
+    else:
+        if v0 is not None and (len(v0) != n or not np.all(np.isfinite(v0))):
+            v0 = None
+        values, vectors = scipy.sparse.linalg.eigs(t_matrix, k=k, which='LR', v0=v0)
+
+    order = np.argsort(-np.real(values))[:k]
+    return np.real(values[order]), np.real(vectors[:, order])
+
+
+def _is_reversible(t_matrix, populations, tol=1e-8):
+    """Does the transition matrix satisfy detailed balance with respect to
+    the populations"""
+    flux = scipy.sparse.diags(populations, 0).dot(t_matrix)
+    diff = abs(flux - flux.T)
+    return diff.nnz == 0 or diff.max() < tol
+
+
+def _match_eigenvectors(eigenvalues, other_values, other_vectors):
+    """Reorder `other_vectors` so that column i corresponds to the eigenvalue
+    in `other_values` closest to eigenvalues[i]"""
+    order = [np.argmin(np.abs(other_values - v)) for v in eigenvalues]
+    return other_vectors[:, order]
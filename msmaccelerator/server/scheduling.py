@@ -0,0 +1,112 @@
+"""Scheduling of model builds.
+
+The modelers are started by the external queueing system, which doesn't
+know whether there's enough new data to be worth building a new model, or
+whether another modeler is already building one. The server decides that,
+using the ModelScheduler, and tells the modelers that shouldn't build a
+model that they have nothing to do.
+"""
+##############################################################################
+# Imports
+##############################################################################
+
+import time
+import threading
+
+##############################################################################
+# Classes
+##############################################################################
+
+
+class ModelScheduler(object):
+    """Decides which modelers get to build a model.
+
+    A modeler is given a model to build only if (1) no other modeler is
+    currently building one, and (2) at least `frames_threshold` frames of
+    new data have been collected since the trajectories in the current
+    model. A build that hasn't finished after `build_timeout` seconds is
+    assumed to have died, and no longer blocks new ones.
+
+    Since the builds can finish out of order (e.g. a slow build that had
+    timed out), a finished model is only used if it contains newer data
+    than the current one.
+
+    Parameters
+    ----------
+    frames_threshold : int
+        Minimum number of new frames needed to build a new model
+    build_timeout : float
+        Time, in seconds, after which a build is considered dead
+    model_last_id : int
+        The id of the last trajectory in the current model, or 0 if there
+        isn't one.
+    """
+    def __init__(self, frames_threshold=0, build_timeout=3600, model_last_id=0):
+        self.frames_threshold = frames_threshold
+        self.build_timeout = build_timeout
+        self.model_last_id = model_last_id
+        # sender_id -> (start time, id of the last trajectory in the build)
+        self.builds = {}
+        self.n_expired = 0
+        self._lock = threading.Lock()
+
+    def request(self, sender_id, last_id, count_new_frames):
+        """A modeler is asking to build a model.
+
+        Parameters
+        ----------
+        sender_id : str
+            The modeler
+        last_id : int
+            The id of the last trajectory that it would be given
+        count_new_frames : callable
+            Called with the id of the last trajectory in the current model
+            (model_last_id), returns the number of frames in the
+            trajectories added since. It's called while the lock is held,
+            so that a model that finishes at the same time can't change
+            model_last_id in between.
+
+        Returns
+        -------
+        reason : str or None
+            None if the modeler should build the model. Otherwise, the
+            reason why not.
+        """
+        with self._lock:
+            self._expire()
+            if len(self.builds) > 0:
+                return 'A model is already being built'
+            if last_id <= self.model_last_id:
+                return 'No new trajectories since the last model'
+            n_new_frames = count_new_frames(self.model_last_id)
+            if n_new_frames < self.frames_threshold:
+                return ('Only %d new frames since the last model. The '
+                        'threshold is %d' % (n_new_frames, self.frames_threshold))
+            self.builds[sender_id] = (time.time(), last_id)
+            return None
+
+    def finish(self, sender_id, last_id):
+        """A modeler has finished building a model.
+
+        Returns
+        -------
+        use : bool
+            Whether the new model should replace the current one. It
+            shouldn't if it's been superseded by a model with newer data.
+        """
+        with self._lock:
+            self.builds.pop(sender_id, None)
+            if last_id is None:
+                # a modeler that doesn't tell us what's in its model
+                return True
+            if last_id <= self.model_last_id:
+                return False
+            self.model_last_id = last_id
+            return True
+
+    def _expire(self):
+        now = time.time()
+        for sender_id, (started, last_id) in self.builds.items():
+            if now - started > self.build_timeout:
+                del self.builds[sender_id]
+                self.n_expired += 1
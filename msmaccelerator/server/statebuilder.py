@@ -6,20 +6,33 @@ Code for the server to build serialized states to send to the client
 ##############################################################################
 
 import os
+import re
 import abc
 import datetime
 from cStringIO import StringIO
 
 import numpy as np
+from scipy.io import netcdf
 from simtk.unit import femtoseconds, nanometers
 from simtk.openmm import Context, Platform, XmlSerializer, VerletIntegrator
 
+##############################################################################
+# Globals
+##############################################################################
+
+# pieces of the OpenMM State XML format, used by OpenMMStateBuilder
+_POSITION_TEMPLATE = '\t\t<Position x="%.9g" y="%.9g" z="%.9g"/>\n'
+_BOX_TEMPLATE = ('\n\t\t<A x="%.9g" y="0" z="0"/>\n\t\t<B x="0" y="%.9g" z="0"/>'
+                 '\n\t\t<C x="0" y="0" z="%.9g"/>\n\t')
+
 ##############################################################################
 # Classes
 ##############################################################################
 
 class StateBuilder(object):
     __metaclass__ = abc.ABCMeta
+    # file extension for the serialized states
+    extension = None
 
     @abc.abstractmethod
     def build(self, trajectory):
@@ -35,8 +48,28 @@ class StateBuilder(object):
 
 class OpenMMStateBuilder(StateBuilder):
     """Build an OpenMM "state" that can be sent to a device to simulate.
+
+    The simulators only need the positions and box vectors (and the context
+    parameters) out of the state, so by default, we don't evaluate anything
+    with OpenMM per state. Instead, we serialize a state once, up front, to
+    use as a template, and then just fill in the coordinates from the mdtraj
+    trajectory each time a new state is built.
+
+    Parameters
+    ----------
+    system : simtk.openmm.System or str
+        The system, or the path to its XML serialization
+    integrator : simtk.openmm.Integrator or str, optional
+        The integrator, or the path to its XML serialization. This is only
+        needed because the OpenMM API requires one to create a Context.
+    use_context : bool, default=False
+        If True, build each state by setting the positions in a Reference
+        platform Context and calling getState(), which also evaluates the
+        forces and energy. This is much slower for large systems.
     """
-    def __init__(self, system, integrator=None):
+    extension = '.xml'
+
+    def __init__(self, system, integrator=None, use_context=False):
 
         # if strings are passed in, assume that they are paths to
         # xml files on disk
@@ -51,7 +84,15 @@ class OpenMMStateBuilder(StateBuilder):
             # this integrator isn't really necessary, but it has to be something
             # for the openmm API to let us serialize the state
             integrator = VerletIntegrator(2*femtoseconds)
+
+        self.use_context = use_context
+        self.n_particles = system.getNumParticles()
         self.context = Context(system, integrator, Platform.getPlatformByName('Reference'))
+        self._template = self._build_template()
+        if not self.use_context:
+            # we won't be needing this anymore, and its memory footprint
+            # is not small for big systems.
+            del self.context
 
     def build(self, trajectory):
         """Create a serialized XML state from the first frame in a trajectory
@@ -63,6 +104,24 @@ class OpenMMStateBuilder(StateBuilder):
             positions and the box vectors (if you're using periodic boundary
             conditions)
         """
+        if trajectory.n_atoms != self.n_particles:
+            raise ValueError('trajectory has %d atoms, but the system has %d '
+                             'particles' % (trajectory.n_atoms, self.n_particles))
+        if self.use_context:
+            return self._build_with_context(trajectory)
+
+        head, box, middle, tail = self._template
+        if trajectory.unitcell_vectors is not None:
+            a, b, c = trajectory.unitcell_lengths[0]
+            np.testing.assert_array_almost_equal(trajectory.unitcell_angles[0], np.ones(3)*90)
+            box = _BOX_TEMPLATE % (a, b, c)
+
+        # format all of the positions in one go. 9 significant digits is
+        # enough to round trip the float32 coordinates from mdtraj.
+        positions = (_POSITION_TEMPLATE * self.n_particles) % tuple(trajectory.xyz[0].ravel().tolist())
+        return ''.join([head, box, middle, positions, tail])
+
+    def _build_with_context(self, trajectory):
         periodic = False
         if trajectory.unitcell_vectors is not None:
             a, b, c = trajectory.unitcell_lengths[0]
@@ -76,10 +135,49 @@ class OpenMMStateBuilder(StateBuilder):
                                       getParameters=True, enforcePeriodicBox=periodic)
         return XmlSerializer.serialize(state)
 
+    def _build_template(self):
+        """Serialize a state from the context, and split it up around the
+        periodic box vectors and the positions, so that we can fill them
+        in later.
+
+        Returns
+        -------
+        head, box, middle, tail : str
+            The serialized state is head + box + middle + positions + tail.
+            `box` contains the system's default box vectors.
+        """
+        self.context.setPositions(np.zeros((self.n_particles, 3)) * nanometers)
+        state = self.context.getState(getPositions=True, getVelocities=True,
+                                      getParameters=True)
+        xml = XmlSerializer.serialize(state)
+
+        match = re.match(r'(.*<PeriodicBoxVectors>)(.*?)(</PeriodicBoxVectors>.*?<Positions>)'
+                         r'.*?(\s*</Positions>.*)', xml, re.DOTALL)
+        if match is None:
+            raise ValueError('Unrecognized OpenMM state XML format')
+        head, box, middle, tail = match.groups()
+        return head, box, middle + '\n', tail.lstrip('\r\n')
 
 class AmberStateBuilder(StateBuilder):
+    """Build an AMBER restart file that can be sent to a device to simulate.
+
+    Parameters
+    ----------
+    restart_format : {'inpcrd', 'ncrst'}
+        Write either ASCII inpcrd files, or AMBER NetCDF restart files. The
+        NetCDF files are smaller, and faster for pmemd to read. pmemd
+        detects the format automatically.
+    """
+    def __init__(self, restart_format='inpcrd'):
+        if restart_format not in ['inpcrd', 'ncrst']:
+            raise ValueError('restart_format must be one of "inpcrd" or '
+                             '"ncrst": %s' % restart_format)
+        self.restart_format = restart_format
+        self.extension = '.' + restart_format
+
     def build(self, trajectory):
-        """Create a serialized inpcrd from the first frame in a trajectory
+        """Create a serialized restart file from the first frame in a
+        trajectory
 
         Parameteters
         ------------
@@ -88,28 +186,81 @@ class AmberStateBuilder(StateBuilder):
             positions and the box vectors (if you're using periodic boundary
             conditions)
         """
+        if self.restart_format == 'ncrst':
+            return self._build_netcdf(trajectory)
+        return self._build_inpcrd(trajectory)
+
+    def _build_inpcrd(self, trajectory):
         buf = StringIO()
 
         print >>buf, str(datetime.datetime.now())
         print >>buf, '%5d' % trajectory.n_atoms
 
-        linecount = 0
-        for atom in range(trajectory.n_atoms):
-            for dim in range(3):
-                # need to convert from nm to angstroms by multiplying by ten
-                fmt = '%12.7f' % (10 * trajectory.xyz[0, atom, dim])
-                assert len(fmt) == 12, 'fmt overflowed writing inpcrd. blowup?'
-                buf.write(fmt)
-                linecount += 1
-                if linecount >= 6:
-                    buf.write(os.linesep)
-                    linecount = 0
-
-        if trajectory.unitcell_lengths != None:
-            if linecount != 0:
+        # need to convert from nm to angstroms by multiplying by ten.
+        # all of the coordinates get formatted in a single pass, six to
+        # a line.
+        xyz = (10 * trajectory.xyz[0]).ravel()
+        coordinates = ('%12.7f' * len(xyz)) % tuple(xyz.tolist())
+        if len(coordinates) != 12 * len(xyz):
+            raise ValueError('fmt overflowed writing inpcrd. blowup?')
+        buf.write(os.linesep.join([coordinates[i:i+72] for i in range(0, len(coordinates), 72)]))
+
+        complete_line = len(xyz) % 6 == 0
+        if complete_line and len(xyz) > 0:
+            buf.write(os.linesep)
+
+        if trajectory.unitcell_lengths is not None:
+            if not complete_line:
                 buf.write(os.linesep)
             box = (trajectory.unitcell_lengths[0]*10).tolist()
             box.extend(trajectory.unitcell_angles[0].tolist())
             buf.write(('%12.7f' * 6) % tuple(box))
-    
+
+        return buf.getvalue()
+
+    def _build_netcdf(self, trajectory):
+        """Create an AMBER NetCDF restart file, following the conventions at
+        http://ambermd.org/netcdf/nctraj.xhtml"""
+        buf = StringIO()
+        f = netcdf.netcdf_file(buf, 'w', version=2)
+
+        f.title = str(datetime.datetime.now())
+        f.application = 'AMBER'
+        f.program = 'MSMAccelerator'
+        f.programVersion = '2'
+        f.Conventions = 'AMBERRESTART'
+        f.ConventionVersion = '1.0'
+
+        f.createDimension('spatial', 3)
+        f.createDimension('atom', trajectory.n_atoms)
+        f.createDimension('cell_spatial', 3)
+        f.createDimension('cell_angular', 3)
+        f.createDimension('label', 5)
+
+        spatial = f.createVariable('spatial', 'c', ('spatial',))
+        spatial[:] = np.array(list('xyz'))
+
+        time = f.createVariable('time', 'd', ())
+        time.units = 'picosecond'
+        time[...] = 0.0
+
+        coordinates = f.createVariable('coordinates', 'd', ('atom', 'spatial'))
+        coordinates.units = 'angstrom'
+        coordinates[:] = 10 * trajectory.xyz[0]
+
+        if trajectory.unitcell_lengths is not None:
+            cell_spatial = f.createVariable('cell_spatial', 'c', ('cell_spatial',))
+            cell_spatial[:] = np.array(list('abc'))
+            cell_angular = f.createVariable('cell_angular', 'c', ('cell_angular', 'label'))
+            cell_angular[:] = np.array([list('alpha'), list('beta '), list('gamma')])
+
+            cell_lengths = f.createVariable('cell_lengths', 'd', ('cell_spatial',))
+            cell_lengths.units = 'angstrom'
+            cell_lengths[:] = 10 * trajectory.unitcell_lengths[0]
+            cell_angles = f.createVariable('cell_angles', 'd', ('cell_angular',))
+            cell_angles.units = 'degree'
+            cell_angles[:] = trajectory.unitcell_angles[0]
+
+        # netcdf_file.close() would close the buffer too
+        f.flush()
         return buf.getvalue()
@@ -0,0 +1,286 @@
+"""Instrumentation for the server: message counts, handler latencies, bytes
+on the wire, and the time spent in the different parts of the server (the
+sampler, the state builder, the database). Also, the throughput of the
+simulations, from the status reports that the simulators publish.
+
+The statistics can be queried from a live server with the `get_stats`
+message (see `accelerator interact --stats`), and optionally dumped
+periodically to a JSON file (see BaseServer.stats_file).
+"""
+##############################################################################
+# Imports
+##############################################################################
+
+import time
+import math
+import threading
+import contextlib
+
+##############################################################################
+# Classes
+##############################################################################
+
+
+class Histogram(object):
+    """Histogram of durations, with logarithmically spaced buckets.
+
+    The buckets are powers of two, starting at `min_value` seconds, so
+    that a single histogram can cover everything from microseconds to
+    minutes with a fixed (small) number of buckets.
+
+    Parameters
+    ----------
+    min_value : float
+        Upper edge of the first bucket, in seconds
+    n_buckets : int
+        Number of buckets. Values bigger than the last edge go in the
+        last bucket.
+    """
+    def __init__(self, min_value=1e-5, n_buckets=24):
+        self.min_value = min_value
+        self.edges = [min_value * 2**i for i in range(n_buckets)]
+        self.counts = [0] * n_buckets
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+
+    def add(self, value):
+        if value <= self.min_value:
+            i = 0
+        else:
+            i = int(math.ceil(math.log(value / self.min_value, 2)))
+            i = min(i, len(self.counts) - 1)
+        self.counts[i] += 1
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def percentile(self, q):
+        """Approximate percentile, `q` in [0, 100]. This is the upper edge of
+        the bucket that the percentile falls in, so it's an overestimate by
+        at most a factor of two."""
+        if self.count == 0:
+            return None
+        target = q / 100.0 * self.count
+        cumulative = 0
+        # the last bucket has no upper edge, since it holds the overflow
+        for edge, count in zip(self.edges[:-1], self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return min(edge, self.max)
+        return self.max
+
+    def to_dict(self):
+        if self.count == 0:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            # only the non-empty buckets, keyed by their upper edge
+            'buckets': dict(('%.3g' % e, c) for e, c in
+                            zip(self.edges, self.counts) if c > 0),
+        }
+
+
+class ServerStats(object):
+    """Counters and timers for the server.
+
+    All of the methods are protected by a lock, since they're called from
+    both the IOLoop and the worker threads.
+
+    Examples
+    --------
+    >>> stats = ServerStats()
+    >>> stats.received('register_OpenMMSimulator', 212)
+    >>> with stats.timer('sampler'):
+    ...     frame = sampler.select()
+    >>> stats.to_dict()['timers']['sampler']['count']
+    1
+    """
+    def __init__(self, fleet_window=300):
+        self._lock = threading.Lock()
+        self.start_time = time.time()
+        # number of messages waiting for a worker thread. this one is a
+        # gauge, not a counter, so it isn't cleared by reset()
+        self.queue_depth = 0
+        # job_id -> (time, ns/day) of the latest status report from each
+        # simulation. the ones older than fleet_window seconds are assumed
+        # to be finished (or dead). also a gauge.
+        self.fleet_window = fleet_window
+        self._fleet = {}
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # msg_type -> dict of counters
+            self.messages = {}
+            # msg_type -> Histogram, from when the message was received to
+            # when its handler returned (including time spent in the queue)
+            self.latency = {}
+            # name -> Histogram, for the timer() sections
+            self.timers = {}
+            # name -> int, for count()
+            self.counters = {}
+            self.bytes_in = 0
+            self.bytes_out = 0
+            self.max_queue_depth = self.queue_depth
+            self.reset_time = time.time()
+
+    def _message(self, msg_type):
+        if msg_type not in self.messages:
+            self.messages[msg_type] = {'received': 0, 'sent': 0, 'errors': 0,
+                                       'bytes_in': 0, 'bytes_out': 0}
+        return self.messages[msg_type]
+
+    def received(self, msg_type, n_bytes):
+        """Record an incoming message"""
+        with self._lock:
+            m = self._message(msg_type)
+            m['received'] += 1
+            m['bytes_in'] += n_bytes
+            self.bytes_in += n_bytes
+
+    def sent(self, msg_type, n_bytes):
+        """Record an outgoing message"""
+        with self._lock:
+            m = self._message(msg_type)
+            m['sent'] += 1
+            m['bytes_out'] += n_bytes
+            self.bytes_out += n_bytes
+
+    def handled(self, msg_type, seconds, error=False):
+        """Record that the handler for a message has finished, `seconds`
+        after the message was received"""
+        with self._lock:
+            if msg_type not in self.latency:
+                self.latency[msg_type] = Histogram()
+            self.latency[msg_type].add(seconds)
+            if error:
+                self._message(msg_type)['errors'] += 1
+
+    def enqueued(self):
+        with self._lock:
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+    def dequeued(self, seconds):
+        """A queued message was picked up by a worker, after waiting for
+        `seconds`"""
+        with self._lock:
+            self.queue_depth -= 1
+        self.add_time('queue_wait', seconds)
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            if name not in self.timers:
+                self.timers[name] = Histogram()
+            self.timers[name].add(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Context manager that records the time spent inside of it under
+        `name`, e.g. 'sampler', 'statebuilder' or 'database'"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def count(self, name, n=1):
+        """Increment a generic counter"""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def progress(self, job_id, ns_per_day):
+        """Record the speed of a simulation, from its status report"""
+        with self._lock:
+            self._fleet[job_id] = (time.time(), ns_per_day)
+
+    def _fleet_dict(self, now):
+        for job_id, (t, ns_per_day) in self._fleet.items():
+            if now - t > self.fleet_window:
+                del self._fleet[job_id]
+        speeds = [v for t, v in self._fleet.itervalues() if v is not None]
+        return {
+            'simulations': len(self._fleet),
+            'ns_per_day': sum(speeds),
+            'mean_ns_per_day': sum(speeds) / len(speeds) if len(speeds) > 0 else None,
+        }
+
+    def to_dict(self):
+        """All of the statistics, as a JSON-serializable dict"""
+        with self._lock:
+            now = time.time()
+            return {
+                'uptime': now - self.start_time,
+                'interval': now - self.reset_time,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'queue_depth': self.queue_depth,
+                'max_queue_depth': self.max_queue_depth,
+                'messages': dict((k, dict(v)) for k, v in self.messages.iteritems()),
+                'latency': dict((k, v.to_dict()) for k, v in self.latency.iteritems()),
+                'timers': dict((k, v.to_dict()) for k, v in self.timers.iteritems()),
+                'counters': dict(self.counters),
+                'fleet': self._fleet_dict(now),
+            }
+
+
+##############################################################################
+# Functions
+##############################################################################
+
+
+def format_stats(stats):
+    """Format the output of ServerStats.to_dict() as a human readable
+    table"""
+    lines = ['uptime: %.1f s, in: %d bytes, out: %d bytes, queue depth: %d (max %d)' % (
+        stats['uptime'], stats['bytes_in'], stats['bytes_out'],
+        stats['queue_depth'], stats['max_queue_depth'])]
+
+    def ms(value):
+        if value is None:
+            return '-'
+        return '%.2f' % (1000 * value)
+
+    lines.append('')
+    lines.append('%-28s %8s %8s %7s %10s %10s %10s %10s' % ('msg_type',
+        'received', 'sent', 'errors', 'mean (ms)', 'p50 (ms)', 'p99 (ms)',
+        'max (ms)'))
+    for msg_type in sorted(stats['messages']):
+        m = stats['messages'][msg_type]
+        h = stats['latency'].get(msg_type, {})
+        lines.append('%-28s %8d %8d %7d %10s %10s %10s %10s' % (msg_type,
+            m['received'], m['sent'], m['errors'], ms(h.get('mean')),
+            ms(h.get('p50')), ms(h.get('p99')), ms(h.get('max'))))
+
+    if len(stats['timers']) > 0:
+        lines.append('')
+        lines.append('%-28s %8s %10s %10s %10s %10s' % ('timer', 'count',
+            'total (s)', 'mean (ms)', 'p99 (ms)', 'max (ms)'))
+        for name in sorted(stats['timers']):
+            h = stats['timers'][name]
+            lines.append('%-28s %8d %10.2f %10s %10s %10s' % (name,
+                h['count'], h.get('total', 0), ms(h.get('mean')),
+                ms(h.get('p99')), ms(h.get('max'))))
+
+    fleet = stats.get('fleet', {})
+    if fleet.get('simulations', 0) > 0:
+        lines.append('')
+        lines.append('%d simulations reporting, %.1f ns/day total' % (
+            fleet['simulations'], fleet['ns_per_day']))
+
+    if len(stats['counters']) > 0:
+        lines.append('')
+        for name in sorted(stats['counters']):
+            lines.append('%-28s %8d' % (name, stats['counters'][name]))
+
+    return '\n'.join(lines)
@@ -0,0 +1,26 @@
+from msmaccelerator.server.clients import ClientTable
+
+
+def test_client_table():
+    clients = ClientTable(max_clients=2)
+    assert clients.track('a', 'a', 'json', 'r1') == (False, None)
+    # retried before we replied, from a new connection
+    assert clients.track('a', 'a.1', 'json', 'r1') == (True, None)
+    assert clients.route('a') == ('a.1', 'json')
+    assert clients.set_reply('a', 'r1', ('simulate', {}, None))
+    # only the first reply counts
+    assert not clients.set_reply('a', 'r1', ('other', {}, None))
+    assert clients.track('a', 'a.2', 'json', 'r1') == (True, ('simulate', {}, None))
+
+    # a new request
+    assert clients.track('a', 'a.2', 'json', 'r2') == (False, None)
+    assert not clients.set_reply('a', 'r1', ('simulate', {}, None))
+    # messages without a request_id are never retries
+    assert clients.track('b', 'b', 'msgpack') == (False, None)
+    assert clients.track('b', 'b', 'msgpack') == (False, None)
+
+    # the least recently heard from is forgotten
+    clients.track('c', 'c', 'json', 'r3')
+    assert len(clients) == 2
+    assert clients.route('a') is None
+    assert clients.route('b') == ('b', 'msgpack')
@@ -0,0 +1,75 @@
+import time
+from msmaccelerator.server.leases import LeaseTable
+
+
+def test_lease_table():
+    saved = []
+    leases = LeaseTable(timeout=0.2, save=saved.append)
+    a = leases.issue('simulator-a', 'a.xml')
+    b = leases.issue('simulator-b', 'b.xml')
+    assert len(leases) == 2
+
+    time.sleep(0.12)
+    assert leases.renew(a)
+    time.sleep(0.12)
+    # b missed its heartbeat
+    assert leases.expire() == [b]
+    assert not leases.renew(b)
+    assert leases.next_reissue() == ('b.xml', b, None)
+    assert leases.next_reissue() is None
+
+    assert leases.complete(a)
+    assert len(leases) == 0
+    assert [(row.job_id, row.status) for row in saved] == [
+        (a, 'active'), (b, 'active'), (b, 'expired'), (a, 'done')]
+    assert (leases.n_issued, leases.n_completed, leases.n_expired) == (2, 1, 1)
+
+
+def test_lease_checkpoints():
+    saved = []
+    leases = LeaseTable(timeout=0.1, save=saved.append)
+    a = leases.issue('simulator-a', 'a.xml', output='a.h5')
+    resume = {'checkpoint': {'protocol': 'localfs', 'path': 'a.chk'}, 'step': 500}
+    assert leases.renew(a, resume)
+    time.sleep(0.12)
+    assert leases.expire() == [a]
+    # handed out again with the checkpoint, and where it came from
+    starting_state, job_id, resume = leases.next_reissue()
+    assert (starting_state, job_id) == ('a.xml', a)
+    assert resume['step'] == 500
+    assert resume['output'] == {'protocol': 'localfs', 'path': 'a.h5'}
+    assert resume['trajectory_id'] == a
+    assert [(row.status, row.checkpoint, row.step) for row in saved] == [
+        ('active', None, None), ('active', 'a.chk', 500), ('expired', 'a.chk', 500)]
+
+    # the resumed job gets its own lease, in the same trajectory. the old
+    # simulator can't renew or complete it.
+    b = leases.issue('simulator-b', 'a.xml', 'b', resume, 'b.h5', resume['trajectory_id'])
+    assert b == 'b'
+    assert not leases.renew(a)
+    assert not leases.complete(a)
+    assert leases.renew(b, {'checkpoint': {'protocol': 'localfs', 'path': 'b.chk'},
+                            'step': 800})
+    assert (saved[-1].job_id, saved[-1].output, saved[-1].trajectory_id) == ('b', 'b.h5', a)
+
+    # and it can be restored from the database
+    restored = LeaseTable()
+    restored.restore([saved[-1]])
+    assert restored.leases['b'][4]['output']['path'] == 'b.h5'
+    assert restored.leases['b'][4]['trajectory_id'] == a
+
+
+def test_lease_job_id():
+    saved = []
+    leases = LeaseTable(save=saved.append)
+    # the server picks the job_id first, to name the job's files after it
+    assert leases.issue('simulator-a', 'job-1.xml', 'job-1') == 'job-1'
+    # one simulator, several jobs
+    assert leases.issue('simulator-a', 'job-2.xml', 'job-2') == 'job-2'
+    assert sorted(leases.leases) == ['job-1', 'job-2']
+    assert leases.complete('job-1')
+    assert not leases.complete('job-1')
+    assert leases.renew('job-2')
+    assert [(row.job_id, row.sender_id, row.status) for row in saved] == [
+        ('job-1', 'simulator-a', 'active'), ('job-2', 'simulator-a', 'active'),
+        ('job-1', 'simulator-a', 'done')]
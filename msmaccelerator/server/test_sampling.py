@@ -0,0 +1,35 @@
+import numpy as np
+import scipy.sparse
+
+from msmaccelerator.server.sampling import timescale_variance_contributions
+
+
+def test_timescale_variance():
+    random = np.random.RandomState(0)
+    n = 20
+    counts = random.rand(n, n) * (random.rand(n, n) < 0.3)
+    counts = counts + counts.T + np.eye(n)
+    t_matrix = counts / counts.sum(axis=1)[:, np.newaxis]
+    populations = counts.sum(axis=1) / counts.sum()
+    row_counts = random.randint(1, 100, size=n).astype(float)
+
+    # explicit computation, with the full Dirichlet covariance of each row
+    values, right = np.linalg.eig(t_matrix)
+    left_values, left = np.linalg.eig(t_matrix.T)
+    right = np.real(right[:, np.argsort(-np.real(values))])
+    left = np.real(left[:, np.argsort(-np.real(left_values))])
+    values = np.sort(np.real(values))[::-1]
+
+    correct = np.zeros(n)
+    for k in [1, 2]:
+        dtdl = 1.0 / (values[k] * np.log(values[k])**2)
+        for i in range(n):
+            s = left[i, k] * right[:, k] / np.dot(left[:, k], right[:, k])
+            p = t_matrix[i]
+            cov = (np.diag(p) - np.outer(p, p)) / (row_counts[i] + 1)
+            correct[i] += dtdl**2 * np.dot(s, np.dot(cov, s))
+
+    for pops in [None, populations]:
+        got, _ = timescale_variance_contributions(scipy.sparse.csr_matrix(t_matrix),
+            row_counts, n_timescales=2, populations=pops)
+        np.testing.assert_array_almost_equal(got / correct, np.ones(n))
@@ -0,0 +1,42 @@
+import time
+from msmaccelerator.server.scheduling import ModelScheduler
+
+
+def frames(n):
+    return lambda model_last_id: n
+
+
+def test_model_scheduler():
+    scheduler = ModelScheduler(frames_threshold=100, build_timeout=3600)
+    assert scheduler.request('a', last_id=0, count_new_frames=frames(0)) is not None
+    assert scheduler.request('a', last_id=5, count_new_frames=frames(50)) is not None
+    assert scheduler.request('a', last_id=10, count_new_frames=frames(100)) is None
+    # coalesced with the build that's running
+    assert scheduler.request('b', last_id=11, count_new_frames=frames(110)) is not None
+    assert scheduler.finish('a', 10)
+    assert scheduler.model_last_id == 10
+    assert scheduler.request('b', last_id=10, count_new_frames=frames(1000)) is not None
+
+
+def test_model_scheduler_superseded():
+    scheduler = ModelScheduler(frames_threshold=0, build_timeout=0)
+    assert scheduler.request('slow', last_id=10, count_new_frames=frames(1)) is None
+    time.sleep(0.01)
+    # the first build has timed out
+    assert scheduler.request('fast', last_id=20, count_new_frames=frames(1)) is None
+    assert scheduler.n_expired == 1
+    assert scheduler.finish('fast', 20)
+    assert not scheduler.finish('slow', 10)
+    assert scheduler.model_last_id == 20
+
+
+def test_model_scheduler_counts_since_current_model():
+    scheduler = ModelScheduler(frames_threshold=100)
+    # 60 frames in each of the trajectories 1-5
+    count = lambda model_last_id: 60 * (5 - model_last_id)
+    assert scheduler.request('a', last_id=3, count_new_frames=count) is None
+    assert scheduler.finish('a', 3)
+    # only 120 frames since the model of trajectories 1-3
+    assert scheduler.request('b', last_id=5, count_new_frames=count) is None
+    assert scheduler.finish('b', 5)
+    assert scheduler.request('c', last_id=5, count_new_frames=count) is not None
@@ -1,6 +1,10 @@
 import os
 
-from msmaccelerator.server.statebuilder import AmberStateBuilder
+import numpy as np
+from cStringIO import StringIO
+from scipy.io import netcdf
+from simtk.openmm import System, XmlSerializer
+from msmaccelerator.server.statebuilder import AmberStateBuilder, OpenMMStateBuilder
 import mdtraj as md
 from mdtraj.testing import get_fn
 
@@ -27,6 +31,34 @@ def test_amber():
     assert os.linesep.join(got.splitlines()[1:]) == correct
 
 
-    
-    
+def test_amber_netcdf():
+    t = md.load(get_fn('native2.pdb'))
+
+    builder = AmberStateBuilder('ncrst')
+    f = netcdf.netcdf_file(StringIO(builder.build(t)), 'r')
+
+    assert f.Conventions == 'AMBERRESTART'
+    np.testing.assert_array_almost_equal(f.variables['coordinates'][:], 10 * t.xyz[0], decimal=5)
+    np.testing.assert_array_almost_equal(f.variables['cell_lengths'][:], 10 * t.unitcell_lengths[0], decimal=5)
+    np.testing.assert_array_almost_equal(f.variables['cell_angles'][:], t.unitcell_angles[0])
+
+
+def test_openmm_template():
+    t = md.load(get_fn('native2.pdb'))
+    system = System()
+    for i in range(t.n_atoms):
+        system.addParticle(1.0)
+
+    template = OpenMMStateBuilder(system).build(t)
+    reference = OpenMMStateBuilder(system, use_context=True).build(t)
+
+    state = XmlSerializer.deserialize(template)
+    np.testing.assert_array_almost_equal(
+        state.getPositions(asNumpy=True)._value, t.xyz[0], decimal=6)
 
+    # the context-based builder wraps the positions into the box, so only
+    # the box vectors are directly comparable
+    for xml in [template, reference]:
+        state = XmlSerializer.deserialize(xml)
+        np.testing.assert_array_almost_equal(
+            state.getPeriodicBoxVectors(asNumpy=True)._value, np.diag(t.unitcell_lengths[0]))
@@ -0,0 +1,60 @@
+from msmaccelerator.server.stats import Histogram, ServerStats, format_stats
+
+
+def test_histogram():
+    h = Histogram(min_value=1e-3, n_buckets=4)
+    for value in [1e-4, 1e-3, 1.5e-3, 3e-3, 100]:
+        h.add(value)
+    # edges are 1, 2, 4, 8 ms, and the last bucket also holds the overflow
+    assert h.counts == [2, 1, 1, 1]
+    assert h.count == 5
+    assert h.max == 100
+    assert h.percentile(50) == 2e-3
+    assert h.percentile(100) == 100
+
+
+def test_server_stats():
+    stats = ServerStats()
+    stats.received('register_OpenMMSimulator', 100)
+    stats.sent('simulate', 50)
+    stats.handled('register_OpenMMSimulator', 0.01)
+    stats.handled('register_OpenMMSimulator', 0.02, error=True)
+    with stats.timer('sampler'):
+        pass
+    stats.enqueued()
+    stats.enqueued()
+    stats.dequeued(0.1)
+    stats.count('invalid_messages')
+
+    d = stats.to_dict()
+    assert d['bytes_in'] == 100
+    assert d['bytes_out'] == 50
+    assert d['queue_depth'] == 1
+    assert d['max_queue_depth'] == 2
+    assert d['messages']['register_OpenMMSimulator']['errors'] == 1
+    assert d['latency']['register_OpenMMSimulator']['count'] == 2
+    assert d['timers']['sampler']['count'] == 1
+    assert d['timers']['queue_wait']['count'] == 1
+    assert d['counters'] == {'invalid_messages': 1}
+    # smoke test
+    format_stats(d)
+
+    stats.reset()
+    assert stats.to_dict()['messages'] == {}
+
+
+def test_fleet():
+    stats = ServerStats(fleet_window=60)
+    stats.progress('a', 10.0)
+    stats.progress('b', 30.0)
+    # the first report from a simulation doesn't have a speed yet
+    stats.progress('c', None)
+    fleet = stats.to_dict()['fleet']
+    assert fleet['simulations'] == 3
+    assert fleet['ns_per_day'] == 40.0
+    assert fleet['mean_ns_per_day'] == 20.0
+
+    # a simulation that stopped reporting is dropped
+    stats._fleet['a'] = (stats._fleet['a'][0] - 120, 10.0)
+    assert stats.to_dict()['fleet']['simulations'] == 2
+    assert 'simulations reporting' in format_stats(stats.to_dict())
@@ -6,17 +6,25 @@ structure, and then propagate.
 ##############################################################################
 
 import os
+import re
+import time
 import shutil
+import tempfile
 import subprocess
-from os.path import join, basename, relpath, splitext, isfile, abspath, exists
+from multiprocessing.pool import ThreadPool
+from os.path import join, splitext, isfile, abspath
 
 from ..core.traitlets import FilePath
-from IPython.utils.traitlets import Unicode, Enum, CBytes
+from IPython.utils.traitlets import Unicode, Enum, CBytes, Int, Bool
+import numpy as np
+from mdtraj.formats import AmberNetCDFRestartFile, AmberRestartFile
 
 
 # local
-from ..core.utils import cd_context
 from ..core.device import Device
+from ..core.message import Message
+from .resume import checkpoint_filename, can_resume, join_frames, join_resumed
+from .sanity import prmtop_bonds, check_bonds
 
 #############################################################################
 # Classes
@@ -33,14 +41,35 @@ class AmberSimulator(Device):
     mdin = FilePath(config=True, exists=True, isfile=True,
         help="""AMBER .in file controlling the production run. If no production is
         desired, do not set this parameter.""")
-    workdir = CBytes(config=True, help="""Directory to work in. If not set,
-        we'll requirest a temporary directory from the OS and clean it up
-        when we're finished. This option is useful for debugging.""")
+    workdir = CBytes(config=True, help="""Directory to make the scratch
+        directories for the jobs in, ideally on storage that's local to the
+        node. Each job runs in its own uniquely named directory, so several
+        devices can share this. If not set, the system's temporary directory
+        is used (see the TMPDIR environment variable). The scratch directory
+        of a job is removed when it's done, unless it fails, which is
+        useful for debugging. The trajectory is staged out to the output
+        path at each checkpoint too, so that the job can be resumed on
+        another node.""")
     executable = Enum(['pmemd', 'pmemd.cuda', 'pmemd.cuda.MPI'], config=True,
         default_value='pmemd', help="Which AMBER executable to use?")
     precommand = Unicode(u'', config=True, help="Something to run before the command, like mpirun")
     prmtop = FilePath(config=True, exists=True, isfile=True,
                       help="""Parameter/topology file for the system""")
+    n_runs = Int(1, config=True, help="""Number of AMBER processes to run at
+        once. With more than one, we ask the server for a batch of this many
+        jobs, and run them concurrently, e.g. one per group of cores on a
+        CPU node.""")
+    worker_loop = Bool(False, config=True, help="""Keep going instead of
+        exiting after the first job (or batch of n_runs jobs): whenever one
+        of the AMBER processes finishes, ask the server for another job to
+        run in its place, so that none of the cores sit idle while the
+        others finish.""")
+    max_jobs = Int(0, config=True, help="""In the worker loop mode, exit
+        after this many jobs. If zero, keep going until killed.""")
+    cpus_per_run = Int(0, config=True, help="""If nonzero, pin each of the
+        concurrent AMBER processes to its own group of this many cores (with
+        taskset), so that they don't compete for the same ones. The i-th
+        process gets cores i*cpus_per_run to (i+1)*cpus_per_run - 1.""")
 
     amber_home = FilePath(exists=True, isdir=True, help='Home directory for AMBER installation')
     def _amber_home_default(self):
@@ -51,61 +80,426 @@ class AmberSimulator(Device):
     aliases = dict(mdin='AmberSimulator.mdin',
                    precommand='AmberSimulator.precommand',
                    prmtop='AmberSimulator.prmtop',
+                   workdir='AmberSimulator.workdir',
+                   n_runs='AmberSimulator.n_runs',
+                   cpus_per_run='AmberSimulator.cpus_per_run',
+                   worker_loop='AmberSimulator.worker_loop',
+                   max_jobs='AmberSimulator.max_jobs',
                    zmq_port='Device.zmq_port',
                    zmq_url='Device.zmq_url',
                    executable='AmberSimulator.executable')
 
     def start(self):
+        # threads that copy the inputs into the scratch directories, and the
+        # outputs back out, while the dynamics run
+        self._staging_pool = ThreadPool(max(2, self.n_runs))
+        self._bonds = prmtop_bonds(self.prmtop)
         super(AmberSimulator, self).start()
 
 
     def error(self, msg):
         self.log.error(msg)
         self.exit(1)
-        
+
+    def registration_content(self):
+        if self.n_runs > 1:
+            # ask for a batch of starting states
+            return {'n_walkers': self.n_runs}
+        return None
+
     def on_startup_message(self, msg):
         """This method is called when the device receives its startup message
         from the server.
         """
 
-        assert msg.header.msg_type in ['simulate']  # only allowed RPC
+        assert msg.header.msg_type in ['simulate', 'simulate_batch']  # only allowed RPC
         return getattr(self, msg.header.msg_type)(msg.header, msg.content)
 
     def simulate(self, header, content):
-        """Run the simulation in subprocesses to invoke the AMBER binaries"""
+        """Run the simulation in subprocesses to invoke the AMBER binaries
+
+        This also handles the msg_type == 'simulate_batch' message, which the
+        server sends when we've asked for more than one job (n_runs). Its
+        content is a list of jobs, each of which looks like the content of a
+        'simulate' message.
+        """
+        if header.msg_type == 'simulate_batch':
+            jobs = [Message(job) for job in content.jobs]
+        else:
+            jobs = [content]
+        self.run_jobs(jobs)
+
+    simulate_batch = simulate
+
+    def run_jobs(self, jobs):
+        """Run AMBER on a list of jobs, at most n_runs at a time, and tell the
+        server about each of them as soon as it's done.
+
+        Each job runs in its own scratch directory (see prepare()). Its
+        inputs are staged in by a staging thread, and it's started as soon
+        as they're there. When it finishes, its trajectory is staged out by
+        a staging thread too, while the other runs keep going. All of the
+        messages to the server are sent from this thread.
+
+        In the worker loop mode, each job that leaves its slot (or fails to
+        be set up) is replaced by a new one from the server (see
+        request_job()), until max_jobs have been run.
+
+        A job that fails isn't reported, so its lease expires, and its
+        starting state is handed out again. Once the others are done, the
+        first error is raised.
+        """
+        with open(self.mdin) as f:
+            mdin_text = f.read()
+
+        staging_in = [self._staging_pool.apply_async(self.prepare, (job, mdin_text))
+                      for job in jobs]
+        n_jobs = len(jobs)
+        # number of jobs to ask the server for, to replace the ones that
+        # are done (or failed)
+        n_replace = 0
+        free_slots = range(self.n_runs)
+        # slot -> AmberRun
+        running = {}
+        # (AmberRun, AsyncResult) of the runs being staged out
+        staging_out = []
+        errors = []
+
+        while len(staging_in) + len(running) + len(staging_out) > 0:
+            for result in [r for r in staging_in if r.ready()]:
+                if len(free_slots) == 0:
+                    break
+                staging_in.remove(result)
+                try:
+                    run = result.get()
+                except Exception as e:
+                    self.log.error('Unable to set up job: %s', e)
+                    errors.append(e)
+                    n_replace += 1
+                    continue
+                slot = free_slots.pop(0)
+                self.launch(run, slot)
+                running[slot] = run
+
+            for slot, run in running.items():
+                if run.process.poll() is None:
+                    self.heartbeat(run.job_id)
+                    self.poll_checkpoint(run)
+                    continue
+                del running[slot]
+                free_slots.append(slot)
+                n_replace += 1
+                if run.process.returncode != 0:
+                    self.log.error('AMBER failed on job %s, with exit code %d. '
+                                   'See its scratch directory, %s', run.job_id,
+                                   run.process.returncode, run.scratch)
+                    errors.append(subprocess.CalledProcessError(
+                        run.process.returncode, run.cmd))
+                    continue
+                staging_out.append((run, self._staging_pool.apply_async(self.finish, (run,))))
 
+            for run, result in [item for item in staging_out if item[1].ready()]:
+                staging_out.remove((run, result))
+                try:
+                    result.get()
+                except Exception as e:
+                    self.log.error('Unable to stage out job %s: %s', run.job_id, e)
+                    errors.append(e)
+                    continue
+                self.send_recv(msg_type='simulation_done', content={
+                    'status': 'success',
+                    'job_id': run.job_id,
+                    'output': {
+                        'protocol': 'localfs',
+                        'path': run.content.output.path
+                    }
+                })
+
+            while n_replace > 0 and self.worker_loop and (
+                    self.max_jobs == 0 or n_jobs < self.max_jobs):
+                job = self.request_job()
+                staging_in.append(self._staging_pool.apply_async(self.prepare, (job, mdin_text)))
+                n_jobs += 1
+                n_replace -= 1
+
+            time.sleep(1)
+
+        if len(errors) > 0:
+            raise errors[0]
+
+    def request_job(self):
+        """Ask the server for one more job, while the others are running.
+        Returns the content of its simulate message."""
+        msg = self.send_recv(msg_type='register_%s' % self.__class__.__name__,
+                             content={'n_walkers': 1})
+        assert msg.header.msg_type == 'simulate_batch'  # only allowed RPC
+        return Message(msg.content.jobs[0])
+
+    def prepare(self, content, mdin_text):
+        """Make the scratch directory for a job, and stage its inputs into it.
+        This runs in a staging thread, so it doesn't talk to the server.
+
+        Returns
+        -------
+        run : AmberRun
+        """
         if content.starting_state.protocol == 'localfs':
-            if not content.starting_state.path.endswith('.inpcrd'):
-                raise ValueError('starting state must have inpcrd extension. '
+            if splitext(content.starting_state.path)[1] not in ['.inpcrd', '.ncrst']:
+                raise ValueError('starting state must have inpcrd or ncrst extension. '
                                  'did you start server in amber mode? '
                                  'starting_state.path=%s' % content.starting_state.path)
         else:
             raise NotImplementedError('Only localfs transport is currently '
                                       'supported.')
 
+        run = AmberRun(content, tempfile.mkdtemp(prefix='amber-', dir=self.workdir or None))
+        run.dt = float(mdin_value(mdin_text, 'dt', 0.001))
+        run.nstlim = int(mdin_value(mdin_text, 'nstlim', 1))
+        run.ntwx = int(mdin_value(mdin_text, 'ntwx', 0))
+
+        inpcrd = abspath(content.starting_state.path)
+        if 'resume' in content and run.job_id is not None:
+            run.start_step = self.check_resume(content.resume, run.ntwx)
+        if run.start_step > 0:
+            # continue from the checkpoint, with its velocities, for the
+            # rest of the steps. the new frames are joined onto the ones
+            # from before the checkpoint, in our output trajectory, at each
+            # of our own checkpoints and when we're done
+            inpcrd = content.resume.checkpoint.path
+            mdin_text = set_mdin_values(mdin_text, nstlim=run.nstlim - run.start_step,
+                                        irest=1, ntx=5)
+        else:
+            self.sanity_check(inpcrd)
+        run.start_time = restart_time(inpcrd)
+
+        with open(run.mdin, 'w') as f:
+            f.write(mdin_text)
+        shutil.copy(self.prmtop, run.prmtop)
+        shutil.copy(inpcrd, run.inpcrd)
+        return run
+
+    def launch(self, run, slot):
+        """Start AMBER on a job, in its scratch directory. `slot` (from 0 to
+        n_runs - 1) picks the group of cores that it's pinned to, if
+        cpus_per_run is set."""
         template = '{precommand} {binary} -O -i {mdin} -o {mdout} -p {prmtop} -c {inpcrd} -r {restart} -x {traj}'
+        run.cmd = template.format(binary=join(self.amber_home, 'bin', self.executable),
+                                  mdin=run.mdin, mdout=run.mdout, prmtop=run.prmtop,
+                                  inpcrd=run.inpcrd, restart=run.restart,
+                                  precommand=self.precommand, traj=run.traj).split()
+        if self.cpus_per_run > 0:
+            first = slot * self.cpus_per_run
+            run.cmd = ['taskset', '-c', '%d-%d' % (first, first + self.cpus_per_run - 1)] + run.cmd
+
+        self.log.info('Executing Command: %s' % run.cmd)
+        # the other files that AMBER writes (mdinfo, logfile) go in the
+        # scratch directory too
+        with open(os.devnull, 'w') as devnull:
+            run.process = subprocess.Popen(run.cmd, stdout=devnull, cwd=run.scratch)
+
+    def poll_checkpoint(self, run):
+        """Save a copy of the restart file of a running job as its checkpoint,
+        whenever AMBER writes a new one (every ntwr steps)"""
+        if run.job_id is None or not isfile(run.restart):
+            return
+        mtime = os.path.getmtime(run.restart)
+        if mtime != run.restart_mtime:
+            if self.save_checkpoint(run):
+                run.restart_mtime = mtime
+
+    def finish(self, run):
+        """Stage the trajectory of a finished job out of its scratch
+        directory, to its output path, and remove the scratch directory.
+        This runs in a staging thread."""
+        if run.start_step > 0:
+            # the frames from before the checkpoint are in the trajectory
+            # of the job that saved it
+            join_resumed(abspath(run.content.resume.output.path), run.traj,
+                         run.start_step // run.ntwx if run.ntwx > 0 else 0,
+                         topology=self.prmtop, output=run.output)
+        else:
+            # copy to a temporary file and then rename it, so that the
+            # server never sees a half written trajectory
+            root, ext = splitext(run.output)
+            shutil.copy(run.traj, root + '.tmp' + ext)
+            os.rename(root + '.tmp' + ext, run.output)
+        shutil.rmtree(run.scratch)
+
+    def sanity_check(self, inpcrd):
+        """Check that the bonded atoms are close by in space in a starting
+        structure. The bonds are read from the prmtop once, in start(), and
+        reused for all of the jobs."""
+        check_bonds(restart_coordinates(inpcrd), self._bonds)
+
+    def check_resume(self, resume, ntwx):
+        """Check whether a job can be resumed from its last checkpoint
+
+        Returns
+        -------
+        start_step : int
+            The step to continue from, or 0 if the job has to be started
+            over.
+        """
+        step = resume.step
+        n_frames = step // ntwx if ntwx > 0 else 0
+        if not isfile(resume.checkpoint.path) or \
+                not can_resume(resume.output.path, n_frames, topology=self.prmtop):
+            self.log.warning('Unable to resume from checkpoint %s. Starting '
+                             'over.', resume.checkpoint.path)
+            return 0
+        self.log.info('Resuming from checkpoint %s, at step %d',
+                      resume.checkpoint.path, step)
+        return step
+
+    def save_checkpoint(self, run):
+        """Copy the restart file written by pmemd for a running job to the
+        checkpoint next to its output trajectory, stage the frames from
+        before it out to the output trajectory (see stage_frames()), and
+        tell the server about it.
+
+        Returns
+        -------
+        saved : bool
+            False if the restart file or the frames couldn't be read, e.g.
+            because pmemd is in the middle of writing them. We'll try again
+            later.
+        """
+        checkpoint_fn = checkpoint_filename(run.output, '.rst')
+        shutil.copy(run.restart, checkpoint_fn + '.tmp')
+        try:
+            t = restart_time(checkpoint_fn + '.tmp')
+        except Exception:
+            os.unlink(checkpoint_fn + '.tmp')
+            return False
+        step = run.start_step + int(round((t - run.start_time) / run.dt))
+        if step <= run.start_step or step >= run.nstlim:
+            # nothing new, or the final restart file
+            os.unlink(checkpoint_fn + '.tmp')
+            return True
+        try:
+            self.stage_frames(run, step)
+        except Exception as e:
+            self.log.debug('Unable to stage out the frames of job %s: %s',
+                           run.job_id, e)
+            os.unlink(checkpoint_fn + '.tmp')
+            return False
+        os.rename(checkpoint_fn + '.tmp', checkpoint_fn)
+        self.checkpoint(run.job_id, checkpoint_fn, step)
+        return True
+
+    def stage_frames(self, run, step):
+        """Save the frames of a running job from before `step` to its output
+        path, including the ones from before the checkpoint that it was
+        resumed from (if it was), so that a job resumed from a checkpoint at
+        `step` can find all of them on the shared filesystem, even though
+        AMBER writes to the scratch directory.
+
+        Raises an IOError if AMBER hasn't written all of them yet.
+        """
+        if run.ntwx == 0:
+            return
+        pieces = [(run.traj, (step - run.start_step) // run.ntwx)]
+        if run.start_step > 0:
+            pieces.insert(0, (abspath(run.content.resume.output.path),
+                              run.start_step // run.ntwx))
+        if sum(n_frames for fn, n_frames in pieces) > 0:
+            join_frames(pieces, run.output, topology=self.prmtop)
+
+
+class AmberRun(object):
+    """A single AMBER job, in its own scratch directory. All of the paths are
+    absolute, so nothing depends on the working directory of the device.
+
+    Parameters
+    ----------
+    content : Message
+        The job, as sent by the server
+    scratch : str
+        The scratch directory
+    """
+    def __init__(self, content, scratch):
+        self.content = content
+        # our lease on this job, which we renew with heartbeats
+        self.job_id = content.job_id if 'job_id' in content else None
+        self.output = abspath(content.output.path)
+        self.scratch = scratch
+        self.mdin = join(scratch, 'mdin')
+        self.mdout = join(scratch, 'mdout')
+        self.prmtop = join(scratch, 'prmtop')
+        self.inpcrd = join(scratch, 'inpcrd')
+        self.restart = join(scratch, 'restart')
+        self.traj = join(scratch, 'traj' + splitext(self.output)[1])
+        # the step that we're starting from (nonzero if it's being resumed
+        # from a checkpoint), and its time, in picoseconds
+        self.start_step = 0
+        self.start_time = 0.0
+        # from the mdin file
+        self.dt, self.nstlim, self.ntwx = None, None, None
+        self.cmd = None
+        self.process = None
+        # mtime of the last restart file that we saved as a checkpoint
+        self.restart_mtime = None
+
+
+#############################################################################
+# Utilities
+##############################################################################
+
+def mdin_value(text, name, default=None):
+    """Get the value of a variable from the text of an AMBER mdin file, or
+    `default` if it isn't set"""
+    match = re.search(r'\b%s\s*=\s*([^,\s/]+)' % name, text)
+    if match is None:
+        return default
+    return match.group(1)
+
+
+def set_mdin_values(text, **values):
+    """Set the values of variables in the text of an AMBER mdin file. The
+    ones that aren't there already are added to the &cntrl namelist."""
+    for name, value in values.items():
+        pattern = r'\b%s\s*=\s*[^,\s/]+' % name
+        if re.search(pattern, text):
+            text = re.sub(pattern, '%s=%s' % (name, value), text)
+        else:
+            text = re.sub(r'&cntrl\b', '&cntrl\n  %s=%s,' % (name, value), text, count=1)
+    return text
+
+
+def restart_time(path):
+    """The simulation time, in picoseconds, in an AMBER restart (or inpcrd)
+    file, either ASCII or NetCDF. Zero if the file doesn't contain one."""
+    with open(path, 'rb') as f:
+        magic = f.read(3)
+    if magic == 'CDF':
+        f = AmberNetCDFRestartFile(path, 'r')
+        try:
+            t = f.read()[1]
+        finally:
+            f.close()
+        return 0.0 if t is None else float(np.ravel(t)[0])
+
+    # the title, and then the number of atoms and (optionally) the time
+    with open(path) as f:
+        f.readline()
+        fields = f.readline().split()
+    return float(fields[1]) if len(fields) > 1 else 0.0
+
 
-        # RUNNING PRODUCTION
-        with cd_context('amber_workdir', logger=self.log):
-            base = splitext(basename(self.mdin))[0]
-            binary = join(self.amber_home, 'bin', self.executable)
-            mdout = base + '.out'
-            restart = base + '.restart'
-            traj = base + '.nc'
-            cmd = template.format(binary=binary, mdin=relpath(self.mdin),
-                                  mdout=mdout, prmtop=relpath(self.prmtop),
-                                  inpcrd=relpath(content.starting_state.path),
-                                  restart=restart, precommand=self.precommand,
-                                  traj=relpath(content.output.path)).split()
-            self.log.info('Executing Command: %s' % cmd)
-            subprocess.check_output(cmd)
-        
-
-        self.send_recv(msg_type='simulation_done', content={
-            'status': 'success',
-            'output': {
-                'protocol': 'localfs',
-                'path': content.output.path
-            }
-        })
+def restart_coordinates(path):
+    """The coordinates, in nanometers, in an AMBER restart (or inpcrd) file,
+    either ASCII or NetCDF.
 
+    Returns
+    -------
+    xyz : np.ndarray, shape=[n_atoms, 3]
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(3)
+    f = (AmberNetCDFRestartFile if magic == 'CDF' else AmberRestartFile)(path, 'r')
+    try:
+        xyz = f.read()[0]
+    finally:
+        f.close()
+    # the files are in angstroms
+    return xyz[0] / 10.0
@@ -1,6 +1,10 @@
 """An OpenMM reporter that passes off the current report, as a dict, to a
 callback. We can use this to publish the report over a socket instead of
 printing it to stdout.
+
+Also, an HDF5 trajectory file that stores the coordinates with reduced
+precision, so that they compress better, and a trajectory reporter that
+writes the frames in batches, from a background thread.
 """
 #############################################################################
 # Imports
@@ -8,6 +12,16 @@ printing it to stdout.
 
 from __future__ import division
 import os
+import math
+import time
+import Queue
+import threading
+import numpy as np
+import mdtraj as md
+from mdtraj.formats import HDF5TrajectoryFile
+from mdtraj.utils import box_vectors_to_lengths_and_angles
+import simtk.openmm as mm
+import simtk.unit as units
 # note this code requires openmm 5.1, in which StateDataReporter was
 # refactored for easier subclassing
 from simtk.openmm.app import StateDataReporter
@@ -18,14 +32,46 @@ from simtk.openmm.app import StateDataReporter
 
 
 class CallbackReporter(StateDataReporter):
-    def __init__(self, reportCallback, reportInterval, total_steps=None, **kwargs):
+    """Reporter that passes each report to a callback, as a dict.
+
+    Parameters
+    ----------
+    reportCallback : callable
+        Called with the report
+    reportInterval : int
+        The interval (in steps) at which to report
+    total_steps : int, optional
+        The total number of steps, used to report the progress
+    min_interval : float, optional
+        Minimum interval, in seconds, between reports. The reports that
+        would come sooner than that are skipped, without asking OpenMM to
+        compute the energies for them.
+    """
+    def __init__(self, reportCallback, reportInterval, total_steps=None,
+                 min_interval=0, **kwargs):
         super(CallbackReporter, self).__init__(os.devnull, reportInterval, **kwargs)
 
         self.total_steps = total_steps
         self.reportCallback = reportCallback
         self.headers = None
+        self.min_interval = min_interval
+        self._last_report = 0
+        self._skip = False
+
+    def describeNextReport(self, simulation):
+        description = super(CallbackReporter, self).describeNextReport(simulation)
+        # decide now whether we'll skip the next report, so that we don't
+        # ask for anything that we don't need
+        self._skip = time.time() - self._last_report < self.min_interval
+        if self._skip:
+            return (description[0], False, False, False, False)
+        return description
 
     def report(self, simulation, state):
+        if self._skip:
+            return
+        self._last_report = time.time()
+
         if not self._hasInitialized:
             self._initializeConstants(simulation)
             self.headers = self._constructHeaders()
@@ -45,3 +91,232 @@ class CallbackReporter(StateDataReporter):
             
 
         self.reportCallback(content)
+
+
+class BufferedHDF5Reporter(object):
+    """OpenMM reporter that saves the trajectory to an HDF5 file, like
+    mdtraj's HDF5Reporter, but without blocking the dynamics on the disk.
+
+    Each report is copied into a preallocated buffer of `buffer_size`
+    frames. When the buffer is full, it's handed to a background thread,
+    which writes all of its frames to the file at once, while the next
+    frames are collected in a second buffer. The dynamics only wait for
+    the disk if the writer falls a whole buffer behind.
+
+    Parameters
+    ----------
+    file : str
+        Path to the HDF5 file
+    reportInterval : int
+        The interval (in steps) at which to save frames
+    buffer_size : int
+        Number of frames in each buffer
+    atomSubset : list of int, optional
+        Only save these atoms
+    precision : float, optional
+        If nonzero, round the coordinates. See quantize().
+    append : bool, optional
+        Append the frames to the trajectory, if it exists, e.g. for a
+        simulation that's being resumed. It must have been saved with the
+        same atoms and fields (see resume.copy_hdf5_frames()). If it doesn't
+        exist, it's created.
+    """
+    def __init__(self, file, reportInterval, buffer_size=100, atomSubset=None,
+                 precision=0, append=False):
+        self._reportInterval = reportInterval
+        self.buffer_size = buffer_size
+        self.atomSubset = atomSubset
+        self.precision = precision
+        self.append = append and os.path.exists(file)
+        self._traj_file = HDF5TrajectoryFile(file, 'a' if self.append else 'w')
+        self._initialized = False
+        # buffers that are ready to be filled, and buffers (with their
+        # number of frames) waiting to be written
+        self._free = Queue.Queue()
+        self._full = Queue.Queue()
+        self._current = None
+        self._n = 0
+        self._error = None
+        self._thread = threading.Thread(target=self._run,
+                                        name='BufferedHDF5Reporter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def describeNextReport(self, simulation):
+        steps = self._reportInterval - simulation.currentStep % self._reportInterval
+        return (steps, True, False, False, True)
+
+    def report(self, simulation, state):
+        if not self._initialized:
+            self._initialize(simulation)
+        if self._error is not None:
+            raise self._error
+        if self._current is None:
+            # this only blocks if both buffers are waiting to be written
+            self._current = self._free.get()
+            self._n = 0
+
+        i = self._n
+        buf = self._current
+        xyz = state.getPositions(asNumpy=True).value_in_unit(units.nanometers)
+        if self.atomSubset is not None:
+            xyz = xyz[self.atomSubset]
+        buf['coordinates'][i] = xyz
+        buf['box'][i] = state.getPeriodicBoxVectors(asNumpy=True).value_in_unit(units.nanometers)
+        buf['time'][i] = state.getTime().value_in_unit(units.picoseconds)
+        buf['potentialEnergy'][i] = state.getPotentialEnergy().value_in_unit(units.kilojoules_per_mole)
+        kinetic = state.getKineticEnergy()
+        buf['kineticEnergy'][i] = kinetic.value_in_unit(units.kilojoules_per_mole)
+        buf['temperature'][i] = (2 * kinetic / (self._dof * units.MOLAR_GAS_CONSTANT_R)).value_in_unit(units.kelvin)
+        self._n += 1
+
+        if self._n == self.buffer_size:
+            self._full.put((self._current, self._n))
+            self._current = None
+
+    def flush(self):
+        """Write all of the frames reported so far to the file"""
+        if self._current is not None and self._n > 0:
+            self._full.put((self._current, self._n))
+            self._current = None
+        self._full.join()
+        if self._error is not None:
+            raise self._error
+        self._traj_file.flush()
+
+    def close(self):
+        if self._thread is None:
+            return
+        if self._initialized:
+            self.flush()
+        self._full.put(None)
+        self._thread.join()
+        self._thread = None
+        self._traj_file.close()
+
+    def _initialize(self, simulation):
+        topology = md.Topology.from_openmm(simulation.topology)
+        if self.atomSubset is not None:
+            topology = topology.subset(self.atomSubset)
+        n_atoms = topology.n_atoms
+        # this is the only time that this thread touches the file. the
+        # writer thread hasn't been given anything to write yet.
+        if not self.append:
+            self._traj_file.topology = topology
+
+        # degrees of freedom, for the temperature. the same as in OpenMM's
+        # StateDataReporter
+        system = simulation.system
+        dof = 0
+        for i in range(system.getNumParticles()):
+            if system.getParticleMass(i) > 0 * units.dalton:
+                dof += 3
+        dof -= system.getNumConstraints()
+        if any(isinstance(system.getForce(i), mm.CMMotionRemover)
+               for i in range(system.getNumForces())):
+            dof -= 3
+        self._dof = dof
+
+        for i in range(2):
+            self._free.put({
+                'coordinates': np.zeros((self.buffer_size, n_atoms, 3), dtype=np.float32),
+                'box': np.zeros((self.buffer_size, 3, 3), dtype=np.float32),
+                'time': np.zeros(self.buffer_size, dtype=np.float32),
+                'potentialEnergy': np.zeros(self.buffer_size, dtype=np.float32),
+                'kineticEnergy': np.zeros(self.buffer_size, dtype=np.float32),
+                'temperature': np.zeros(self.buffer_size, dtype=np.float32),
+            })
+        self._initialized = True
+
+    def _run(self):
+        while True:
+            item = self._full.get()
+            if item is None:
+                self._full.task_done()
+                return
+            buf, n = item
+            try:
+                if self._error is None:
+                    self._write(buf, n)
+            except Exception as e:
+                # raised in the main thread, on the next report
+                self._error = e
+            finally:
+                self._free.put(buf)
+                self._full.task_done()
+
+    def _write(self, buf, n):
+        coordinates = buf['coordinates'][:n]
+        if self.precision > 0:
+            coordinates = quantize(coordinates, self.precision)
+        box = buf['box'][:n]
+        lengths, angles = box_vectors_to_lengths_and_angles(box[:, 0], box[:, 1], box[:, 2])
+        self._traj_file.write(coordinates=coordinates, time=buf['time'][:n],
+            cell_lengths=lengths, cell_angles=angles,
+            potentialEnergy=buf['potentialEnergy'][:n],
+            kineticEnergy=buf['kineticEnergy'][:n],
+            temperature=buf['temperature'][:n])
+
+
+class QuantizedHDF5TrajectoryFile(HDF5TrajectoryFile):
+    """HDF5TrajectoryFile that rounds the coordinates before writing them.
+
+    The file format is unchanged, so any reader can load the file. But the
+    low bits of the rounded values are zero, so the file's (zlib + shuffle)
+    compression does a much better job on them. See quantize().
+
+    Parameters
+    ----------
+    filename : str
+        Path to the file
+    mode : {'w', 'a'}
+        The mode to open the file in
+    precision : float
+        The coordinates are rounded to a multiple of a power of two no
+        bigger than this, in nanometers.
+    """
+    def __init__(self, filename, mode='w', precision=1e-3, **kwargs):
+        super(QuantizedHDF5TrajectoryFile, self).__init__(filename, mode, **kwargs)
+        self.precision = precision
+
+    def write(self, coordinates, *args, **kwargs):
+        if coordinates is not None:
+            coordinates = quantize(coordinates, self.precision)
+        super(QuantizedHDF5TrajectoryFile, self).write(coordinates, *args, **kwargs)
+
+
+def quantize(x, precision):
+    """Round an array to a multiple of the largest power of two that's no
+    bigger than `precision`.
+
+    Rounding to a power of two, instead of a number of decimal places, makes
+    the values exactly representable, with as many low bits of the mantissa
+    equal to zero as possible.
+    """
+    scale = 2.0 ** math.ceil(-math.log(precision, 2))
+    return (np.round(np.asarray(x) * scale) / scale).astype(np.float32)
+
+
+def report_status(report):
+    """The status of a simulation, from a CallbackReporter report, for
+    Device.publish_status()
+
+    StateDataReporter formats some of the values as strings, e.g. the speed
+    is '%.3g' (and '--' in the first report), so they're parsed here. The
+    values that are missing, or can't be parsed, are None.
+
+    Returns
+    -------
+    status : dict
+        With the keys 'step', 'ns_per_day' and 'potential_energy' (in
+        kJ/mol)
+    """
+    def number(key, type=float):
+        try:
+            return type(report[key])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    return {'step': number('Step', int),
+            'ns_per_day': number('Speed (ns/day)'),
+            'potential_energy': number('Potential Energy (kJ/mole)')}
@@ -0,0 +1,164 @@
+"""Helpers for resuming a simulation from a checkpoint.
+
+The simulators save checkpoints next to their output trajectory, and tell
+the server about them (see Device.checkpoint). If the simulator dies, the
+server hands the job, with its last checkpoint, to the next simulator that
+registers, as a new job with its own output trajectory. That one copies
+the frames of the original trajectory that were saved before the
+checkpoint into its own output trajectory, and then continues the dynamics
+from the checkpoint, appending the new frames to it. The original
+trajectory is left alone.
+
+So the output trajectory of a job always holds the whole trajectory up to
+its last checkpoint, and a job resumed from one of those checkpoints (even
+if the job was itself resumed) only needs that one file.
+"""
+##############################################################################
+# Imports
+##############################################################################
+
+import os
+
+from mdtraj.formats import HDF5TrajectoryFile
+
+from ..core.trajectory_cache import TrajectoryCache
+
+##############################################################################
+# Functions
+##############################################################################
+
+
+def checkpoint_filename(path, extension='.chk'):
+    """Filename of the checkpoint for the trajectory at `path`"""
+    return os.path.splitext(path)[0] + extension
+
+
+def can_resume(path, n_frames, topology=None):
+    """Check that the first `n_frames` frames of the original trajectory
+    can be read, so that the frames saved after the checkpoint can be
+    added to them.
+
+    Parameters
+    ----------
+    path : str
+        The original trajectory
+    n_frames : int
+        The number of frames that were written before the checkpoint was
+        saved
+    topology : str, optional
+        Path to a file giving the topology, for formats that don't contain
+        one (e.g. AMBER NetCDF)
+    """
+    if n_frames == 0:
+        return True
+    if not os.path.exists(path):
+        return False
+    trajectories = TrajectoryCache(max_open=1, topology=topology)
+    try:
+        trajectories.read_frame(path, n_frames - 1)
+        return True
+    except Exception:
+        return False
+    finally:
+        trajectories.close()
+
+
+def copy_hdf5_frames(path, n_frames, output):
+    """Copy the first `n_frames` frames of an HDF5 trajectory to a new file,
+    so that the frames of a resumed simulation can be appended to it.
+
+    All of the fields of the frames (the energies, temperature, etc.) are
+    copied, not just the ones that md.Trajectory keeps, since
+    HDF5TrajectoryFile won't append frames with different fields.
+
+    Parameters
+    ----------
+    path : str
+        The original trajectory
+    n_frames : int
+        The number of frames to copy. If the trajectory has fewer than this,
+        an IOError is raised.
+    output : str
+        The file to create
+    """
+    with HDF5TrajectoryFile(path, 'r') as f:
+        topology = f.topology
+        frames = f.read(n_frames)
+    if len(frames.coordinates) < n_frames:
+        raise IOError('%s has only %d frames' % (path, len(frames.coordinates)))
+
+    # write to a temporary file, and then rename it
+    root, ext = os.path.splitext(output)
+    tmp = root + '.tmp' + ext
+    with HDF5TrajectoryFile(tmp, 'w') as f:
+        f.topology = topology
+        f.write(**dict((name, value) for name, value in frames._asdict().items()
+                       if value is not None))
+    os.rename(tmp, output)
+
+
+def join_frames(pieces, output, topology=None):
+    """Join the first frames of some trajectories into a new one.
+
+    Parameters
+    ----------
+    pieces : list of (str, int)
+        The trajectories, and how many of their frames to take. If the
+        number is None, all of them are taken. If a trajectory has fewer
+        frames than that (e.g. because it's still being written), an
+        IOError is raised.
+    output : str
+        Where to save the joined trajectory
+    topology : str, optional
+        Path to a file giving the topology, for formats that don't contain
+        one (e.g. AMBER NetCDF)
+    """
+    trajectories = TrajectoryCache(max_open=2, topology=topology)
+    joined = []
+    try:
+        for path, n_frames in pieces:
+            if n_frames == 0:
+                continue
+            if n_frames is not None and trajectories.n_frames(path) < n_frames:
+                raise IOError('%s has only %d frames' % (path, trajectories.n_frames(path)))
+            joined.append(trajectories.read(path, stop=n_frames))
+    finally:
+        trajectories.close()
+    if len(joined) == 0:
+        raise ValueError('no frames to join')
+    joined = joined[0].join(joined[1:])
+
+    # write to a temporary file (with the same extension, so that mdtraj
+    # picks the same format), and then rename it
+    root, ext = os.path.splitext(output)
+    tmp = root + '.tmp' + ext
+    joined.save(tmp)
+    os.rename(tmp, output)
+
+
+def join_resumed(path, resumed_fn, n_frames, topology=None, output=None):
+    """Join the frames of a resumed simulation onto the first `n_frames`
+    frames of the original trajectory.
+
+    Parameters
+    ----------
+    path : str
+        The original trajectory. Any frames after the first `n_frames`
+        (written after the checkpoint, before the simulation died) are
+        dropped.
+    resumed_fn : str
+        The frames written by the resumed simulation. This file is removed.
+    n_frames : int
+        The number of frames that were written before the checkpoint was
+        saved
+    topology : str, optional
+        Path to a file giving the topology, for formats that don't contain
+        one (e.g. AMBER NetCDF)
+    output : str, optional
+        Where to save the joined trajectory. By default, it replaces the
+        original one.
+    """
+    if output is None:
+        output = path
+    join_frames([(path, n_frames), (resumed_fn, None)], output, topology)
+    os.unlink(resumed_fn)
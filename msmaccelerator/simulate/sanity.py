@@ -0,0 +1,171 @@
+"""Sanity checks on the starting structures of the simulations.
+
+Before we spend hours of dynamics on a starting structure, we check that
+the atoms that are bonded according to the topology are actually close to
+one another in space. A structure that fails this has been mangled
+somewhere (e.g. by imaging, or by a bad conversion between formats), and
+would blow up or give garbage.
+
+The bonds are turned into an array of atom indices once per topology, so
+that checking a structure is a single vectorized operation, which is fast
+even for very big (e.g. membrane) systems.
+"""
+##############################################################################
+# Imports
+##############################################################################
+
+import re
+
+import numpy as np
+
+##############################################################################
+# Globals
+##############################################################################
+
+# maximum bond length, in nanometers
+MAX_BOND_LENGTH = 0.3
+
+##############################################################################
+# Functions
+##############################################################################
+
+
+def topology_bonds(topology):
+    """The bonds in an OpenMM Topology
+
+    Returns
+    -------
+    bonds : np.ndarray, shape=[n_bonds, 2], dtype=int
+        The indices of the two atoms in each bond
+    """
+    bonds = np.array([(a.index, b.index) for a, b in topology.bonds()], dtype=int)
+    return bonds.reshape(-1, 2)
+
+
+def prmtop_bonds(path):
+    """The bonds in an AMBER prmtop file, from its BONDS_INC_HYDROGEN and
+    BONDS_WITHOUT_HYDROGEN sections.
+
+    Returns
+    -------
+    bonds : np.ndarray, shape=[n_bonds, 2], dtype=int
+        The indices of the two atoms in each bond
+    """
+    sections = read_prmtop_sections(path,
+        ['BONDS_INC_HYDROGEN', 'BONDS_WITHOUT_HYDROGEN'])
+    bonds = []
+    for name in ['BONDS_INC_HYDROGEN', 'BONDS_WITHOUT_HYDROGEN']:
+        # each bond is (3*i, 3*j, type), where i and j are the (zero based)
+        # indices of the atoms. the 3* makes them indices into the array of
+        # coordinates.
+        triples = np.array(sections.get(name, []), dtype=int).reshape(-1, 3)
+        bonds.append(triples[:, :2] // 3)
+    return np.concatenate(bonds)
+
+
+def read_prmtop_sections(path, names):
+    """Read integer sections (%FLAG) from an AMBER prmtop file
+
+    Parameters
+    ----------
+    path : str
+        The prmtop file
+    names : list of str
+        The sections to read. They must have an integer %FORMAT, e.g.
+        (10I8).
+
+    Returns
+    -------
+    sections : dict of str -> list of int
+        The values in each of the sections that was found
+    """
+    sections = {}
+    name, width = None, None
+    with open(path) as f:
+        for line in f:
+            if line.startswith('%FLAG'):
+                name = line.split()[1]
+                width = None
+                if name in names:
+                    sections[name] = []
+            elif line.startswith('%FORMAT'):
+                match = re.search(r'I(\d+)', line)
+                width = int(match.group(1)) if match is not None else None
+            elif line.startswith('%'):
+                # %VERSION, %COMMENT
+                continue
+            elif name in sections:
+                if width is None:
+                    raise ValueError('%s: section %s is not integer' % (path, name))
+                # fixed width fields, which can run together when the
+                # numbers are big
+                line = line.rstrip('\r\n')
+                sections[name].extend(int(line[i:i+width])
+                                      for i in range(0, len(line), width)
+                                      if line[i:i+width].strip())
+    return sections
+
+
+def long_bonds(positions, bonds, cutoff=MAX_BOND_LENGTH):
+    """Find the bonds that are longer than `cutoff`
+
+    Parameters
+    ----------
+    positions : np.ndarray, shape=[n_atoms, 3]
+        The coordinates of the atoms
+    bonds : np.ndarray, shape=[n_bonds, 2]
+        The indices of the two atoms in each bond, from topology_bonds() or
+        prmtop_bonds()
+    cutoff : float
+        The maximum bond length, in the same units as `positions`
+
+    Returns
+    -------
+    bad : np.ndarray, shape=[n_bad]
+        The indices (into `bonds`) of the bonds that are too long, or
+        whose length isn't finite.
+    lengths : np.ndarray, shape=[n_bad]
+        Their lengths
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    delta = positions[bonds[:, 0]] - positions[bonds[:, 1]]
+    lengths = np.sqrt(np.einsum('ij,ij->i', delta, delta))
+    # written this way so that NaNs count as too long
+    bad = np.where(~(lengths < cutoff))[0]
+    return bad, lengths[bad]
+
+
+def check_bonds(positions, bonds, cutoff=MAX_BOND_LENGTH, max_listed=20):
+    """Check that all of the bonded atoms are close by in space
+
+    Parameters
+    ----------
+    positions : np.ndarray, shape=[n_atoms, 3]
+        The coordinates of the atoms
+    bonds : np.ndarray, shape=[n_bonds, 2]
+        The indices of the two atoms in each bond
+    cutoff : float
+        The maximum bond length, in the same units as `positions`
+    max_listed : int
+        Maximum number of bad bonds to list in the error message
+
+    Raises
+    ------
+    ValueError
+        If any bond is too long. The message lists all of them (up to
+        `max_listed`).
+    """
+    if len(bonds) > 0 and bonds.max() >= len(positions):
+        raise ValueError('the topology has more atoms than the structure '
+                         '(%d)' % len(positions))
+    bad, lengths = long_bonds(positions, bonds, cutoff)
+    if len(bad) == 0:
+        return
+
+    lines = ['%d pairs of atoms are bonded according to the topology, but '
+             'not close by in space (cutoff %s):' % (len(bad), cutoff)]
+    for i, length in zip(bad[:max_listed], lengths[:max_listed]):
+        lines.append('  %d-%d: %s' % (bonds[i, 0], bonds[i, 1], length))
+    if len(bad) > max_listed:
+        lines.append('  and %d more' % (len(bad) - max_listed))
+    raise ValueError('\n'.join(lines))
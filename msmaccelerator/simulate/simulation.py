@@ -7,16 +7,26 @@ structure, and then propagate.
 
 import os
 import sys
+import time
+import traceback
+import multiprocessing
+from multiprocessing.queues import SimpleQueue
 import numpy as np
-from IPython.utils.traitlets import Unicode, CInt, Instance, Bool, Enum
+from IPython.utils.traitlets import Unicode, CInt, Instance, Bool, Enum, Float
 from mdtraj.reporters import HDF5Reporter
 import simtk.openmm as mm
+from simtk import unit
 from simtk.openmm import XmlSerializer, Platform
 from simtk.openmm.app import (Simulation, PDBFile)
 
 # local
-from .reporters import CallbackReporter
+from .reporters import (CallbackReporter, QuantizedHDF5TrajectoryFile,
+                        BufferedHDF5Reporter, report_status)
+from .resume import checkpoint_filename, can_resume, copy_hdf5_frames
+from .sanity import topology_bonds, check_bonds
 from ..core.device import Device
+from ..core.message import Message
+from ..core.trajectory_cache import full_system_filename, save_atom_indices
 
 #############################################################################
 # Handlers
@@ -46,17 +56,87 @@ class OpenMMSimulator(Device):
     report_interval = CInt(1000, config=True, help='''
         Interval at which to save positions to a disk, in units of steps''')
 
+    output_atom_indices = Unicode('', config=True, help='''File containing
+        the indices of the atoms to save to the output trajectory, e.g. the
+        modeler's AtomIndices.dat. If empty, all of them are saved. The
+        indices are saved next to the trajectory (see
+        trajectory_cache.atom_indices_filename), so that the modeler (and
+        the server's cache of features) can find their atoms in it, and
+        they must include all of the ones that the modeler uses. The server
+        needs the full system to build new starting states, so use this
+        with full_report_interval.''')
+
+    full_report_interval = CInt(0, config=True, help='''With
+        output_atom_indices, also save the full system every this many steps
+        (a multiple of report_interval) to a second trajectory, named like
+        the output trajectory with .full before the extension (and with
+        segment_steps, one for each segment). When the server samples a
+        frame of the trajectory, it starts the new simulation from the
+        nearest frame of the full system.''')
+
+    coordinate_precision = Float(0, config=True, help='''If nonzero, round the
+        saved coordinates to a multiple of a power of two no bigger than
+        this, in nanometers (e.g. 0.001), so that they compress better. If
+        zero, the coordinates are saved at full (single) precision.''')
+
+    buffer_frames = CInt(0, config=True, help='''If nonzero, collect this
+        many frames in memory before writing them to the trajectory, from a
+        background thread, so that the dynamics don't wait on the disk. This
+        is worth it for short report intervals. A checkpoint or the end of a
+        segment writes out whatever has been collected.''')
+
+    status_interval = Float(0, config=True, help='''Minimum interval, in
+        seconds, between the status reports (the log lines, and the
+        heartbeats) made during the dynamics. The reports in between are
+        skipped, so OpenMM doesn't compute the energies for them.''')
+
+    segment_steps = CInt(0, config=True, help='''If nonzero, write the
+        trajectory in segments of this many steps, each to its own file, and
+        register each segment with the server as soon as it's written, so
+        that it can be used to build models before the simulation is done.
+        This should be a multiple of report_interval. The segments are
+        named like the output trajectory, with .segNNNN before the
+        extension. This isn't used with multiple walkers.''')
+
+    checkpoint_interval = CInt(0, config=True, help='''If nonzero, save a
+        checkpoint of the simulation every this many steps, next to the
+        output trajectory, and tell the server about it. If we're killed,
+        the server hands the job to the next simulator, which resumes it
+        from the checkpoint, and continues the same trajectory. This should
+        be a multiple of report_interval. With segment_steps, a checkpoint
+        is saved at the end of each segment instead. OpenMM checkpoints can
+        only be loaded on the same platform and hardware. This isn't used
+        with multiple walkers.''')
+
     minimize = Bool(True, config=True, help='''Do local energy minimization on
         the configuration that's passed to me, before running dynamics''')
 
     random_initial_velocities = Bool(True, config=True, help='''Choose
         random initial velocities from the Maxwell-Boltzmann distribution''')
 
-    platform = Enum(['Reference', 'CUDA', 'OpenCL'], default_value='CUDA',
+    platform = Enum(['Reference', 'CPU', 'CUDA', 'OpenCL'], default_value='CUDA',
         config=True, help='''The OpenMM platform on which to run the simulation''')
     device_index = CInt(0, config=True, help='''OpenMM device index for CUDA or
         OpenCL platforms. This is used to select which GPU will be used on a
         multi-gpu system. This option is ignored on reference platform''')
+    worker_loop = Bool(False, config=True, help='''After finishing a
+        simulation, ask the server for another one, instead of exiting. The
+        OpenMM Context is reused between the simulations, which saves the
+        cost of creating it (and compiling the kernels) for each one.''')
+    max_jobs = CInt(0, config=True, help='''In the worker loop mode, exit
+        after this many simulations. If zero, keep going until killed.''')
+    n_walkers = CInt(1, config=True, help='''Number of simulations to run at
+        once, each in its own worker process with its own Context. The
+        server sends this many starting states at a time. The worker
+        processes are forked after the system is deserialized, so they share
+        it, which makes this a cheap way to use all of the cores of a
+        CPU-only node for a small system (use --platform=CPU). Each walker
+        writes its own trajectory, and is reported to the server as soon as
+        it's done.''')
+    threads_per_walker = CInt(0, config=True, help='''Number of threads
+        for the Context of each walker, on the CPU platform. If zero, the
+        cores are split evenly between the walkers. (By default, OpenMM
+        would start one thread per core in each of them.)''')
 
 
     # expose these as command line flags on --help
@@ -66,48 +146,406 @@ class OpenMMSimulator(Device):
                   integrator_xml='OpenMMSimulator.integrator_xml',
                   number_of_steps='OpenMMSimulator.number_of_steps',
                   report_interval='OpenMMSimulator.report_interval',
+                  output_atom_indices='OpenMMSimulator.output_atom_indices',
+                  full_report_interval='OpenMMSimulator.full_report_interval',
+                  coordinate_precision='OpenMMSimulator.coordinate_precision',
+                  buffer_frames='OpenMMSimulator.buffer_frames',
+                  status_interval='OpenMMSimulator.status_interval',
+                  segment_steps='OpenMMSimulator.segment_steps',
+                  checkpoint_interval='OpenMMSimulator.checkpoint_interval',
                   zmq_port='Device.zmq_port',
                   zmq_url='Device.zmq_url',
                   platform='OpenMMSimulator.platform',
-                  device_index='OpenMMSimulator.device_index')
+                  device_index='OpenMMSimulator.device_index',
+                  worker_loop='OpenMMSimulator.worker_loop',
+                  max_jobs='OpenMMSimulator.max_jobs',
+                  n_walkers='OpenMMSimulator.n_walkers',
+                  threads_per_walker='OpenMMSimulator.threads_per_walker')
 
 
     def start(self):
         # load up the system and integrator files
         with open(self.system_xml) as f:
             self.system = XmlSerializer.deserialize(f.read())
-            # reset the random number seed for any random
-            # forces (andersen thermostat, montecarlo barostat)
-            for i in range(self.system.getNumForces()):
-                force = self.system.getForce(i)
-                if hasattr(force, 'setRandomNumberSeed'):
-                    force.setRandomNumberSeed(random_seed())
         with open(self.integrator_xml) as f:
             self.integrator = XmlSerializer.deserialize(f.read())
-
-            # reset the random number seed for a stochastic integrator
-            if hasattr(self.integrator, 'setRandomNumberSeed'):
-                self.integrator.setRandomNumberSeed(random_seed())
-
-        super(OpenMMSimulator, self).start()
+        self.reseed()
+
+        self._output_atom_subset = None
+        if self.output_atom_indices != '':
+            # the reporter saves the atoms in the order of the topology
+            self._output_atom_subset = np.unique(np.loadtxt(
+                self.output_atom_indices, dtype=int)).tolist()
+
+        self._walker_pool = None
+        if self.n_walkers > 1:
+            # fork the walkers before we open any sockets. they inherit the
+            # system and integrator that we just deserialized. they tell us
+            # which job each of them is running on _walker_started, so that
+            # we can tell when one dies without returning.
+            self._walker_started = SimpleQueue()
+            self._walker_pool = multiprocessing.Pool(self.n_walkers,
+                initializer=_init_walker, initargs=(self, self._walker_started))
+
+        try:
+            super(OpenMMSimulator, self).start()
+        finally:
+            if self._walker_pool is not None:
+                self._walker_pool.terminate()
+
+    def reseed(self):
+        """Reset the random number seeds of the system and integrator"""
+        # reset the random number seed for any random
+        # forces (andersen thermostat, montecarlo barostat)
+        for i in range(self.system.getNumForces()):
+            force = self.system.getForce(i)
+            if hasattr(force, 'setRandomNumberSeed'):
+                force.setRandomNumberSeed(random_seed())
+
+        # reset the random number seed for a stochastic integrator
+        if hasattr(self.integrator, 'setRandomNumberSeed'):
+            self.integrator.setRandomNumberSeed(random_seed())
+
+    def registration_content(self):
+        if self.n_walkers > 1:
+            # ask for a batch of starting states
+            return {'n_walkers': self.n_walkers}
+        return None
 
     def on_startup_message(self, msg):
         """This method is called when the device receives its startup message
         from the server.
         """
 
-        assert msg.header.msg_type in ['simulate']  # only allowed RPC
+        assert msg.header.msg_type in ['simulate', 'simulate_batch']  # only allowed RPC
         return getattr(self, msg.header.msg_type)(msg.header, msg.content)
 
     def simulate(self, header, content):
         """Main method that is "executed" by the receipt of the
         msg_type == 'simulate' message from the server.
 
-        We run some OpenMM dynamics, and then send back the results.
+        We run some OpenMM dynamics, and then send back the results. In the
+        worker loop mode, we then ask the server for another job, and keep
+        going.
+
+        This also handles the msg_type == 'simulate_batch' message, which the
+        server sends when we have more than one walker. Its content is a
+        list of jobs, each of which looks like the content of a 'simulate'
+        message.
+        """
+        n_jobs = 0
+        msg_type = header.msg_type
+        while True:
+            if 'status_port' in content:
+                # the server wants the status reports published to it
+                self.connect_status(content.status_port)
+            if msg_type == 'simulate_batch':
+                self.run_batch(content.jobs)
+                n_jobs += len(content.jobs)
+            else:
+                self.run_job(content)
+                n_jobs += 1
+            if not self.worker_loop or (self.max_jobs > 0 and n_jobs >= self.max_jobs):
+                break
+
+            # ask for the next job, the same way that we asked for the first
+            msg = self.register()
+            assert msg.header.msg_type in ['simulate', 'simulate_batch']  # only allowed RPC
+            msg_type, content = msg.header.msg_type, msg.content
+
+    simulate_batch = simulate
+
+    def run_job(self, content):
+        """Run the dynamics for a single simulate message"""
+        # our lease on this job, which we renew with heartbeats
+        job_id = content.job_id if 'job_id' in content else None
+        n_segments = self.propagate(content, job_id)
+        self.send_status_reports()
+
+        # tell the master that I'm done
+        done = {
+            'status': 'success',
+            'job_id': job_id,
+            'output': {
+                'protocol': 'localfs',
+                'path': content.output.path
+            }
+        }
+        if n_segments is not None:
+            # the segments have already been registered
+            done['segments'] = n_segments
+        self.send_recv(msg_type='simulation_done', content=done)
+
+    def run_batch(self, jobs):
+        """Run a batch of jobs in the walker processes, and tell the server
+        about each of them as soon as it's done.
+
+        The walkers can't talk to the server themselves, so while they're
+        running, we send the heartbeats for their jobs. A job whose walker
+        fails isn't reported, so its lease expires, and its starting state
+        is handed out again. That includes a walker process that dies
+        without returning (e.g. a segfault, or killed for running out of
+        memory): the pool replaces the process, but never returns a result
+        for its job, so we stop sending heartbeats for the job as soon as
+        its process is gone.
+        """
+        jobs = [Message(job) for job in jobs]
+        pending = dict((job.job_id, (job, self._walker_pool.apply_async(_run_walker, (job,))))
+                       for job in jobs)
+        # job_id -> pid of the walker running it
+        walkers = {}
+
+        while len(pending) > 0:
+            while not self._walker_started.empty():
+                job_id, pid = self._walker_started.get()
+                walkers[job_id] = pid
+            # (the pool doesn't have a public way to get at its processes)
+            alive = set(p.pid for p in self._walker_pool._pool if p.is_alive())
+
+            for job_id, (job, result) in pending.items():
+                if result.ready():
+                    del pending[job_id]
+                    error = result.get()[1]
+                    if error is not None:
+                        self.log.error('Walker failed on job %s:\n%s', job_id, error)
+                        continue
+                    self.send_recv(msg_type='simulation_done', content={
+                        'status': 'success',
+                        'job_id': job_id,
+                        'output': {
+                            'protocol': 'localfs',
+                            'path': job.output.path
+                        }
+                    })
+                elif job_id in walkers and walkers[job_id] not in alive:
+                    del pending[job_id]
+                    self.log.error('The walker running job %s (pid %d) died',
+                                   job_id, walkers[job_id])
+                else:
+                    self.heartbeat(job_id)
+            time.sleep(1)
+
+    def propagate(self, content, job_id=None):
+        """Set up and run the dynamics for a job, writing the trajectory to
+        content.output.path. If job_id is given, heartbeats for it are sent
+        to the server while the dynamics run.
+
+        If the content contains the last checkpoint of the job (resume),
+        the dynamics are continued from there.
+
+        Returns
+        -------
+        n_segments : int or None
+            If the trajectory was written (and registered) in segments, the
+            number of segments. See run_dynamics().
         """
         self.log.info('Setting up simulation...')
         state, topology = self.deserialize_input(content)
 
+        simulation = self.get_simulation(topology)
+        # do the setup
+        self.set_state(state, simulation)
+        start_step = 0
+        # the walkers (without a job_id) start over, since they can't tell
+        # the server about their own checkpoints anyways
+        if 'resume' in content and job_id is not None:
+            start_step = self.load_checkpoint(simulation, content)
+
+        if start_step == 0:
+            self.sanity_check(simulation)
+            if self.minimize:
+                self.log.info('minimizing...')
+                simulation.minimizeEnergy()
+
+            if self.random_initial_velocities:
+                try:
+                    temp = simulation.integrator.getTemperature()
+                    simulation.context.setVelocitiesToTemperature(temp)
+                except AttributeError:
+                    print "I don't know what temperature to use!!"
+                    # TODO: look through the system's forces to find an andersen
+                    # thermostate?
+                    raise
+                pass
+        # the reporters use the step count to decide when to report
+        simulation.currentStep = start_step
+
+        assert content.output.protocol == 'localfs', "I'm currently only equiped for localfs output"
+        # segments are registered with the server as they're written, which
+        # requires a job_id (and a connection to the server)
+        segmented = self.segment_steps > 0 and job_id is not None
+        outfn = content.output.path
+        if segmented:
+            outfn = segment_filename(outfn, start_step // self.segment_steps)
+        full_fn = None
+        if self._saves_full_system():
+            # segmented along with the trajectory, so that the server doesn't
+            # read a file that we're still writing
+            full_fn = full_system_filename(outfn)
+        if self._output_atom_subset is not None:
+            save_atom_indices(content.output.path, self._output_atom_subset)
+
+        append = start_step > 0 and not segmented
+        if append:
+            # start our output with the frames from before the checkpoint,
+            # which are in the trajectory of the job that saved it, and
+            # append to it, so that a job resumed from one of our own
+            # checkpoints only needs our output. (the earlier segments of
+            # a segmented trajectory have been registered already.)
+            self.copy_resumed_frames(content.resume.output.path, start_step,
+                                     outfn, full_fn)
+        self.log.info('adding reporters...')
+        self.add_reporters(simulation, outfn, job_id, full_fn, append)
+
+        # run dynamics!
+        self.log.info('Starting dynamics')
+        trajectory_id = content.trajectory_id if 'trajectory_id' in content else job_id
+        n_segments = self.run_dynamics(simulation, content.output.path, job_id,
+                                       start_step, trajectory_id)
+
+        for reporter in simulation.reporters:
+            # explicitly close the reporters so that any open file handles
+            # are closed.
+            if hasattr(reporter, 'close'):
+                reporter.close()
+        simulation.reporters = []
+        return n_segments
+
+    def copy_resumed_frames(self, path, start_step, outfn, full_fn=None):
+        """Copy the frames from before the checkpoint that a job is resumed
+        from, from the trajectory at `path` (and its full-system trajectory,
+        if full_fn is given) to the start of our own output trajectory. A
+        file is only created if there are frames to copy.
+        """
+        n_frames = start_step // self.report_interval
+        if n_frames > 0:
+            copy_hdf5_frames(path, n_frames, outfn)
+        if full_fn is not None:
+            n_full = start_step // self.full_report_interval
+            if n_full > 0:
+                copy_hdf5_frames(full_system_filename(path), n_full, full_fn)
+
+    def run_dynamics(self, simulation, path, job_id=None, start_step=0,
+                     trajectory_id=None):
+        """Run the dynamics from start_step to number_of_steps.
+
+        With segment_steps, the dynamics are run in segments. After each
+        one, its trajectory file is closed, registered with the server
+        (segment_done, with the trajectory_id that the segments of a
+        resumed job share with the job that it resumed), and replaced by
+        the next segment's file. The trajectory reporter must be the last
+        of the simulation's reporters, preceded by the full-system reporter
+        if there is one (see add_reporters()), which is segmented too.
+
+        With checkpoint_interval, a checkpoint is saved, and reported to the
+        server, every checkpoint_interval steps, or at the end of each
+        segment when the trajectory is segmented (so that a resumed job
+        starts a new segment).
+
+        Returns
+        -------
+        n_segments : int or None
+            The number of segments, if the trajectory was segmented
+        """
+        segmented = self.segment_steps > 0 and job_id is not None
+        checkpointing = self.checkpoint_interval > 0 and job_id is not None
+        interval = self.segment_steps if segmented else self.checkpoint_interval
+
+        step = start_step
+        while step < self.number_of_steps:
+            stop = self.number_of_steps
+            if interval > 0:
+                stop = min(stop, (step // interval + 1) * interval)
+            simulation.step(stop - step)
+            step = stop
+
+            if segmented:
+                i = (step - 1) // self.segment_steps
+                n_files = 2 if self._saves_full_system() else 1
+                for _ in range(n_files):
+                    simulation.reporters.pop().close()
+                if step < self.number_of_steps:
+                    next_fn = segment_filename(path, i + 1)
+                    if self._saves_full_system():
+                        simulation.reporters.append(self.hdf5_reporter(
+                            full_system_filename(next_fn),
+                            self.full_report_interval))
+                    simulation.reporters.append(self.trajectory_reporter(next_fn))
+
+                self.send_recv(msg_type='segment_done', content={
+                    'job_id': job_id,
+                    'trajectory_id': trajectory_id or job_id,
+                    'segment': i,
+                    'output': {
+                        'protocol': 'localfs',
+                        'path': segment_filename(path, i)
+                    }
+                })
+
+            if checkpointing and step < self.number_of_steps:
+                self.save_checkpoint(simulation, path, job_id, step)
+
+        if segmented:
+            return (self.number_of_steps + self.segment_steps - 1) // self.segment_steps
+        return None
+
+    def save_checkpoint(self, simulation, path, job_id, step):
+        """Save a checkpoint of the Context next to the output trajectory,
+        and tell the server about it"""
+        # the frames written before the checkpoint need to be on disk, since
+        # a resumed job keeps them
+        for reporter in simulation.reporters:
+            if hasattr(reporter, 'flush'):
+                reporter.flush()
+            elif getattr(reporter, '_traj_file', None) is not None:
+                reporter._traj_file.flush()
+
+        checkpoint_fn = checkpoint_filename(path)
+        with open(checkpoint_fn + '.tmp', 'wb') as f:
+            f.write(simulation.context.createCheckpoint())
+        os.rename(checkpoint_fn + '.tmp', checkpoint_fn)
+        self.checkpoint(job_id, checkpoint_fn, step)
+
+    def load_checkpoint(self, simulation, content):
+        """Load the last checkpoint of a job that's being resumed.
+
+        Returns
+        -------
+        start_step : int
+            The step to continue from, or 0 if the checkpoint can't be used
+            (e.g. it was saved on a different platform), in which case the
+            job is started over.
+        """
+        checkpoint_fn = content.resume.checkpoint.path
+        step = content.resume.step
+        try:
+            if self.segment_steps == 0 and not can_resume(content.resume.output.path,
+                    step // self.report_interval):
+                raise IOError('The trajectory is missing frames from before '
+                              'the checkpoint')
+            with open(checkpoint_fn, 'rb') as f:
+                simulation.context.loadCheckpoint(f.read())
+        except Exception as e:
+            self.log.warning('Unable to resume from checkpoint %s. Starting '
+                             'over: %s', checkpoint_fn, e)
+            return 0
+
+        self.log.info('Resuming from checkpoint %s, at step %d', checkpoint_fn, step)
+        return step
+
+    def get_simulation(self, topology):
+        """Get the Simulation to run the dynamics with.
+
+        It's created the first time this is called, and then reused for the
+        subsequent jobs (in the worker loop mode), so that we only pay for
+        creating the Context once. Each walker process has its own.
+        """
+        if getattr(self, '_simulation', None) is not None:
+            simulation = self._simulation
+            # the reporters use the step count to decide when to report
+            simulation.currentStep = 0
+            return simulation
+
         # set the GPU platform
         platform = Platform.getPlatformByName(str(self.platform))
         if self.platform == 'CUDA':
@@ -118,65 +556,31 @@ class OpenMMSimulator(Device):
             properties = {'OpenCLPrecision': 'mixed',
                           'OpenCLDeviceIndex': str(self.device_index)
                          }
+        elif self.platform == 'CPU' and (self.n_walkers > 1 or self.threads_per_walker > 0):
+            threads = self.threads_per_walker
+            if threads == 0:
+                threads = max(1, multiprocessing.cpu_count() // self.n_walkers)
+            properties = {'CpuThreads': str(threads)}
         else:
             properties = None
 
-
-        simulation = Simulation(topology, self.system, self.integrator,
-                                platform, properties)
-        # do the setup
-        self.set_state(state, simulation)
-        self.sanity_check(simulation)
-        if self.minimize:
-            self.log.info('minimizing...')
-            simulation.minimizeEnergy()
-
-        if self.random_initial_velocities:
-            try:
-                temp = simulation.integrator.getTemperature()
-                simulation.context.setVelocitiesToTemperature(temp)
-            except AttributeError:
-                print "I don't know what temperature to use!!"
-                # TODO: look through the system's forces to find an andersen
-                # thermostate?
-                raise
-            pass
-
-        assert content.output.protocol == 'localfs', "I'm currently only equiped for localfs output"
-        self.log.info('adding reporters...')
-        self.add_reporters(simulation, content.output.path)
-
-        # run dynamics!
-        self.log.info('Starting dynamics')
-        simulation.step(self.number_of_steps)
-
-        for reporter in simulation.reporters:
-            # explicitly delete the reporters so that any open file handles
-            # are closed.
-            del reporter
-
-        # tell the master that I'm done
-        self.send_recv(msg_type='simulation_done', content={
-            'status': 'success',
-            'output': {
-                'protocol': 'localfs',
-                'path': content.output.path
-            }
-        })
+        self._simulation = Simulation(topology, self.system, self.integrator,
+                                      platform, properties)
+        return self._simulation
 
     ##########################################################################
     # Begin helpers for setting up the simulation
     ##########################################################################
 
     def sanity_check(self, simulation):
+        """Check that the bonded atoms are close by in space. The bonds are
+        gathered from the topology once, and reused for the next jobs."""
+        if getattr(self, '_bonds', None) is None or \
+                self._bonds_topology is not simulation.topology:
+            self._bonds = topology_bonds(simulation.topology)
+            self._bonds_topology = simulation.topology
         positions = simulation.context.getState(getPositions=True).getPositions(asNumpy=True)
-        for atom1, atom2 in simulation.topology.bonds():
-            d = np.linalg.norm(positions[atom1.index, :] - positions[atom2.index, :])
-            if not d < 0.3:
-                self.log.error(positions[atom1.index, :])
-                self.log.error(positions[atom2.index, :])
-                raise ValueError('atoms are bonded according to topology but not close by '
-                                 'in space: %s. %s' % (d, positions))
+        check_bonds(positions.value_in_unit(unit.nanometers), self._bonds)
 
 
     def deserialize_input(self, content):
@@ -217,30 +621,119 @@ class OpenMMSimulator(Device):
         simulation.context.setPositions(state.getPositions())
         simulation.context.setVelocities(state.getVelocities())
         simulation.context.setPeriodicBoxVectors(*state.getPeriodicBoxVectors())
+        simulation.context.setTime(state.getTime())
         for key, value in state.getParameters():
             simulation.context.setParameter(key, value)
 
-    def add_reporters(self, simulation, outfn):
-        "Add reporters to a simulation"
+    def add_reporters(self, simulation, outfn, job_id=None, full_fn=None,
+                      append=False):
+        """Add reporters to a simulation. If full_fn is given, the full
+        system is also saved there, every full_report_interval steps. With
+        append, the frames are appended to the files, if they exist (see
+        copy_resumed_frames())."""
         def reporter_callback(report):
             """Callback for processing reporter output"""
             self.log.info(report)
+            if getattr(self, 'status_socket', None) is not None:
+                # this doesn't wait for the server, and also renews our
+                # lease on the job
+                self.publish_status(job_id, **report_status(report))
+            else:
+                self.heartbeat(job_id, step=report.get('Step'))
 
         callback_reporter = CallbackReporter(reporter_callback,
             self.report_interval, step=True, potentialEnergy=True,
-            temperature=True, time=True, total_steps=self.number_of_steps)
-        h5_reporter = HDF5Reporter(outfn, self.report_interval, coordinates=True,
-                                   time=True, cell=True, potentialEnergy=True,
-                                   kineticEnergy=True, temperature=True)
+            temperature=True, time=True, speed=True,
+            total_steps=self.number_of_steps,
+            min_interval=self.status_interval)
 
         simulation.reporters.append(callback_reporter)
-        simulation.reporters.append(h5_reporter)
+        if full_fn is not None:
+            simulation.reporters.append(self.hdf5_reporter(full_fn,
+                self.full_report_interval, append=append))
+        # this needs to be the last one. see run_dynamics()
+        simulation.reporters.append(self.trajectory_reporter(outfn, append))
+
+    def _saves_full_system(self):
+        """Whether the full system is saved to a second trajectory"""
+        return self._output_atom_subset is not None and self.full_report_interval > 0
+
+    def trajectory_reporter(self, outfn, append=False):
+        """Reporter that saves the trajectory to `outfn`"""
+        return self.hdf5_reporter(outfn, self.report_interval,
+                                  self._output_atom_subset, append)
+
+    def hdf5_reporter(self, outfn, interval, atom_subset=None, append=False):
+        """Reporter that saves the (subset of the) atoms every `interval`
+        steps to `outfn`, with the coordinate_precision. With append, the
+        frames are appended to the file, if it exists."""
+        if self.buffer_frames > 0 or append:
+            # (mdtraj's HDF5Reporter can't append)
+            return BufferedHDF5Reporter(outfn, interval, max(1, self.buffer_frames),
+                atomSubset=atom_subset, precision=self.coordinate_precision,
+                append=append)
+        if self.coordinate_precision > 0:
+            outfn = QuantizedHDF5TrajectoryFile(outfn, 'w',
+                precision=self.coordinate_precision)
+        return HDF5Reporter(outfn, interval, coordinates=True,
+                            time=True, cell=True, potentialEnergy=True,
+                            kineticEnergy=True, temperature=True,
+                            atomSubset=atom_subset)
+
+
+###############################################################################
+# Walkers
+###############################################################################
+
+# the simulator, in a walker process. it's inherited from the parent process
+# when the pool is forked, along with its system and integrator.
+_walker = None
+
+
+# where the walkers put (job_id, pid) when they start a job
+_walker_started = None
+
+
+def _init_walker(simulator, started):
+    global _walker, _walker_started
+    _walker = simulator
+    _walker_started = started
+    # otherwise, all of the walkers would use the same random numbers
+    _walker.reseed()
+
+
+def _run_walker(job):
+    """Run a job in a walker process.
+
+    Returns
+    -------
+    job_id : str
+        The job
+    error : str or None
+        The traceback, if the job failed
+    """
+    # this is written to the pipe right away (it's a SimpleQueue), so the
+    # parent gets it even if we die in the middle of the job
+    _walker_started.put((job.job_id, os.getpid()))
+    try:
+        # no job_id, since the walkers don't have a connection to the
+        # server. the parent process sends the heartbeats.
+        _walker.propagate(job)
+    except Exception:
+        return job.job_id, traceback.format_exc()
+    return job.job_id, None
 
 
 ###############################################################################
 # Utilities
 ###############################################################################
 
+def segment_filename(path, segment):
+    """Filename of a segment of a trajectory, e.g. traj.seg0003.h5"""
+    root, ext = os.path.splitext(path)
+    return '%s.seg%04d%s' % (root, segment, ext)
+
+
 def random_seed():
     """Get a seed for a random number generator, based on the current platform,
     pid, and wall clock time.
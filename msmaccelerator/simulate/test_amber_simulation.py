@@ -0,0 +1,125 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import mdtraj as md
+
+from msmaccelerator.core.message import Message
+from msmaccelerator.simulate.amber_simulation import (AmberSimulator,
+    AmberRun, mdin_value, set_mdin_values, restart_time)
+
+MDIN = '''production
+ &cntrl
+  imin=0, irest=1, ntx=5,
+  nstlim=500000, dt=0.002,
+  ntwx=5000, ntpr = 1000,
+ /
+'''
+
+
+def test_mdin_values():
+    assert mdin_value(MDIN, 'nstlim') == '500000'
+    assert mdin_value(MDIN, 'ntpr') == '1000'
+    assert mdin_value(MDIN, 'ntwr') is None
+    assert mdin_value(MDIN, 'ntwr', '-1') == '-1'
+    # not a prefix of another variable
+    assert mdin_value(MDIN, 'lim') is None
+
+    text = set_mdin_values(MDIN, nstlim=1000, ntwr=100)
+    assert mdin_value(text, 'nstlim') == '1000'
+    assert mdin_value(text, 'ntwr') == '100'
+    # and the rest are left alone
+    for name in ['imin', 'irest', 'ntx', 'dt', 'ntwx', 'ntpr']:
+        assert mdin_value(text, name) == mdin_value(MDIN, name)
+    assert text.rstrip().endswith('/')
+
+
+def test_restart_time():
+    dirname = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(dirname, 'md.rst')
+        with open(fn, 'w') as f:
+            f.write('title\n    2  0.1234500E+03\n'
+                    '   1.0000000   2.0000000   3.0000000   4.0000000   5.0000000   6.0000000\n')
+        assert restart_time(fn) == 123.45
+        # an inpcrd without the time
+        with open(fn, 'w') as f:
+            f.write('title\n    2\n'
+                    '   1.0000000   2.0000000   3.0000000   4.0000000   5.0000000   6.0000000\n')
+        assert restart_time(fn) == 0.0
+    finally:
+        shutil.rmtree(dirname)
+
+
+class CheckpointRecorder(AmberSimulator):
+    """Records the checkpoints instead of telling the server"""
+    def checkpoint(self, job_id, path, step):
+        self.checkpoints.append((job_id, path, step))
+
+
+def _save_trajectory(filename, frames, n_atoms=3):
+    """Save a trajectory whose x coordinates are the numbers in `frames`"""
+    topology = md.Topology()
+    residue = topology.add_residue('ALA', topology.add_chain())
+    for i in range(n_atoms):
+        topology.add_atom('C%d' % i, md.element.carbon, residue)
+    xyz = np.zeros((len(frames), n_atoms, 3), dtype=np.float32)
+    xyz[:, :, 0] = np.asarray(frames)[:, np.newaxis]
+    md.Trajectory(xyz, topology, time=np.asarray(frames, dtype=float)).save_hdf5(filename)
+
+
+def _write_restart(filename, time):
+    with open(filename, 'w') as f:
+        f.write('title\n    2  %15.7E\n' % time)
+        f.write('   1.0000000   2.0000000   3.0000000   4.0000000   5.0000000   6.0000000\n')
+
+
+def test_checkpoint_stages_frames():
+    # job b, resumed from job a's checkpoint at step 500, is preempted
+    # after its own checkpoint at step 800. the frames from before it have
+    # to be on the shared filesystem, not in b's scratch directory.
+    dirname = tempfile.mkdtemp()
+    try:
+        shared = os.path.join(dirname, 'shared')
+        os.mkdir(shared)
+        a, b = os.path.join(shared, 'a.h5'), os.path.join(shared, 'b.h5')
+        # a got as far as frame 7 (every 100 steps) before it died
+        _save_trajectory(a, range(8))
+
+        run = AmberRun(Message({
+            'job_id': 'b',
+            'output': {'protocol': 'localfs', 'path': b},
+            'resume': {'step': 500,
+                       'output': {'protocol': 'localfs', 'path': a},
+                       'checkpoint': {'protocol': 'localfs',
+                                      'path': os.path.join(shared, 'a.rst')}},
+        }), os.path.join(dirname, 'scratch'))
+        os.mkdir(run.scratch)
+        run.dt, run.nstlim, run.ntwx = 0.002, 2000, 100
+        run.start_step, run.start_time = 500, 1.0
+
+        simulator = CheckpointRecorder()
+        simulator.checkpoints = []
+        # pmemd has written the restart file at step 800, but only the
+        # first two of its frames
+        _write_restart(run.restart, 1.6)
+        _save_trajectory(run.traj, range(5, 7))
+        assert not simulator.save_checkpoint(run)
+        assert simulator.checkpoints == []
+
+        _save_trajectory(run.traj, range(5, 9))
+        assert simulator.save_checkpoint(run)
+        checkpoint_fn = os.path.join(shared, 'b.rst')
+        assert simulator.checkpoints == [('b', checkpoint_fn, 800)]
+        np.testing.assert_array_equal(md.load(b).xyz[:, 0, 0], np.arange(8))
+
+        # the node dies, and the scratch directory with it. the next job
+        # can still resume from b's checkpoint
+        shutil.rmtree(run.scratch)
+        resume = Message({'step': 800,
+                          'output': {'protocol': 'localfs', 'path': b},
+                          'checkpoint': {'protocol': 'localfs', 'path': checkpoint_fn}})
+        assert simulator.check_resume(resume, run.ntwx) == 800
+    finally:
+        shutil.rmtree(dirname)
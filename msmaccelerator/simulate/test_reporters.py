@@ -0,0 +1,116 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import mdtraj as md
+import simtk.openmm as mm
+from simtk import unit
+from simtk.openmm import app
+from nose.tools import assert_raises
+
+from msmaccelerator.simulate.reporters import (report_status, quantize,
+                                               BufferedHDF5Reporter)
+from msmaccelerator.simulate.resume import copy_hdf5_frames
+from msmaccelerator.server.stats import ServerStats
+
+
+def test_report_status():
+    # the values as StateDataReporter formats them, zipped with its headers
+    # by CallbackReporter
+    first = {'Step': 500, 'Potential Energy (kJ/mole)': -12345.6,
+             'Temperature (K)': 300.1, 'Time (ps)': 1.0,
+             'Speed (ns/day)': '--', 'Progress (%)': '5.0%'}
+    second = dict(first, Step=1000, **{'Speed (ns/day)': '42.5'})
+
+    assert report_status(first) == {'step': 500, 'ns_per_day': None,
+                                     'potential_energy': -12345.6}
+    assert report_status(second)['ns_per_day'] == 42.5
+    assert report_status({}) == {'step': None, 'ns_per_day': None,
+                                 'potential_energy': None}
+
+    # and through to the throughput of the fleet on the server
+    stats = ServerStats()
+    for report in [first, second]:
+        status = report_status(report)
+        stats.progress('job', status['ns_per_day'])
+    assert stats.to_dict()['fleet']['ns_per_day'] == 42.5
+
+
+def test_quantize():
+    x = np.array([0.1234567, -1.0004, 2.5])
+    q = quantize(x, 1e-3)
+    assert q.dtype == np.float32
+    # rounded to a multiple of 2**-10, which is no bigger than 1e-3
+    assert np.all(np.abs(q - x) <= 2.0 ** -11)
+    np.testing.assert_array_equal(q * 2 ** 10, np.round(q * 2 ** 10))
+    assert q[2] == 2.5
+
+
+def _free_particles(n_atoms=3):
+    """A Simulation of some non-interacting particles"""
+    topology = app.Topology()
+    residue = topology.addResidue('ALA', topology.addChain())
+    system = mm.System()
+    for i in range(n_atoms):
+        topology.addAtom('C%d' % i, app.element.carbon, residue)
+        system.addParticle(12.0)
+    simulation = app.Simulation(topology, system, mm.VerletIntegrator(0.001),
+                                mm.Platform.getPlatformByName('Reference'))
+    simulation.context.setPositions(unit.Quantity(np.random.randn(n_atoms, 3),
+                                                  unit.nanometers))
+    return simulation
+
+
+def test_buffered_reporter():
+    dirname = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(dirname, 'traj.h5')
+        simulation = _free_particles()
+        reporter = BufferedHDF5Reporter(fn, 2, buffer_size=3, atomSubset=[0, 2])
+        simulation.reporters.append(reporter)
+        # 7 frames: two full buffers, and one frame in the third
+        simulation.step(14)
+        reporter.close()
+        # twice is fine
+        reporter.close()
+
+        traj = md.load(fn)
+        assert (traj.n_frames, traj.n_atoms) == (7, 2)
+        np.testing.assert_array_almost_equal(traj.time, 0.002 * np.arange(1, 8))
+        final = simulation.context.getState(getPositions=True)
+        np.testing.assert_array_almost_equal(traj.xyz[-1],
+            final.getPositions(asNumpy=True).value_in_unit(unit.nanometers)[[0, 2]])
+
+        # resumed from a checkpoint after the 4th frame, appending to a copy
+        # of the frames from before it
+        resumed_fn = os.path.join(dirname, 'resumed.h5')
+        copy_hdf5_frames(fn, 4, resumed_fn)
+        simulation.currentStep = 8
+        simulation.reporters = [BufferedHDF5Reporter(resumed_fn, 2, buffer_size=3,
+                                                     atomSubset=[0, 2], append=True)]
+        simulation.step(6)
+        simulation.reporters[0].close()
+        assert md.load(resumed_fn).n_frames == 7
+    finally:
+        shutil.rmtree(dirname)
+
+
+def test_buffered_reporter_error():
+    dirname = tempfile.mkdtemp()
+    try:
+        simulation = _free_particles()
+        reporter = BufferedHDF5Reporter(os.path.join(dirname, 'traj.h5'), 1,
+                                        buffer_size=2)
+        def fail(buf, n):
+            raise IOError('disk full')
+        reporter._write = fail
+        simulation.reporters.append(reporter)
+
+        # the first buffer is handed to the writer, which fails. that's
+        # raised in the dynamics, on one of the following reports
+        simulation.step(2)
+        assert_raises(IOError, simulation.step, 4)
+        assert_raises(IOError, reporter.flush)
+    finally:
+        shutil.rmtree(dirname)
@@ -0,0 +1,115 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import mdtraj as md
+from mdtraj.formats import HDF5TrajectoryFile
+from nose.tools import assert_raises
+
+from msmaccelerator.simulate.resume import (can_resume, join_resumed,
+                                            copy_hdf5_frames, checkpoint_filename)
+
+
+def _topology(n_atoms=3):
+    topology = md.Topology()
+    residue = topology.add_residue('ALA', topology.add_chain())
+    for i in range(n_atoms):
+        topology.add_atom('C%d' % i, md.element.carbon, residue)
+    return topology
+
+
+def _frames(frames, n_atoms=3):
+    """Frames whose x coordinates are the numbers in `frames`"""
+    xyz = np.zeros((len(frames), n_atoms, 3), dtype=np.float32)
+    xyz[:, :, 0] = np.asarray(frames)[:, np.newaxis]
+    return xyz
+
+
+def _save_trajectory(filename, frames):
+    """Save a trajectory whose x coordinates are the numbers in `frames`"""
+    md.Trajectory(_frames(frames), _topology(),
+                  time=np.asarray(frames, dtype=float)).save_hdf5(filename)
+
+
+def _append_frames(filename, frames):
+    """Append frames to an HDF5 trajectory, with the fields that the
+    reporters write, like a simulation does"""
+    exists = os.path.exists(filename)
+    with HDF5TrajectoryFile(filename, 'a' if exists else 'w') as f:
+        if not exists:
+            f.topology = _topology()
+        n = len(frames)
+        f.write(coordinates=_frames(frames), time=np.asarray(frames, dtype=np.float32),
+                cell_lengths=np.ones((n, 3), dtype=np.float32),
+                cell_angles=90 * np.ones((n, 3), dtype=np.float32),
+                potentialEnergy=-np.asarray(frames, dtype=np.float32),
+                kineticEnergy=np.zeros(n, dtype=np.float32),
+                temperature=300 * np.ones(n, dtype=np.float32))
+
+
+def test_filenames():
+    assert checkpoint_filename('a/traj.h5') == 'a/traj.chk'
+    assert checkpoint_filename('a/traj.nc', '.rst') == 'a/traj.rst'
+
+
+def test_join_resumed():
+    dirname = tempfile.mkdtemp()
+    try:
+        # the simulation died after frame 7, and its last checkpoint was
+        # after frame 5
+        original = os.path.join(dirname, 'a.h5')
+        _save_trajectory(original, range(8))
+        assert can_resume(original, 5)
+        assert can_resume(original, 8)
+        assert not can_resume(original, 9)
+        assert not can_resume(os.path.join(dirname, 'missing.h5'), 5)
+        # nothing to join onto
+        assert can_resume(os.path.join(dirname, 'missing.h5'), 0)
+
+        # resumed as a new job, with its own output
+        resumed = os.path.join(dirname, 'b.new.h5')
+        _save_trajectory(resumed, range(5, 10))
+        output = os.path.join(dirname, 'b.h5')
+        join_resumed(original, resumed, 5, output=output)
+
+        np.testing.assert_array_equal(md.load(output).xyz[:, 0, 0], np.arange(10))
+        assert not os.path.exists(resumed)
+        # the original trajectory is left alone
+        assert md.load(original).n_frames == 8
+    finally:
+        shutil.rmtree(dirname)
+
+
+def test_resume_twice():
+    dirname = tempfile.mkdtemp()
+    try:
+        # job a dies after frame 7. its last checkpoint was after frame 5
+        a, b, c = [os.path.join(dirname, name + '.h5') for name in 'abc']
+        _append_frames(a, range(8))
+
+        # job b resumes it: copies the frames from before the checkpoint,
+        # and appends its own. it dies after frame 9, with a checkpoint
+        # after frame 8
+        assert can_resume(a, 5)
+        copy_hdf5_frames(a, 5, b)
+        _append_frames(b, range(5, 10))
+
+        # job c resumes b, which is all in b's output
+        assert can_resume(b, 8)
+        copy_hdf5_frames(b, 8, c)
+        _append_frames(c, range(8, 12))
+
+        with HDF5TrajectoryFile(c) as f:
+            frames = f.read()
+        np.testing.assert_array_equal(frames.coordinates[:, 0, 0], np.arange(12))
+        np.testing.assert_array_equal(frames.potentialEnergy, -np.arange(12))
+        # the others are left alone
+        assert md.load(a).n_frames == 8
+        assert md.load(b).n_frames == 10
+
+        # not enough frames
+        assert not can_resume(b, 11)
+        assert_raises(IOError, copy_hdf5_frames, b, 11, os.path.join(dirname, 'd.h5'))
+    finally:
+        shutil.rmtree(dirname)
@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from nose.tools import assert_raises
+
+from msmaccelerator.simulate.sanity import prmtop_bonds, long_bonds, check_bonds
+
+PRMTOP = '''%VERSION  VERSION_STAMP = V0001.000  DATE = 01/01/14  00:00:00
+%FLAG POINTERS
+%FORMAT(10I8)
+       4       2
+%FLAG BONDS_INC_HYDROGEN
+%FORMAT(10I8)
+       0       3       1       0       9       1
+%FLAG BONDS_WITHOUT_HYDROGEN
+%FORMAT(10I8)
+       3       6       2
+'''
+
+
+def test_prmtop_bonds():
+    dirname = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(dirname, 'test.prmtop')
+        with open(fn, 'w') as f:
+            f.write(PRMTOP)
+        bonds = prmtop_bonds(fn)
+    finally:
+        shutil.rmtree(dirname)
+    assert np.array_equal(bonds, [[0, 1], [0, 3], [1, 2]])
+
+
+def test_check_bonds():
+    positions = np.array([[0, 0, 0], [0.1, 0, 0], [0.2, 0, 0], [1.0, 0, 0]])
+    bonds = np.array([[0, 1], [1, 2], [0, 3], [2, 3]])
+    check_bonds(positions, bonds[:2])
+
+    bad, lengths = long_bonds(positions, bonds)
+    assert np.array_equal(bad, [2, 3])
+    assert np.allclose(lengths, [1.0, 0.8])
+
+    positions[1] = np.nan
+    bad, lengths = long_bonds(positions, bonds)
+    assert np.array_equal(bad, [0, 1, 2, 3])
+    assert_raises(ValueError, check_bonds, positions, bonds)
@@ -0,0 +1,6 @@
+from msmaccelerator.simulate.simulation import segment_filename
+
+
+def test_segment_filename():
+    assert segment_filename('a/traj.h5', 0) == 'a/traj.seg0000.h5'
+    assert segment_filename('a/traj.h5', 12) == 'a/traj.seg0012.h5'
@@ -100,10 +100,13 @@ def check_openmm_version():
 
 def check_mdtraj_version():
     import pkg_resources  # part of setuptools
-    err = ValueError('MSMAccelerator requires MDTraj version 0.1 or greater '
-                     'https://github.com/rmcgibbo/mdtraj')
+    # for mdtraj.formats (HDF5TrajectoryFile, AmberNetCDFRestartFile, ...),
+    # read_as_traj and atom_slice
+    err = ValueError('MSMAccelerator requires MDTraj version 1.5 or greater '
+                     'https://github.com/mdtraj/mdtraj')
     try:
-        if not pkg_resources.require("MDTraj")[0].version >= '0.1':
+        version = pkg_resources.require("MDTraj")[0].version
+        if pkg_resources.parse_version(version) < pkg_resources.parse_version('1.5'):
             raise err
     except pkg_resources.DistributionNotFound:
         raise err
@@ -129,7 +132,7 @@ setup_args = {
 if 'setuptools' in sys.modules:
     setup_args['zip_safe'] = False
     setup_args['install_requires'] = ['IPython>=0.12', 'pyzmq>=2.1.11',
-        'pyyaml', 'sqlalchemy']
+        'sqlalchemy']
 
 
 setup_args['packages'] = find_packages()